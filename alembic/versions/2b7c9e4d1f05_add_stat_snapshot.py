@@ -0,0 +1,32 @@
+"""Add zq_stat_snapshot
+
+Revision ID: 2b7c9e4d1f05
+Revises: 4868392d7270
+Create Date: 2026-10-17 01:12:40.318204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7c9e4d1f05'
+down_revision = '4868392d7270'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'zq_stat_snapshot',
+        sa.Column('key', sa.String(length=80), nullable=False),
+        sa.Column('data', postgresql.JSON(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('zq_stat_snapshot')
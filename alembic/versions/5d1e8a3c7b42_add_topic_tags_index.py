@@ -0,0 +1,26 @@
+"""Add GIN index on zq_topic.tags
+
+Revision ID: 5d1e8a3c7b42
+Revises: 2b7c9e4d1f05
+Create Date: 2026-10-17 09:24:51.602317
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1e8a3c7b42'
+down_revision = '2b7c9e4d1f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_zq_topic_tags', 'zq_topic', ['tags'], postgresql_using='gin',
+    )
+
+
+def downgrade():
+    op.drop_index('ix_zq_topic_tags', table_name='zq_topic')
@@ -0,0 +1,83 @@
+# coding: utf-8
+"""
+Compare cached payload size and decode time of pickled model instances
+against :mod:`zerqu.models.codec`.
+
+Usage::
+
+    $ python benchmarks/bench_codec.py
+"""
+from __future__ import print_function
+
+import timeit
+import pickle
+import datetime
+from sqlalchemy.orm import make_transient_to_detached
+from zerqu.app import create_app
+from zerqu.models import Topic, User, Comment
+from zerqu.models.codec import dump_row, load_row, codecs
+
+NUMBER = 10000
+
+
+def create_topic():
+    topic = Topic(
+        title=u'Compact, versioned row serialization',
+        content=u'Hello **world**\n\n' * 20,
+        user_id=1,
+    )
+    topic.id = 1
+    topic.tags = ['cache', 'redis']
+    topic.status = Topic.STATUS_PUBLIC
+    topic.created_at = topic.updated_at = datetime.datetime.utcnow()
+    return topic
+
+
+def create_user():
+    user = User(username='zerqu', email='zerqu@gmail.com', role=1)
+    user.id = 1
+    user.name = u'Zerqu'
+    user.description = u'An API based forum-like application'
+    user.reputation = 100
+    user.created_at = user.updated_at = datetime.datetime.utcnow()
+    return user
+
+
+def create_comment():
+    comment = Comment(content=u'nice post @zerqu', topic_id=1, user_id=1)
+    comment.id = 1
+    comment.status = 0
+    comment.flag_count = 0
+    comment.like_count = 3
+    comment.created_at = comment.updated_at = datetime.datetime.utcnow()
+    return comment
+
+
+def bench(obj):
+    model = type(obj)
+    make_transient_to_detached(obj)
+
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    seconds = timeit.timeit(lambda: pickle.loads(data), number=NUMBER)
+    yield 'pickle instance', len(data), seconds
+
+    for name in sorted(codecs):
+        app.config['ZERQU_MODEL_CODEC'] = name
+        data = dump_row(obj)
+        seconds = timeit.timeit(lambda: load_row(model, data), number=NUMBER)
+        yield name, len(data), seconds
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        print('%-10s %-16s %8s %12s' % (
+            'model', 'codec', 'bytes', 'decode(us)'
+        ))
+        for create in (create_topic, create_user, create_comment):
+            obj = create()
+            for name, size, seconds in bench(obj):
+                us = seconds / NUMBER * 1000000
+                print('%-10s %-16s %8d %12.2f' % (
+                    type(obj).__name__, name, size, us
+                ))
@@ -0,0 +1,110 @@
+# coding: utf-8
+"""
+Compare the time to build and encode a 100-topic timeline payload with
+``dict(o)`` plus the old ``JSONEncoder.default`` against
+:mod:`zerqu.models.serializer`.
+
+Usage::
+
+    $ python benchmarks/bench_serializer.py
+"""
+from __future__ import print_function
+
+import json
+import timeit
+import datetime
+from zerqu.app import create_app
+from zerqu.models import Topic, User, Cafe
+from zerqu.models.serializer import dump_model, dumps, backends
+
+NUMBER = 200
+TOPICS = 100
+
+
+class LegacyEncoder(json.JSONEncoder):
+    """``zerqu.app.JSONEncoder`` before the serializers"""
+
+    def default(self, o):
+        if hasattr(o, 'keys') and hasattr(o, '__getitem__'):
+            return dict(o)
+        if isinstance(o, datetime.datetime):
+            return o.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return json.JSONEncoder.default(self, o)
+
+
+def create_payload():
+    now = datetime.datetime.utcnow()
+    users = {}
+    for i in range(1, 11):
+        user = User(username='user%d' % i, email='u%d@gmail.com' % i, role=1)
+        user.id = i
+        user.name = u'User %d' % i
+        user.reputation = 100
+        user.created_at = user.updated_at = now
+        users[i] = user
+
+    cafe = Cafe(name=u'cafe', slug='cafe', user_id=1)
+    cafe.id = 1
+    cafe.status = Cafe.STATUS_ACTIVE
+    cafe.created_at = cafe.updated_at = now
+
+    topics = []
+    for i in range(1, TOPICS + 1):
+        topic = Topic(title=u'Topic %d' % i, content=u'', user_id=i % 10 + 1)
+        topic.id = i
+        topic.tags = ['cache', 'redis']
+        topic.status = Topic.STATUS_PUBLIC
+        topic.created_at = topic.updated_at = now
+        topics.append(topic)
+    return topics, users, [cafe]
+
+
+def legacy(topics, users, cafes, indent=None, sort_keys=False):
+    data = []
+    for topic in topics:
+        d = dict(topic)
+        d['user'] = dict(users[topic.user_id])
+        d['cafes'] = cafes
+        d['like_count'] = 3
+        data.append(d)
+    return json.dumps(
+        {'data': data, 'cursor': 0}, cls=LegacyEncoder,
+        indent=indent, sort_keys=sort_keys,
+    )
+
+
+def compiled(topics, users, cafes):
+    data = []
+    for topic in topics:
+        d = dump_model(topic)
+        d['user'] = dump_model(users[topic.user_id])
+        d['cafes'] = cafes
+        d['like_count'] = 3
+        data.append(d)
+    return dumps({'data': data, 'cursor': 0})
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.test_request_context():
+        payload = create_payload()
+        cases = [
+            ('dict(o), sorted and indented', lambda: legacy(
+                *payload, indent=2, sort_keys=True
+            )),
+            ('dict(o), compact', lambda: legacy(*payload)),
+        ]
+        for name in sorted(backends):
+            if backends[name] is None:
+                continue
+
+            def run(name=name):
+                app.config['ZERQU_JSON_BACKEND'] = name
+                return compiled(*payload)
+            cases.append(('serializer, %s' % name, run))
+
+        print('%-32s %8s %12s' % ('encoder', 'bytes', 'encode(ms)'))
+        for name, func in cases:
+            size = len(func())
+            seconds = timeit.timeit(func, number=NUMBER)
+            print('%-32s %8d %12.3f' % (name, size, seconds / NUMBER * 1000))
@@ -5,7 +5,7 @@ import os
 from flask.ext.script import Manager
 
 from zerqu import create_app
-from zerqu.models.base import db
+from zerqu.models.base import db, reconcile_counters as _reconcile_counters
 from zerqu.models.user import User
 
 
@@ -43,5 +43,105 @@ def adduser(username, password, role=User.ROLE_ACTIVE, **kwargs):
                   'and role {role}'.format(**userdata))
 
 
+@manager.command
+def reconcile_counters(batch_size=1000):
+    """Recount ``__cache_counters__`` with GROUP BY and fix drifted keys.
+    Usage::
+        $ python manage.py reconcile_counters [--batch_size=1000]
+    """
+    with app.app_context():
+        rv = _reconcile_counters(batch_size=int(batch_size))
+        for model, column, checked, drifted in rv:
+            print('{}.{}: checked {}, drifted {}'.format(
+                model.__tablename__, column, checked, drifted
+            ))
+
+
+@manager.command
+def cache_stats(reset=False):
+    """Print cache hit rates and latency for each model and operation.
+    Usage::
+        $ python manage.py cache_stats [--reset]
+    """
+    from zerqu.libs.cache import read_metrics, reset_metrics
+    with app.app_context():
+        rv = read_metrics()
+        for name in sorted(rv['stats']):
+            for op, data in sorted(rv['stats'][name].items()):
+                print('{:<24} {:<10} calls={:<10} hit_rate={:<8} '
+                      'avg_us={:<8} miss={}'.format(
+                          name, op, data.get('calls', '-'),
+                          data.get('hit_rate', '-'), data.get('avg_us', '-'),
+                          data.get('miss', 0)))
+        print('hot keys:')
+        for key, score in rv['hot_keys']:
+            print('  {:<8} {}'.format(score, key))
+        if reset:
+            reset_metrics()
+
+
+@manager.command
+def reconcile_topic_stats(start=None, end=None, batch_size=1000):
+    """Recount likes, reads and comments of topics into redis.
+    Usage::
+        $ python manage.py reconcile_topic_stats [--start=ID] [--end=ID]
+    """
+    from zerqu.models.topic import reconcile_topic_stats as reconcile
+    start = start and int(start)
+    end = end and int(end)
+    with app.app_context():
+        rv = reconcile(start, end, int(batch_size))
+        for done, drifted, tid in rv:
+            print('{} topics (up to #{}), {} drifted'.format(
+                done, tid, drifted
+            ))
+
+
+@manager.command
+def snapshot_stats(batch_size=1000):
+    """Save RedisStat hashes such as topic views into PostgreSQL.
+    Usage::
+        $ python manage.py snapshot_stats [--batch_size=1000]
+    """
+    from zerqu.models.base import snapshot_stats as snapshot
+    with app.app_context():
+        for stat_cls, done in snapshot(batch_size=int(batch_size)):
+            print('{}: {} saved'.format(stat_cls.__name__, done))
+
+
+@manager.command
+def decay_hot_scores():
+    """Rescale hot ranking scores to the current time and trim them.
+    Usage::
+        $ python manage.py decay_hot_scores
+    """
+    from zerqu.rec.popularity import decay_hot_scores as decay
+    with app.app_context():
+        print('{} sorted sets rescaled'.format(decay()))
+
+
+@manager.command
+def rebuild_tag_counts():
+    """Count topics of every tag again.
+    Usage::
+        $ python manage.py rebuild_tag_counts
+    """
+    from zerqu.rec.tags import rebuild_tag_counts as rebuild
+    with app.app_context():
+        print('{} tags counted'.format(rebuild()))
+
+
+@manager.command
+def build_related_topics(full=False, batch_size=1000):
+    """Compute related topics of topics changed since the last run.
+    Usage::
+        $ python manage.py build_related_topics [--full] [--batch_size=1000]
+    """
+    from zerqu.rec.related import build_related_topics as build
+    with app.app_context():
+        done = build(full=full, batch_size=int(batch_size))
+        print('{} topics computed'.format(done))
+
+
 if __name__ == '__main__':
     manager.run()
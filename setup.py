@@ -35,6 +35,7 @@ enhance_requires = [
 
     # enhance redis
     'hiredis==0.2.0',
+    'msgpack==0.5.6',
 
     # enhance requests
     'pyOpenSSL==0.15.1',
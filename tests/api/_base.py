@@ -8,6 +8,8 @@ from zerqu.models import db, User, OAuthClient, OAuthToken
 
 
 DATABASE = 'postgresql://postgres@localhost/testing'
+# 每个测试之前都会清空
+REDIS = 'redis://localhost:6379/9'
 
 
 def encode_base64(text):
@@ -23,6 +25,7 @@ class TestCase(unittest.TestCase):
             'OAUTH_CACHE_TYPE': 'simple',
             'RATE_LIMITER_TYPE': 'cache',
             'SECRET_KEY': 'secret',
+            'ZERQU_REDIS_URI': REDIS,
         })
         app.testing = True
         self._ctx = app.app_context()
@@ -32,6 +35,7 @@ class TestCase(unittest.TestCase):
 
         db.drop_all()
         db.create_all()
+        app.extensions['zerqu_redis'].flushdb()
 
         self.app = app
         self.client = app.test_client()
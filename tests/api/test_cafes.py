@@ -266,6 +266,25 @@ class TestCafeMembers(TestCase, CafeMixin):
         rv = self.client.delete(url, headers=headers)
         assert rv.status_code == 204
 
+    def test_following_cafes(self):
+        self.create_cafes(2)
+        cafe = Cafe.query.get(2)
+        # 先读取一次，之后的变化由事件更新
+        assert CafeMember.get_user_following_cafe_ids(1) == set()
+
+        url = '/api/cafes/%s/users' % cafe.slug
+        headers = self.get_authorized_header(scope='user:subscribe')
+        rv = self.client.post(url, headers=headers)
+        assert rv.status_code == 204
+        rv = self.client.get('/api/users/zerqu/cafes', headers=headers)
+        data = json.loads(rv.data)['data']
+        assert [d['id'] for d in data] == [2]
+
+        rv = self.client.delete(url, headers=headers)
+        assert rv.status_code == 204
+        rv = self.client.get('/api/cafes', headers=headers)
+        assert json.loads(rv.data)['following'] == []
+
     def test_list_public_cafe_users(self):
         total = 60
         self.create_membership(Cafe.PERMISSION_PUBLIC, total)
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+from flask import json
+from zerqu.libs.cache import redis
+from zerqu.models import db, Topic, TopicStat, Comment
+from ._base import TestCase
+
+
+class TestFlaggedTopics(TestCase):
+    def create_flagged_topics(self):
+        for i in range(3):
+            db.session.add(Topic(title=u'topic', content=u'', user_id=2))
+        db.session.commit()
+        for tid, flags in ((1, 2), (2, 2), (3, 1)):
+            for i in range(flags):
+                TopicStat(tid).flag()
+
+    def test_permission_denied(self):
+        headers = self.get_authorized_header(user_id=2)
+        rv = self.client.get('/api/flags/topics', headers=headers)
+        assert rv.status_code == 403
+
+    def test_cursor(self):
+        self.create_flagged_topics()
+        headers = self.get_authorized_header(user_id=1)
+        seen = []
+        url = '/api/flags/topics?count=1'
+        while True:
+            rv = self.client.get(url, headers=headers)
+            data = json.loads(rv.data)
+            for d in data['data']:
+                assert d['user']['id'] == 2
+                seen.append((d['id'], d['flag_count']))
+            if not data['cursor']:
+                break
+            url = '/api/flags/topics?count=1&cursor=%s' % data['cursor']
+        assert sorted(seen[:2]) == [(1, 2), (2, 2)]
+        assert seen[2:] == [(3, 1)]
+
+        rv = self.client.get(url + 'x', headers=headers)
+        assert rv.status_code == 400
+
+    def test_resolve(self):
+        self.create_flagged_topics()
+        headers = self.get_authorized_header(user_id=1)
+        rv = self.client.delete('/api/flags/topics/1', headers=headers)
+        assert rv.status_code == 204
+        assert redis.zscore(TopicStat.TOPIC_FLAGS, 1) is None
+        assert int(TopicStat(1)['flags']) == 0
+
+        rv = self.client.delete('/api/flags/topics/1', headers=headers)
+        assert rv.status_code == 404
+
+
+class TestFlaggedComments(TestCase):
+    def test_flag_and_resolve(self):
+        db.session.add(Topic(title=u'topic', content=u'', user_id=1))
+        db.session.add(Comment(content=u'spam', topic_id=1, user_id=2))
+        db.session.commit()
+        Comment.flag(1)
+
+        headers = self.get_authorized_header(user_id=1)
+        rv = self.client.get('/api/flags/comments', headers=headers)
+        data = json.loads(rv.data)['data']
+        assert data[0]['id'] == 1
+        assert data[0]['topic']['id'] == 1
+
+        rv = self.client.delete('/api/flags/comments/1', headers=headers)
+        assert rv.status_code == 204
+        assert Comment.query.get(1).flag_count == 0
+        rv = self.client.get('/api/flags/comments', headers=headers)
+        assert json.loads(rv.data)['data'] == []
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+from flask import json
+from zerqu.models import db, Topic
+from ._base import TestCase
+
+
+class TestTagTopics(TestCase):
+    def create_topics(self):
+        for tags in (['python'], ['python', 'flask'], ['go'], ['python']):
+            t = Topic(title=u'topic', content=u'', user_id=1)
+            t.tags = tags
+            db.session.add(t)
+        db.session.commit()
+
+    def test_keyset_pagination(self):
+        self.create_topics()
+        seen = []
+        url = '/api/tags/python/topics?count=2'
+        while True:
+            rv = self.client.get(url)
+            assert rv.status_code == 200
+            data = json.loads(rv.data)
+            seen.extend(d['id'] for d in data['data'])
+            if not data['cursor']:
+                break
+            url = '/api/tags/python/topics?count=2&cursor=%d' % data['cursor']
+        assert seen == [4, 2, 1]
+
+    def test_tag_counts(self):
+        self.create_topics()
+        rv = self.client.get('/api/tags')
+        data = json.loads(rv.data)['data']
+        assert data[0] == {'name': 'python', 'count': 3}
+        assert len(data) == 3
+
+        topic = Topic.query.get(2)
+        topic.tags = ['flask']
+        db.session.commit()
+        rv = self.client.get('/api/tags?count=1')
+        data = json.loads(rv.data)['data']
+        assert data == [{'name': 'python', 'count': 2}]
+        rv = self.client.get('/api/tags/python/topics')
+        data = json.loads(rv.data)['data']
+        assert [d['id'] for d in data] == [4, 1]
+
+    def test_tags_cursor_with_token(self):
+        self.create_topics()
+        # cursor 原样放在查询参数里，OAuth 校验请求时不能出错
+        headers = self.get_authorized_header(user_id=1)
+        seen = []
+        url = '/api/tags?count=1'
+        while True:
+            rv = self.client.get(url, headers=headers)
+            assert rv.status_code == 200
+            data = json.loads(rv.data)
+            seen.extend((d['name'], d['count']) for d in data['data'])
+            if not data['cursor']:
+                break
+            url = '/api/tags?count=1&cursor=%s' % data['cursor']
+        assert seen[0] == ('python', 3)
+        assert sorted(seen[1:]) == [('flask', 1), ('go', 1)]
+
+    def test_skip_drafts(self):
+        self.create_topics()
+        topic = Topic.query.get(4)
+        topic.status = Topic.STATUS_DRAFT
+        db.session.commit()
+        # 响应有缓存，每次用不同的参数
+        rv = self.client.get('/api/tags/python/topics?count=10')
+        data = json.loads(rv.data)['data']
+        assert [d['id'] for d in data] == [2, 1]
+        rv = self.client.get('/api/tags?count=1')
+        data = json.loads(rv.data)['data']
+        assert data == [{'name': 'python', 'count': 2}]
+
+        draft = Topic(title=u'draft', content=u'', user_id=1)
+        draft.tags = ['python']
+        draft.status = Topic.STATUS_DRAFT
+        db.session.add(draft)
+        db.session.commit()
+        rv = self.client.get('/api/tags/python/topics?count=11')
+        data = json.loads(rv.data)['data']
+        assert [d['id'] for d in data] == [2, 1]
+
+        topic.status = Topic.STATUS_PUBLIC
+        db.session.commit()
+        rv = self.client.get('/api/tags/python/topics?count=12')
+        data = json.loads(rv.data)['data']
+        assert [d['id'] for d in data] == [4, 2, 1]
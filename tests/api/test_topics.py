@@ -1,7 +1,7 @@
 # coding: utf-8
 
 from flask import json
-from zerqu.models import db, User, Topic, TopicLike
+from zerqu.models import db, User, Topic, TopicLike, TopicStat
 from zerqu.models import Cafe, CafeTopic, Comment
 from ._base import TestCase
 
@@ -101,6 +101,18 @@ class TestViewTopic(TestCase, TopicMixin):
         data = json.loads(rv.data)
         assert data['editable']
 
+    def test_unique_view_count(self):
+        t = self.create_topic()
+        self.app.config['ZERQU_STAT_BUFFER_INTERVAL'] = 0
+        for i in range(3):
+            self.client.get('/api/topics/%d' % t.id)
+        headers = self.get_authorized_header(user_id=1)
+        rv = self.client.get('/api/topics/%d' % t.id, headers=headers)
+        data = json.loads(rv.data)
+        assert data['view_count'] == 3
+        assert data['unique_view_count'] == 1
+        assert TopicStat(t.id).unique_views(days=7) == 2
+
 
 class TestUpdateTopic(TestCase, TopicMixin):
     def test_not_found(self):
@@ -168,11 +180,13 @@ class TestTopicLikes(TestCase, TopicMixin):
         assert rv.status_code == 204
         rv = self.client.post(url, headers=headers)
         assert rv.status_code == 409
+        assert int(TopicStat(topic.id)['likes']) == 1
 
         rv = self.client.delete(url, headers=headers)
         assert rv.status_code == 204
         rv = self.client.delete(url, headers=headers)
         assert rv.status_code == 409
+        assert int(TopicStat(topic.id)['likes']) == 0
 
     def test_view_topic_likes(self):
         topic = Topic(title=u'hello', content=u'', user_id=1)
@@ -315,3 +329,19 @@ class TestTopicComment(TestCase, TopicMixin):
         rv = self.client.post(url, headers=headers)
         assert rv.status_code == 204
         assert c.flag_count == 1
+
+    def test_like_topic_comment(self):
+        topic = self.create_public_topic()
+        self.create_topic_comments(topic.id)
+        c = Comment.query.filter_by(topic_id=topic.id).first()
+        assert Comment.cache.get(c.id).like_count == 0
+
+        url = '/api/topics/%d/comments/%d/likes' % (topic.id, c.id)
+        headers = self.get_authorized_header(user_id=2)
+        rv = self.client.post(url, headers=headers)
+        assert rv.status_code == 204
+        assert Comment.cache.get(c.id).like_count == 1
+
+        rv = self.client.delete(url, headers=headers)
+        assert rv.status_code == 204
+        assert Comment.cache.get(c.id).like_count == 0
@@ -5,6 +5,8 @@ from zerqu.app import create_app
 from zerqu.models import db
 
 DATABASE = 'postgresql://postgres@localhost/testing'
+# 每个测试之前都会清空
+REDIS = 'redis://localhost:6379/9'
 
 
 class TestCase(unittest.TestCase):
@@ -15,6 +17,7 @@ class TestCase(unittest.TestCase):
             'OAUTH_CACHE_TYPE': 'simple',
             'RATE_LIMITER_TYPE': 'cache',
             'SECRET_KEY': 'secret',
+            'ZERQU_REDIS_URI': REDIS,
         })
         app.testing = True
 
@@ -25,6 +28,7 @@ class TestCase(unittest.TestCase):
 
         db.drop_all()
         db.create_all()
+        app.extensions['zerqu_redis'].flushdb()
         self.app = app
         self.client = app.test_client()
 
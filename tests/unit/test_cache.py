@@ -0,0 +1,223 @@
+# coding: utf-8
+
+import time
+from zerqu.models import db, User
+from zerqu.libs.cache import cached, redis, flush_metrics, local_caches
+from zerqu.models.base import CacheStat
+from ._base import TestCase
+
+
+class TestNegativeCache(TestCase):
+    def get_stat(self, field):
+        flush_metrics()
+        return int(CacheStat(User.__tablename__).get(field, 0))
+
+    def test_get_tombstone(self):
+        misses = self.get_stat('get:miss')
+        assert User.cache.get(1) is None
+        assert self.get_stat('get:miss') == misses + 1
+
+        nils = self.get_stat('get:nil')
+        assert User.cache.get(1) is None
+        assert self.get_stat('get:nil') == nils + 1
+        assert self.get_stat('get:miss') == misses + 1
+
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.commit()
+        assert User.cache.get(user.id).username == 'zerqu'
+
+    def test_filter_first_tombstone(self):
+        assert User.cache.filter_first(username='zerqu') is None
+        assert User.cache.filter_first(username='zerqu') is None
+
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.commit()
+        assert User.cache.filter_first(username='zerqu').id == user.id
+
+
+class TestLookupIndex(TestCase):
+    def test_rename_user(self):
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.commit()
+        assert User.cache.filter_first(username='zerqu').id == user.id
+        assert User.cache.filter_first(username='lepture') is None
+
+        user = User.query.get(user.id)
+        user.username = 'lepture'
+        db.session.add(user)
+        db.session.commit()
+
+        assert User.cache.filter_first(username='zerqu') is None
+        assert User.cache.filter_first(username='lepture').id == user.id
+        assert User.cache.get(user.id).username == 'lepture'
+
+
+class TestLocalCache(TestCase):
+    def test_fresh_instances(self):
+        self.app.config['ZERQU_LOCAL_CACHE'] = True
+        self.addCleanup(local_caches.clear)
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.commit()
+
+        # 第一次从数据库读取，之后都从进程内缓存读取
+        User.cache.get(user.id)
+        a = User.cache.get(user.id)
+        a.username = 'changed'
+        b = User.cache.get(user.id)
+        assert a is not b
+        assert b.username == 'zerqu'
+
+
+class TestStaleWhileRevalidate(TestCase):
+    def test_cached(self):
+        calls = []
+
+        @cached('test:swr:%s', expire=1)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        redis.delete('lock:test:swr:2')
+        assert double(2) == 4
+        assert double(2) == 4
+        assert calls == [2]
+
+        time.sleep(1.1)
+        # another worker is refreshing, serve the stale value
+        redis.set('lock:test:swr:2', 1, ex=10)
+        assert double(2) == 4
+        assert calls == [2]
+
+        redis.delete('lock:test:swr:2')
+        assert double(2) == 4
+        assert calls == [2, 2]
+
+
+class TestCounter(TestCase):
+    def test_filter_count(self):
+        from zerqu.models import TopicLike
+        assert TopicLike.cache.filter_count(topic_id=1) == 0
+
+        db.session.add(TopicLike(1, 1))
+        db.session.add(TopicLike(1, 2))
+        db.session.commit()
+        assert TopicLike.cache.filter_count(topic_id=1) == 2
+
+        like = TopicLike.query.get((1, 2))
+        like.topic_id = 2
+        db.session.commit()
+        assert TopicLike.cache.filter_count(topic_id=1) == 1
+        # 不存在的计数器不会被事件初始化
+        assert TopicLike.cache.filter_count(topic_id=2) == 1
+
+        db.session.delete(like)
+        db.session.commit()
+        assert TopicLike.cache.filter_count(topic_id=2) == 0
+
+
+class TestLoader(TestCase):
+    def test_identity_map(self):
+        from zerqu.models import TopicLike
+        from zerqu.models.loader import current_loader
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.add(TopicLike(1, 1))
+        db.session.commit()
+
+        with self.app.test_request_context():
+            loader = current_loader()
+            loader.want(User, [user.id, 2])
+            loader.want(TopicLike, [(1, 1), (2, 1)])
+            assert len(loader.pending) == 4
+
+            likes = TopicLike.cache.get_dict([(1, 1), (2, 1)])
+            assert not loader.pending
+            assert likes['1-1'].user_id == 1
+            assert likes['2-1'] is None
+            assert User.cache.get(user.id) is loader.get(User, user.id)
+            assert User.cache.get(2) is None
+
+
+class TestCacheWrites(TestCase):
+    def test_rollback(self):
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.commit()
+        assert User.cache.get(user.id).username == 'zerqu'
+
+        user.username = 'changed'
+        db.session.add(user)
+        db.session.flush()
+        db.session.rollback()
+        assert User.cache.get(user.id).username == 'zerqu'
+        assert User.cache.filter_first(username='changed') is None
+
+    def test_commit(self):
+        user = User(username='zerqu', email='zerqu@gmail.com')
+        db.session.add(user)
+        db.session.commit()
+        assert User.cache.get(user.id).username == 'zerqu'
+
+        user.username = 'changed'
+        db.session.add(user)
+        db.session.flush()
+        assert User.cache.get(user.id).username == 'zerqu'
+        db.session.commit()
+        assert User.cache.get(user.id).username == 'changed'
+
+
+class TestStatBuffer(TestCase):
+    def test_buffered_increase(self):
+        from zerqu.models import TopicStat
+        from zerqu.models.base import use_stat_buffer
+        self.app.config['ZERQU_STAT_BUFFER_INTERVAL'] = 60000
+        stat = TopicStat(1)
+        stat.increase('views', buffered=True)
+        stat.increase('views', buffered=True)
+        assert not redis.hget(stat._key, 'views')
+
+        use_stat_buffer().flush()
+        assert int(redis.hget(stat._key, 'views')) == 2
+
+    def test_reconcile_topic_stats(self):
+        from zerqu.models import Topic, TopicLike, TopicStat, Comment
+        from zerqu.models.topic import reconcile_topic_stats
+        for i in range(3):
+            db.session.add(Topic(title=u'topic', content=u'', user_id=1))
+        db.session.commit()
+        db.session.add(TopicLike(1, 1))
+        db.session.add(TopicLike(1, 2))
+        db.session.add(Comment(content=u'hi', topic_id=3, user_id=1))
+        db.session.commit()
+        redis.hset(TopicStat.KEY_PREFIX.format(2), 'likes', 5)
+
+        rv = list(reconcile_topic_stats(batch_size=2))
+        assert [done for done, _, _ in rv] == [2, 3]
+        assert int(TopicStat(1)['likes']) == 2
+        assert int(TopicStat(2)['likes']) == 0
+        assert int(TopicStat(3)['comments']) == 1
+        assert list(reconcile_topic_stats())[-1][1] == 0
+
+
+class TestStatSnapshot(TestCase):
+    def test_restore_from_snapshot(self):
+        from zerqu.models import TopicStat
+        from zerqu.models.base import snapshot_stats
+        stat = TopicStat(1)
+        stat.increase('views', 3)
+        stat.flag()
+        rv = list(snapshot_stats([TopicStat]))
+        assert rv == [(TopicStat, 1)]
+
+        # redis 数据丢失之后的新计数会和快照累加
+        redis.delete(stat._key, TopicStat.TOPIC_FLAGS)
+        TopicStat(1).increase('views')
+        assert int(TopicStat(1)['views']) == 4
+        assert int(TopicStat(1)['flags']) == 1
+        assert redis.zscore(TopicStat.TOPIC_FLAGS, 1) == 1
+        # 只恢复一次
+        assert int(TopicStat(1)['views']) == 4
@@ -0,0 +1,54 @@
+# coding: utf-8
+
+import datetime
+import unittest
+from zerqu.app import create_app
+from zerqu.models import User
+from zerqu.models.codec import dump_row, load_row, get_schema
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        app = create_app()
+        self._ctx = app.app_context()
+        self._ctx.push()
+        self.app = app
+
+    def tearDown(self):
+        self._ctx.pop()
+
+    def create_user(self):
+        user = User(username='zerqu', email='zerqu@gmail.com', role=1)
+        user.id = 1
+        user.created_at = datetime.datetime(2015, 10, 1, 8, 30, 12, 345)
+        return user
+
+    def assert_round_trip(self):
+        user = self.create_user()
+        rv = load_row(User, dump_row(user))
+        assert rv.id == 1
+        assert rv.username == 'zerqu'
+        assert rv.created_at == user.created_at
+        assert rv.is_active
+
+    def test_msgpack(self):
+        self.app.config['ZERQU_MODEL_CODEC'] = 'msgpack'
+        self.assert_round_trip()
+
+    def test_pickle(self):
+        self.app.config['ZERQU_MODEL_CODEC'] = 'pickle'
+        self.assert_round_trip()
+
+    def test_fingerprint_mismatch(self):
+        data = dump_row(self.create_user())
+        schema = get_schema(User)
+        fingerprint = schema.fingerprint
+        schema.fingerprint = fingerprint + 1
+        try:
+            assert load_row(User, data) is None
+        finally:
+            schema.fingerprint = fingerprint
+
+    def test_invalid_data(self):
+        assert load_row(User, None) is None
+        assert load_row(User, b'invalid') is None
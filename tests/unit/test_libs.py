@@ -2,8 +2,9 @@
 import unittest
 
 from zerqu.libs import renderer
+from zerqu.libs.cache import LocalCache, redis
 from zerqu.libs.ratelimit import ratelimit
-from zerqu.libs.utils import is_robot, is_mobile
+from zerqu.libs.utils import is_robot, is_mobile, PeriodicBuffer
 from zerqu.libs.webparser import parse_meta
 from zerqu.libs.errors import LimitExceeded
 from ._base import TestCase
@@ -75,6 +76,73 @@ class TestRenderer(TestCase):
         assert '<p>' in renderer.render_text(s)
         assert '<br>' in renderer.render_text(s)
 
+    def test_markup_cache(self):
+        s = u'hello **world**'
+        key = renderer.html_cache_key(s)
+        assert renderer.markup(s) == renderer.render(s)
+        assert redis.get(key) is not None
+
+        # 缓存命中时不再渲染
+        redis.set(key, u'<p>cached</p>')
+        rv = renderer.markup_many([s, u'other', s])
+        assert rv[0] == rv[2] == u'<p>cached</p>'
+        assert 'other' in rv[1]
+
+        # 版本变化之后是新的 key
+        self.app.config['ZERQU_RENDERER_VERSION'] = 2
+        assert renderer.html_cache_key(s) != key
+        assert '<strong>' in renderer.markup(s)
+
+    def test_cache_markup(self):
+        old = u'old content'
+        renderer.cache_markup(old)
+        key = renderer.html_cache_key(old)
+        assert redis.get(key) is not None
+
+        renderer.cache_markup(u'new content', old)
+        assert redis.get(key) is None
+        assert redis.get(renderer.html_cache_key(u'new content'))
+
+
+class TestLocalCache(unittest.TestCase):
+    def test_lru(self):
+        local = LocalCache(size=2, timeout=60)
+        local.set('a', 1)
+        local.set('b', 2)
+        assert local.get('a') == 1
+        local.set('c', 3)
+        assert local.get('b') is None
+        assert local.get('a') == 1
+        assert local.get('c') == 3
+        assert len(local) == 2
+
+    def test_expires(self):
+        local = LocalCache(size=2, timeout=60)
+        local.set('a', 1, timeout=-1)
+        assert local.get('a') is None
+        local.set('b', 2)
+        local.delete('b')
+        assert local.get('b') is None
+
+
+class TestPeriodicBuffer(unittest.TestCase):
+    def test_flush(self):
+        flushed = []
+        buf = PeriodicBuffer(flushed.append, interval=60, size=3)
+        buf.add('a')
+        buf.add('a', 2)
+        assert flushed == []
+        buf.add('b')
+        assert flushed == [{'a': 3, 'b': 1}]
+        buf.flush()
+        assert len(flushed) == 1
+
+    def test_interval(self):
+        flushed = []
+        buf = PeriodicBuffer(flushed.append, interval=0)
+        buf.add('a')
+        assert flushed == [{'a': 1}]
+
 
 class TestParser(unittest.TestCase):
     def test_parse_meta(self):
@@ -0,0 +1,63 @@
+# coding: utf-8
+
+from zerqu.libs.cache import redis
+from zerqu.models import db, Topic, Cafe, CafeTopic, TopicLike
+from zerqu.rec.popularity import get_hot_topics, decay_hot_scores
+from zerqu.rec.popularity import HOT_KEY, HOT_CAFE_KEY, HOT_EPOCHS
+from ._base import TestCase
+
+
+class TestHotTopics(TestCase):
+    def setUp(self):
+        super(TestHotTopics, self).setUp()
+        self.app.config['ZERQU_STAT_BUFFER_INTERVAL'] = 0
+        keys = redis.hkeys(HOT_EPOCHS)
+        redis.delete(HOT_EPOCHS, HOT_KEY, *keys)
+
+    def create_topics(self):
+        cafe = Cafe(name=u'cafe', slug='cafe', user_id=1)
+        db.session.add(cafe)
+        db.session.flush()
+        for i in range(3):
+            t = Topic(title=u'hi', content=u'', user_id=1)
+            db.session.add(t)
+            db.session.flush()
+            ct = CafeTopic(cafe.id, t.id, 1, CafeTopic.STATUS_PUBLIC)
+            db.session.add(ct)
+        db.session.commit()
+        return cafe
+
+    def test_hot_topics(self):
+        cafe = self.create_topics()
+        db.session.add(TopicLike(2, 1))
+        db.session.commit()
+
+        topics, cursor = get_hot_topics(count=1)
+        assert [t.id for t in topics] == [2]
+        topics, cursor = get_hot_topics(cursor, count=5)
+        assert sorted(t.id for t in topics) == [1, 3]
+        assert cursor == 0
+
+        topics, _ = get_hot_topics(cafe_id=cafe.id)
+        assert topics[0].id == 2
+
+        score = redis.zscore(HOT_KEY, 2)
+        assert decay_hot_scores() == 2
+        assert redis.zscore(HOT_KEY, 2) <= score
+        assert get_hot_topics()[0][0].id == 2
+        assert redis.zcard(HOT_CAFE_KEY.format(cafe.id)) == 3
+
+    def test_withdraw_topic(self):
+        cafe = self.create_topics()
+        ct = CafeTopic.query.get((cafe.id, 2))
+        ct.status = CafeTopic.STATUS_DRAFT
+        db.session.add(ct)
+        db.session.commit()
+        assert redis.zscore(HOT_KEY, 2) is None
+        assert redis.zscore(HOT_CAFE_KEY.format(cafe.id), 2) is None
+
+        # 撤回之后的喜欢不再增加热度
+        db.session.add(TopicLike(2, 1))
+        db.session.commit()
+        assert redis.zscore(HOT_KEY, 2) is None
+        assert redis.zscore(HOT_KEY, 1) is not None
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+from zerqu.libs.cache import redis
+from zerqu.models import db, Topic, TopicLike
+from zerqu.rec.related import build_related_topics, get_related_topics
+from zerqu.rec.related import FeatureIndex, RELATED_KEY, RELATED_CHANGED
+from ._base import TestCase
+
+
+class TestRelatedTopics(TestCase):
+    def test_feature_index(self):
+        pairs = [
+            (1, ('tag', 'python')), (1, ('tag', 'flask')),
+            (2, ('tag', 'python')), (2, ('tag', 'flask')),
+            (3, ('tag', 'python')), (3, ('like', 1)),
+            (4, ('tag', 'go')), (4, ('like', 1)),
+        ]
+        index = FeatureIndex(pairs)
+        rv = dict(index.related([1, 4], size=5))
+        assert [tid for tid, _ in rv[1]] == [2, 3]
+        assert [tid for tid, _ in rv[4]] == [3]
+
+    def test_incremental_build(self):
+        for tags in (['python', 'flask'], ['python', 'flask'], ['python']):
+            t = Topic(title=u'topic', content=u'', user_id=1)
+            t.tags = tags
+            db.session.add(t)
+        db.session.add(Topic(title=u'topic', content=u'', user_id=1))
+        db.session.commit()
+
+        assert build_related_topics() == 3
+        topics = get_related_topics(1)
+        assert [t.id for t in topics] == [2, 3]
+        assert redis.zcard(RELATED_KEY.format(4)) == 0
+
+        db.session.add(TopicLike(3, 2))
+        db.session.add(TopicLike(4, 2))
+        db.session.commit()
+        assert build_related_topics() == 2
+        assert [t.id for t in get_related_topics(4)] == [3]
+
+    def test_removed_features(self):
+        for i in range(3):
+            t = Topic(title=u'topic', content=u'', user_id=1)
+            t.tags = ['python'] if i else ['go']
+            db.session.add(t)
+        db.session.add(TopicLike(1, 2))
+        db.session.add(TopicLike(2, 2))
+        db.session.commit()
+        assert build_related_topics() == 3
+        assert [t.id for t in get_related_topics(1)] == [2]
+
+        db.session.delete(TopicLike.query.get((1, 2)))
+        db.session.delete(Topic.query.get(3))
+        db.session.commit()
+        assert redis.zcard(RELATED_KEY.format(3)) == 0
+        assert redis.scard(RELATED_CHANGED) == 2
+
+        assert build_related_topics() == 1
+        assert get_related_topics(1) == []
+        assert redis.scard(RELATED_CHANGED) == 0
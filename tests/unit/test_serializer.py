@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import datetime
+import unittest
+from flask import json
+from zerqu.app import create_app
+from zerqu.models import User, Cafe
+from zerqu.models.serializer import dump_model, dumps, jsonify
+
+
+class TestSerializer(unittest.TestCase):
+    def setUp(self):
+        app = create_app()
+        self._ctx = app.test_request_context()
+        self._ctx.push()
+        self.app = app
+
+    def tearDown(self):
+        self._ctx.pop()
+
+    def create_user(self):
+        user = User(username='zerqu', email='zerqu@gmail.com', role=1)
+        user.id = 1
+        user.created_at = datetime.datetime(2015, 10, 1, 8, 30, 12, 345)
+        return user
+
+    def test_same_as_dict(self):
+        user = self.create_user()
+        expected = dict(user)
+        expected['created_at'] = '2015-10-01T08:30:12Z'
+        assert dump_model(user) == expected
+
+    def test_nested_models(self):
+        cafe = Cafe(name=u'cafe', slug='cafe', user_id=1)
+        cafe.id = 1
+        data = {'data': [{'user': self.create_user(), 'cafes': [cafe]}]}
+        for backend in ('json', 'simplejson'):
+            self.app.config['ZERQU_JSON_BACKEND'] = backend
+            rv = json.loads(dumps(data))['data'][0]
+            assert rv['user']['created_at'] == '2015-10-01T08:30:12Z'
+            assert rv['cafes'][0]['slug'] == 'cafe'
+
+        rv = jsonify(self.create_user())
+        assert rv.mimetype == 'application/json'
+        assert json.loads(rv.data)['username'] == 'zerqu'
@@ -0,0 +1,163 @@
+# coding: utf-8
+
+from zerqu.libs.cache import redis
+from zerqu.models import db, Topic, Cafe, CafeMember, CafeTopic
+from zerqu.rec.timeline import get_timeline_topics, get_cafe_topics
+from zerqu.rec.timeline import get_promoted_cafe_ids, get_random_cafe_ids
+from zerqu.rec.timeline import get_pull_cafe_ids
+from zerqu.rec.timeline import TIMELINE_KEY, CAFE_TOPICS_KEY
+from ._base import TestCase
+
+
+def add_topic(cafe_id, status=CafeTopic.STATUS_PUBLIC):
+    t = Topic(title=u'hi', content=u'', user_id=1)
+    db.session.add(t)
+    db.session.flush()
+    db.session.add(CafeTopic(cafe_id, t.id, 1, status))
+    db.session.commit()
+    return t.id
+
+
+class TestCafeTopics(TestCase):
+    def test_merge(self):
+        self.app.config['ZERQU_CAFE_TOPICS_SIZE'] = 3
+        for name in ('a', 'b'):
+            db.session.add(Cafe(name=name, slug=name, user_id=1))
+        db.session.commit()
+
+        a = [add_topic(1) for i in range(3)]
+        b = [add_topic(2) for i in range(2)]
+        add_topic(2, CafeTopic.STATUS_DRAFT)
+        a.extend(add_topic(1) for i in range(3))
+        # 同一个主题在两个 cafe 里
+        db.session.add(CafeTopic(2, a[0], 1, CafeTopic.STATUS_PUBLIC))
+        db.session.commit()
+        expected = sorted(set(a + b), reverse=True)
+
+        seen = []
+        cursor = None
+        while cursor != 0:
+            topics, cursor = get_cafe_topics([1, 2], cursor, count=3)
+            seen.extend(t.id for t in topics)
+        assert seen == expected
+        # 只保存了最新的 3 个，后面的从数据库读取
+        assert redis.zcard(CAFE_TOPICS_KEY.format(1)) == 4
+
+        tid = add_topic(2)
+        assert redis.zscore(CAFE_TOPICS_KEY.format(2), tid) == tid
+        topics, cursor = get_cafe_topics([1, 2], count=2)
+        assert [t.id for t in topics] == [tid, a[-1]]
+        assert cursor == a[-1]
+
+
+class TestCafeSets(TestCase):
+    def test_cafe_events(self):
+        db.session.add(Cafe(name=u'a', slug='a', user_id=1))
+        db.session.add(Cafe(
+            name=u'b', slug='b', user_id=1,
+            permission=Cafe.PERMISSION_MEMBER,
+            status=Cafe.STATUS_VERIFIED,
+        ))
+        db.session.commit()
+        # 第一次读取时重建
+        assert get_promoted_cafe_ids() == {2}
+        assert get_random_cafe_ids() == {1}
+
+        db.session.add(Cafe(
+            name=u'c', slug='c', user_id=1, status=Cafe.STATUS_OFFICIAL,
+        ))
+        cafe = Cafe.query.get(1)
+        cafe.status = Cafe.STATUS_VERIFIED
+        db.session.delete(Cafe.query.get(2))
+        db.session.commit()
+        assert get_promoted_cafe_ids() == {1, 3}
+        assert get_random_cafe_ids() == {1, 3}
+        assert get_pull_cafe_ids() == {3}
+
+
+class TestMaterializedTimeline(TestCase):
+
+    def test_fanout(self):
+        self.app.config['ZERQU_TIMELINE_FANOUT'] = True
+        self.app.config['ZERQU_TIMELINE_SIZE'] = 5
+        key = TIMELINE_KEY.format(2)
+        redis.delete(key)
+
+        cafe = Cafe(name=u'cafe', slug='cafe', user_id=1)
+        official = Cafe(
+            name=u'official', slug='official', user_id=1,
+            status=Cafe.STATUS_OFFICIAL,
+        )
+        db.session.add(cafe)
+        db.session.add(official)
+        db.session.flush()
+        db.session.add(CafeMember(cafe.id, 2, CafeMember.ROLE_SUBSCRIBER))
+        db.session.commit()
+
+        first = add_topic(cafe.id)
+        # 第一次读取时重建
+        topics, cursor = get_timeline_topics(user_id=2, count=3)
+        assert [t.id for t in topics] == [first]
+        assert redis.zscore(key, first) == first
+
+        ids = [add_topic(cafe.id) for i in range(3)]
+        pulled = add_topic(official.id)
+        # 官方 cafe 不推送，读取时查询
+        assert redis.zscore(key, ids[-1]) == ids[-1]
+        assert redis.zscore(key, pulled) is None
+
+        topics, cursor = get_timeline_topics(user_id=2, count=3)
+        assert [t.id for t in topics] == [pulled, ids[2], ids[1]]
+        topics, cursor = get_timeline_topics(cursor, 2, count=3)
+        assert [t.id for t in topics] == [ids[0], first]
+        assert cursor == 0
+
+    def test_remove_from_one_cafe(self):
+        self.app.config['ZERQU_TIMELINE_FANOUT'] = True
+        key = TIMELINE_KEY.format(2)
+        a = Cafe(name=u'a', slug='a', user_id=1)
+        b = Cafe(name=u'b', slug='b', user_id=1)
+        db.session.add(a)
+        db.session.add(b)
+        db.session.flush()
+        db.session.add(CafeMember(a.id, 2, CafeMember.ROLE_SUBSCRIBER))
+        db.session.add(CafeMember(b.id, 2, CafeMember.ROLE_SUBSCRIBER))
+        db.session.commit()
+
+        tid = add_topic(a.id)
+        db.session.add(CafeTopic(b.id, tid, 1, CafeTopic.STATUS_PUBLIC))
+        db.session.commit()
+        get_timeline_topics(user_id=2)
+        CafeMember.get_user_following_cafe_ids(2)
+        assert redis.zscore(key, tid) == tid
+
+        # 还在关注的 cafe b 里公开
+        item = CafeTopic.query.get((a.id, tid))
+        item.status = CafeTopic.STATUS_DRAFT
+        db.session.add(item)
+        db.session.commit()
+        assert redis.zscore(key, tid) == tid
+
+        db.session.delete(CafeTopic.query.get((b.id, tid)))
+        db.session.commit()
+        assert redis.zscore(key, tid) is None
+
+    def test_rollback(self):
+        self.app.config['ZERQU_TIMELINE_FANOUT'] = True
+        key = TIMELINE_KEY.format(2)
+        cafe = Cafe(name=u'cafe', slug='cafe', user_id=1)
+        db.session.add(cafe)
+        db.session.flush()
+        db.session.add(CafeMember(cafe.id, 2, CafeMember.ROLE_SUBSCRIBER))
+        db.session.commit()
+        get_timeline_topics(user_id=2)
+
+        t = Topic(title=u'hi', content=u'', user_id=1)
+        db.session.add(t)
+        db.session.flush()
+        db.session.add(CafeTopic(cafe.id, t.id, 1, CafeTopic.STATUS_PUBLIC))
+        db.session.flush()
+        tid = t.id
+        db.session.rollback()
+        assert redis.zscore(key, tid) is None
+        assert redis.zscore(CAFE_TOPICS_KEY.format(cafe.id), tid) is None
@@ -3,7 +3,7 @@
 
 import re
 from flask import Blueprint, request
-from . import front, users, topics, cafes
+from . import front, users, topics, cafes, flags, tags
 
 VERSION_URL = re.compile(r'^/api/\d/')
 VERSION_ACCEPT = re.compile(r'application/vnd\.zerqu\+json;\s+version=(\d)')
@@ -71,6 +71,8 @@ def init_app(app):
     users.api.register(bp)
     cafes.api.register(bp)
     topics.api.register(bp)
+    flags.api.register(bp)
+    tags.api.register(bp)
 
     # 给 flask app 注册 Blueprint
     app.register_blueprint(bp, url_prefix='/api/1')
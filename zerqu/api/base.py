@@ -8,7 +8,7 @@ from flask_oauthlib.utils import decode_base64
 
 from zerqu.libs.errors import NotAuth, NotConfidential, InvalidClient
 from zerqu.libs.ratelimit import ratelimit
-from zerqu.libs.cache import cache
+from zerqu.libs.cache import fetch
 from zerqu.models import oauth, current_user
 from zerqu.models import UserSession, OAuthClient
 
@@ -128,14 +128,11 @@ def cache_response(cache_time):
                 return f(*args, **kwargs)
 
             key = 'api:%s' % request.full_path
-            response = cache.get(key)  # 从缓存中获取
-            if response:
-                # 缓存命中
-                return response
-            # 缓存没命中则进入这里
-            response = f(*args, **kwargs)
-            cache.set(key, response, cache_time)  # 设置缓存
-            return response
+            # 缓存过期后只有一个请求重新生成，其他请求继续使用旧的响应
+            metric = ('response', request.endpoint)
+            return fetch(
+                key, lambda: f(*args, **kwargs), cache_time, metric=metric,
+            )
         return decorated
     return wrapper
 
@@ -10,11 +10,11 @@ from zerqu.libs.errors import NotFound, Denied, InvalidAccount, Conflict
 from zerqu.models import db, current_user
 from zerqu.models import User, Cafe, CafeMember, CafeTopic, Topic
 from zerqu.models import iter_items_with_users
-from zerqu.models.topic import iter_topics_with_statuses
+from zerqu.models.topic import iter_topics_with_statuses, prefetch_topics
 from zerqu.forms import CafeForm, TopicForm
 from .base import ApiBlueprint
 from .base import require_oauth
-from .utils import cursor_query, pagination_query
+from .utils import cursor_query, pagination_query, hot_cursor_query
 
 api = ApiBlueprint('cafes')
 
@@ -83,6 +83,8 @@ def update_cafe(slug):
         if not data or data.role != CafeMember.ROLE_ADMIN:
             raise Denied('cafe "%s"' % cafe.slug)
 
+    # cached instance is shared between requests, load a fresh one to write
+    cafe = Cafe.query.get(cafe.id)
     form = CafeForm.create_api_form(obj=cafe)
     cafe = form.update_cafe(cafe, current_user.id)
     return jsonify(cafe)
@@ -159,11 +161,22 @@ def list_cafe_users(slug):
 @api.route('/<slug>/topics')
 @require_oauth(login=False, cache_time=600)
 def list_cafe_topics(slug):
+    """GET /cafes/<slug>/topics
+
+    ``?sort=hot`` 按热度排序，用 cursor 翻页
+    """
     cafe = Cafe.cache.first_or_404(slug=slug)
-    cts, p = pagination_query(CafeTopic, 'updated_at', cafe_id=cafe.id)
-    data = Topic.cache.get_many([c.topic_id for c in cts])
+    hot = request.args.get('sort') == 'hot'
+    if hot:
+        data, cursor = hot_cursor_query(cafe.id)
+    else:
+        cts, p = pagination_query(CafeTopic, 'updated_at', cafe_id=cafe.id)
+        data = Topic.cache.get_many([c.topic_id for c in cts])
+    prefetch_topics(data, current_user.id)
     data = list(iter_items_with_users(data))
     data = list(iter_topics_with_statuses(data, current_user.id))
+    if hot:
+        return jsonify(data=data, cursor=cursor)
     return jsonify(data=data, pagination=dict(p))
 
 
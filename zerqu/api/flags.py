@@ -0,0 +1,75 @@
+# coding: utf-8
+
+from flask import jsonify
+from zerqu.models import current_user, User
+from zerqu.models import Topic, TopicStat, Comment
+from zerqu.models import iter_items_with_users
+from zerqu.libs.renderer import markup_many
+from zerqu.libs.errors import NotFound, Denied
+from .base import ApiBlueprint, require_oauth
+from .utils import zset_cursor_query
+
+api = ApiBlueprint('flags')
+
+
+def check_staff(action):
+    if current_user.role < User.ROLE_STAFF:
+        raise Denied(action)
+
+
+@api.route('/topics')
+@require_oauth(login=True)
+def view_flagged_topics():
+    """GET /flags/topics
+
+    被举报次数最多的主题，只有员工可以查看
+    """
+    check_staff('viewing flagged topics')
+    rv, cursor = zset_cursor_query(TopicStat.TOPIC_FLAGS)
+    scores = dict(rv)
+    topics = Topic.cache.get_many([tid for tid, _ in rv])
+    data = []
+    for d in iter_items_with_users(topics):
+        d['flag_count'] = scores[d['id']]
+        data.append(d)
+    return jsonify(data=data, cursor=cursor)
+
+
+@api.route('/topics/<int:tid>', methods=['DELETE'])
+@require_oauth(login=True)
+def resolve_topic_flags(tid):
+    check_staff('resolving flags')
+    if not TopicStat(tid).resolve_flags():
+        raise NotFound('Flag')
+    return '', 204
+
+
+@api.route('/comments')
+@require_oauth(login=True)
+def view_flagged_comments():
+    """GET /flags/comments
+
+    被举报次数最多的评论，只有员工可以查看
+    """
+    check_staff('viewing flagged comments')
+    rv, cursor = zset_cursor_query(Comment.FLAGS_KEY)
+    comments = Comment.cache.get_many([cid for cid, _ in rv])
+    topics = Topic.cache.get_dict([c.topic_id for c in comments])
+    data = []
+    htmls = markup_many([c.content for c in comments])
+    for d, html in zip(iter_items_with_users(comments), htmls):
+        d['content'] = html
+        topic = topics.get(str(d['topic_id']))
+        if topic:
+            d['topic'] = dict(topic)
+        data.append(d)
+    return jsonify(data=data, cursor=cursor)
+
+
+@api.route('/comments/<int:cid>', methods=['DELETE'])
+@require_oauth(login=True)
+def resolve_comment_flags(cid):
+    check_staff('resolving flags')
+    if not Comment.resolve_flags(cid):
+        raise NotFound('Flag')
+    return '', 204
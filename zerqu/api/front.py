@@ -2,10 +2,11 @@
 
 from flask import jsonify
 from flask import current_app, request
-from zerqu.models import current_user
-from zerqu.libs.renderer import markup
+from zerqu.models import current_user, User
+from zerqu.libs.renderer import render
 from zerqu.libs.uploader import uploader
-from zerqu.libs.errors import APIException
+from zerqu.libs.cache import flush_metrics, read_metrics
+from zerqu.libs.errors import APIException, Denied
 from zerqu.versions import VERSION, API_VERSION
 from .base import ApiBlueprint, require_oauth
 
@@ -33,7 +34,7 @@ def preview_text():
     text = data.get('text')
     if not text:
         return ''
-    return markup(text)
+    return render(text)
 
 
 @api.route('upload', methods=['GET'])
@@ -47,3 +48,16 @@ def upload_form_data():
     if data is None:
         raise APIException(description='Invalid content type')
     return jsonify(data)
+
+
+@api.route('cache')
+@require_oauth(login=True)
+def view_cache_stats():
+    """GET /cache
+
+    缓存统计，只有员工可以查看
+    """
+    if current_user.role < User.ROLE_STAFF:
+        raise Denied('viewing cache stats')
+    flush_metrics()
+    return jsonify(read_metrics())
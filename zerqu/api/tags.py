@@ -0,0 +1,46 @@
+# coding: utf-8
+
+from flask import request, jsonify
+from zerqu.models import current_user, CafeTopic
+from zerqu.models import iter_items_with_users
+from zerqu.models.topic import iter_topics_with_statuses, prefetch_topics
+from zerqu.rec.tags import get_tag_topics, get_popular_tags
+from zerqu.libs.errors import APIException
+from .base import ApiBlueprint, require_oauth
+from .utils import int_or_raise
+
+api = ApiBlueprint('tags')
+
+
+@api.route('')
+@require_oauth(login=False, cache_time=600)
+def list_tags():
+    """GET /tags
+
+    主题最多的标签，cursor 的格式见 ``zset_page``
+    """
+    count = int_or_raise('count', 20, 100)
+    try:
+        rv, cursor = get_popular_tags(request.args.get('cursor'), count)
+    except ValueError:
+        raise APIException(description='Invalid cursor')
+    data = [{'name': name, 'count': n} for name, n in rv]
+    return jsonify(data=data, cursor=cursor)
+
+
+@api.route('/<tag>/topics')
+@require_oauth(login=False, cache_time=300)
+def list_tag_topics(tag):
+    """GET /tags/<tag>/topics"""
+    cursor = int_or_raise('cursor', 0)
+    count = int_or_raise('count', 20, 100)
+    topics, cursor = get_tag_topics(tag, cursor, count)
+
+    prefetch_topics(topics, current_user.id)
+    topics_cafes = CafeTopic.get_topics_cafes([t.id for t in topics])
+    data = []
+    for d in iter_items_with_users(topics):
+        d['cafes'] = topics_cafes.get(d['id'])
+        data.append(d)
+    data = list(iter_topics_with_statuses(data, current_user.id))
+    return jsonify(data=data, cursor=cursor)
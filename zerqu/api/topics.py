@@ -1,21 +1,27 @@
 # coding: utf-8
 
-from flask import request, jsonify
+from flask import request
 
 from zerqu.models import db, current_user, User
 from zerqu.models import CafeTopic, WebPage
 from zerqu.models import Topic, TopicLike, TopicRead, TopicStat
 from zerqu.models import Comment, CommentLike
 from zerqu.models import iter_items_with_users
-from zerqu.models.topic import iter_topics_with_statuses
+from zerqu.models.loader import current_loader
+from zerqu.models.topic import iter_topics_with_statuses, prefetch_topics
+from zerqu.models.serializer import jsonify
 from zerqu.rec.timeline import get_timeline_topics, get_all_topics
+from zerqu.rec.popularity import record_hot
+from zerqu.rec.related import get_related_topics
 from zerqu.forms import TopicForm, CommentForm
-from zerqu.libs.renderer import markup
+from zerqu.libs.renderer import markup, markup_many
 from zerqu.libs.cache import cache
+from zerqu.libs.utils import is_robot, get_visitor_id
 from zerqu.libs.errors import APIException, Conflict, NotFound, Denied
 from .base import ApiBlueprint
 from .base import require_oauth
 from .utils import cursor_query, pagination_query, int_or_raise
+from .utils import hot_cursor_query
 
 api = ApiBlueprint('topics')
 
@@ -27,13 +33,18 @@ def timeline():
     """时间线
     GET /topics
     GET /topics/timeline
+    GET /topics?sort=hot
     """
-    cursor = int_or_raise('cursor', 0)
-    if request.args.get('show') == 'all':
-        topics, cursor = get_all_topics(cursor)
+    if request.args.get('sort') == 'hot':
+        topics, cursor = hot_cursor_query()
+    elif request.args.get('show') == 'all':
+        topics, cursor = get_all_topics(int_or_raise('cursor', 0))
     else:
+        cursor = int_or_raise('cursor', 0)
         topics, cursor = get_timeline_topics(cursor, current_user.id)
 
+    # 用户、统计和当前用户状态和 cafe 一起读取
+    prefetch_topics(topics, current_user.id)
     topics_cafes = CafeTopic.get_topics_cafes([t.id for t in topics])
     data = []
     for d in iter_items_with_users(topics):
@@ -62,6 +73,7 @@ def view_topic(tid):
     GET /topics/<int:tid>
     """
     topic = Topic.cache.get_or_404(tid)
+    current_loader().want(User, [topic.user_id])
     data = make_topic_response(topic)
 
     # /api/topic/:id?content=raw vs ?content=html
@@ -70,13 +82,33 @@ def view_topic(tid):
         data['content'] = topic.content
     else:
         data['content'] = topic.html
-        TopicStat(tid).increase('views')
+        stat = TopicStat(tid)
+        stat.increase('views', buffered=True)
+        record_hot(tid, 'views', buffered=True)
+        if not is_robot():
+            visitor = get_visitor_id(current_user.id)
+            stat.add_viewer(visitor, buffered=True)
 
     data['cafes'] = CafeTopic.get_topic_cafes(tid, 1)
     data['user'] = User.cache.get(topic.user_id)
     return jsonify(data)
 
 
+@api.route('/<int:tid>/related')
+@require_oauth(login=False, cache_time=600)
+def view_related_topics(tid):
+    """相关主题
+    GET /topics/<int:tid>/related
+    """
+    Topic.cache.get_or_404(tid)
+    count = int_or_raise('count', 10, 50)
+    topics = get_related_topics(tid, count)
+    prefetch_topics(topics, current_user.id)
+    data = list(iter_items_with_users(topics))
+    data = list(iter_topics_with_statuses(data, current_user.id))
+    return jsonify(data=data)
+
+
 @api.route('/<int:tid>', methods=['POST'])
 @require_oauth(login=True, scopes=['topic:write'])
 def update_topic(tid):
@@ -146,8 +178,9 @@ def view_topic_comments(tid):
         )
     else:
         statuses = {}
-    for d in iter_items_with_users(comments):
-        d['content'] = markup(d['content'])
+    htmls = markup_many([c.content for c in comments])
+    for d, html in zip(iter_items_with_users(comments), htmls):
+        d['content'] = html
         # update status
         d.update(statuses.get(str(d['id']), {}))
         data.append(d)
@@ -210,8 +243,6 @@ def unlike_topic(tid):
         raise Conflict(description='You already unliked it')
     with db.auto_commit():
         db.session.delete(data)
-
-    TopicStat(tid).calculate()
     return '', 204
 
 
@@ -224,8 +255,6 @@ def delete_topic_comment(tid, cid):
         raise Denied('deleting this comment')
     with db.auto_commit():
         db.session.delete(comment)
-
-    TopicStat(tid).calculate()
     return '', 204
 
 
@@ -236,10 +265,7 @@ def flag_topic_comment(tid, cid):
     if cache.get(key):
         return '', 204
     comment = get_comment_or_404(tid, cid)
-    # here is a concurrency bug, but it doesn't matter
-    comment.flag_count += 1
-    with db.auto_commit():
-        db.session.add(comment)
+    Comment.flag(comment.id)
     # one person, one flag
     cache.inc(key)
     return '', 204
@@ -253,15 +279,10 @@ def like_topic_comment(tid, cid):
         raise Conflict(description='You already liked it')
 
     comment = get_comment_or_404(tid, cid)
-    # here is a concurrency bug, but it doesn't matter
-    if comment.like_count:
-        comment.like_count += 1
-    else:
-        comment.like_count = 1
     like = CommentLike(comment_id=comment.id, user_id=current_user.id)
     with db.auto_commit():
         db.session.add(like)
-        db.session.add(comment)
+        Comment.increase_column(comment.id, 'like_count')
     return '', 204
 
 
@@ -275,9 +296,7 @@ def unlike_topic_comment(tid, cid):
     comment = get_comment_or_404(tid, cid)
     with db.auto_commit():
         db.session.delete(like)
-
-    with db.auto_commit(False):
-        comment.reset_like_count()
+        Comment.increase_column(comment.id, 'like_count', -1)
     return '', 204
 
 ####################################################################
@@ -1,11 +1,11 @@
 # coding: utf-8
 
-from flask import jsonify
 from zerqu.models import db, User, current_user
 from zerqu.models import Cafe, CafeMember, Topic
 from zerqu.models import Notification
 from zerqu.models import iter_items_with_users
-from zerqu.models.topic import iter_topics_with_statuses
+from zerqu.models.topic import iter_topics_with_statuses, prefetch_topics
+from zerqu.models.serializer import jsonify
 from zerqu.forms import RegisterForm, UserProfileForm
 from .base import ApiBlueprint
 from .base import require_oauth, require_confidential
@@ -70,6 +70,7 @@ def view_user_topics(username):
         return jsonify(data=[], cursor=0)
 
     topics = Topic.cache.get_many(topic_ids)
+    prefetch_topics(topics, current_user.id)
     data = list(iter_items_with_users(topics, {str(user.id): user}))
     data = list(iter_topics_with_statuses(data, current_user.id))
 
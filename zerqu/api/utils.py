@@ -4,7 +4,9 @@ from flask import request
 
 from zerqu.libs.errors import APIException
 from zerqu.libs.utils import Pagination
+from zerqu.libs.cache import zset_page
 from zerqu.models import db
+from zerqu.rec.popularity import get_hot_topics
 
 
 def int_or_raise(key, value=0, maxvalue=None):
@@ -51,6 +53,25 @@ def cursor_query(model, filter_func=None):
     return data, cursor
 
 
+def zset_cursor_query(key):
+    """按分数从高到低分页读取 redis 有序集合，返回 ``([(ID, 分数)], cursor)``"""
+    count = int_or_raise('count', 20, 100)
+    try:
+        rv, cursor = zset_page(key, request.args.get('cursor'), count)
+    except ValueError:
+        raise APIException(description='Invalid cursor')
+    return [(int(i), int(score)) for i, score in rv], cursor
+
+
+def hot_cursor_query(cafe_id=None):
+    """按热度排序的主题，cursor 的格式见 ``zset_page``"""
+    count = int_or_raise('count', 20, 100)
+    try:
+        return get_hot_topics(request.args.get('cursor'), count, cafe_id)
+    except ValueError:
+        raise APIException(description='Invalid cursor')
+
+
 def get_pagination_query():
     # 获取页数参数
     page = int_or_raise('page', 1)
@@ -3,16 +3,20 @@ import os
 from datetime import datetime
 from flask import Flask as _Flask
 from flask.json import JSONEncoder as _JSONEncoder
+from zerqu.models.base import Base
+from zerqu.models.serializer import dump_model, format_datetime
 SYSTEM_CONF = '/etc/zerqu/conf.py'
 
 
 class JSONEncoder(_JSONEncoder):
     def default(self, o):
+        if isinstance(o, Base):
+            return dump_model(o)
         if hasattr(o, 'keys') and hasattr(o, '__getitem__'):
             return dict(o)
         if isinstance(o, datetime):
-            return o.strftime('%Y-%m-%dT%H:%M:%SZ')
-        return JSONEncoder.default(self, o)
+            return format_datetime(o)
+        return _JSONEncoder.default(self, o)
 
 
 class Flask(_Flask):
@@ -3,10 +3,11 @@
 from flask import redirect, request, current_app
 from flask import url_for as flask_url_for
 from werkzeug.urls import url_encode, url_join
-from flask_admin import Admin, AdminIndexView
+from flask_admin import Admin, AdminIndexView, BaseView, expose
 from flask_admin.contrib.sqla import ModelView as _ModelView
 from zerqu.models import db, current_user
-from zerqu.models import User, Cafe, Topic
+from zerqu.models import User, Cafe, Topic, TopicStat, Comment
+from zerqu.libs.cache import zset_page
 
 
 class LoginMixin(object):
@@ -84,6 +85,43 @@ class TopicModelView(ModelView):
     }
 
 
+class FlagView(LoginMixin, BaseView):
+    """被举报的主题和评论，按举报次数从高到低排列"""
+    kinds = {
+        'topics': (Topic, TopicStat.TOPIC_FLAGS),
+        'comments': (Comment, Comment.FLAGS_KEY),
+    }
+
+    @expose('/')
+    def index(self):
+        kind = request.args.get('kind')
+        if kind not in self.kinds:
+            kind = 'topics'
+        model, key = self.kinds[kind]
+        try:
+            rv, cursor = zset_page(key, request.args.get('cursor'), 50)
+        except ValueError:
+            rv, cursor = zset_page(key, None, 50)
+
+        scores = {int(i): int(score) for i, score in rv}
+        items = model.cache.get_many([int(i) for i, _ in rv])
+        users = User.cache.get_dict([o.user_id for o in items])
+        return self.render(
+            'admin/flags.html', kind=kind, items=items, scores=scores,
+            users=users, cursor=cursor,
+        )
+
+    @expose('/resolve', methods=['POST'])
+    def resolve(self):
+        kind = request.form.get('kind')
+        ident = int(request.form['id'])
+        if kind == 'comments':
+            Comment.resolve_flags(ident)
+        else:
+            TopicStat(ident).resolve_flags()
+        return redirect(self.get_url('.index', kind=kind))
+
+
 def url_for(endpoint, **values):
     if endpoint == 'admin.static':
         filename = values.pop('filename')
@@ -103,6 +141,7 @@ def init_app(app):
     admin.add_view(UserModelView(User, db.session))
     admin.add_view(CafeModelView(Cafe, db.session))
     admin.add_view(TopicModelView(Topic, db.session))
+    admin.add_view(FlagView(name='Flags', endpoint='flags'))
 
     if app.config.get('ADMIN_STATIC_URL'):
         app.jinja_env.globals['url_for'] = url_for
@@ -1,15 +1,38 @@
 # coding: utf-8
 
-from functools import wraps
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from functools import wraps, partial
 from contextlib import contextmanager
 from flask import current_app, g
 from werkzeug.local import LocalProxy
+from .utils import EMPTY, PeriodicBuffer, to_str
 
 # defined time durations
 ONE_DAY = 86400
 ONE_HOUR = 3600
 FIVE_MINUTES = 300
 
+# 进程内缓存失效广播频道
+INVALIDATE_CHANNEL = 'cache:invalidate'
+
+# 重新计算缓存时持有锁的最长时间
+LOCK_TIMEOUT = 10
+# 带软过期时间的缓存条目标记: (ENTRY_MARK, soft_expires_at, value)
+ENTRY_MARK = '!swr'
+
+# 缓存统计，按数据表或者名称记录在 redis hash 里
+METRICS_PREFIX = 'cache_stat:{}'
+METRICS_NAMES = 'cache_stat:names'
+# 没命中次数最多的 key
+METRICS_HOT = 'cache_stat:hot'
+HOT_KEYS_SIZE = 1000
+
+logger = logging.getLogger('zerqu')
+
 
 def init_app(app):
     """缓存初始化"""
@@ -42,8 +65,10 @@ def execute_pipeline(prefix='zerqu'):
     redis = current_app.extensions[key]
     with redis.pipeline() as pipe:
         setattr(g, key, pipe)
-        yield
-        delattr(g, key)
+        try:
+            yield
+        finally:
+            delattr(g, key)
         pipe.execute()
 
 
@@ -51,8 +76,350 @@ def execute_pipeline(prefix='zerqu'):
 cache = LocalProxy(use_cache)
 redis = LocalProxy(use_redis)
 
+LUA_SCRIPTS = {
+    # key 存在时才增加，不存在说明还没有初始化，等读取时再计算
+    'incr_if_exists': """
+        if redis.call('exists', KEYS[1]) == 1 then
+            return redis.call('incrby', KEYS[1], ARGV[1])
+        end
+        return nil
+    """,
+    # key 存在时才加入集合，和 incr_if_exists 一样
+    'sadd_if_exists': """
+        if redis.call('exists', KEYS[1]) == 1 then
+            return redis.call('sadd', KEYS[1], ARGV[1])
+        end
+        return nil
+    """,
+    # hash 字段减少，最小为 0
+    'hdecr_floor': """
+        local v = redis.call('hincrby', KEYS[1], ARGV[1], -tonumber(ARGV[2]))
+        if v < 0 then
+            redis.call('hset', KEYS[1], ARGV[1], 0)
+            return 0
+        end
+        return v
+    """,
+    # 从快照恢复 hash：没有恢复标记 ARGV[1] 时，ARGV[2] 个字段累加，
+    # 其余字段不存在时才设置，最后写入标记
+    'hrestore': """
+        if redis.call('hexists', KEYS[1], ARGV[1]) == 1 then
+            return 0
+        end
+        local n = tonumber(ARGV[2]) * 2 + 2
+        for i = 3, #ARGV, 2 do
+            if i <= n then
+                redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+            else
+                redis.call('hsetnx', KEYS[1], ARGV[i], ARGV[i + 1])
+            end
+        end
+        redis.call('hset', KEYS[1], ARGV[1], 1)
+        return 1
+    """,
+    # key 存在时才加入有序集合，只保留分数最高的 ARGV[3] 个成员
+    'zadd_capped': """
+        if redis.call('exists', KEYS[1]) == 0 then
+            return 0
+        end
+        redis.call('zadd', KEYS[1], ARGV[1], ARGV[2])
+        redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+        return 1
+    """,
+    # 从时间线 KEYS[1] 移除主题 ARGV[1]，主题所在的 cafe KEYS[3] 里还有
+    # 用户关注的 cafe KEYS[2] 时保留；关注集合不存在时删除时间线，等读取时重建
+    'timeline_zrem': """
+        if redis.call('exists', KEYS[2]) == 0 then
+            return redis.call('del', KEYS[1])
+        end
+        for _, cafe_id in ipairs(redis.call('smembers', KEYS[3])) do
+            if redis.call('sismember', KEYS[2], cafe_id) == 1 then
+                return 0
+            end
+        end
+        return redis.call('zrem', KEYS[1], ARGV[1])
+    """,
+    # 热度增加 weight * 2 ^ ((now - epoch) / half_life)，每个有序集合的
+    # epoch 保存在 KEYS[1] 里；同时增加 KEYS[2] 里的 cafe 的有序集合，
+    # KEYS[2] 为空说明主题不在任何公开的 cafe 里，不增加
+    'hot_incr': """
+        if redis.call('exists', KEYS[2]) == 0 then
+            return 0
+        end
+        local now = tonumber(ARGV[3])
+        local function incr(key)
+            local epoch = tonumber(redis.call('hget', KEYS[1], key))
+            if not epoch then
+                epoch = now
+                redis.call('hset', KEYS[1], key, ARGV[3])
+            end
+            local exp = (now - epoch) / tonumber(ARGV[4])
+            local score = tonumber(ARGV[2]) * math.pow(2, exp)
+            redis.call('zincrby', key, score, ARGV[1])
+        end
+        incr(KEYS[3])
+        for _, cafe in ipairs(redis.call('smembers', KEYS[2])) do
+            incr(ARGV[5] .. cafe)
+        end
+        return 1
+    """,
+    # 把有序集合的 epoch 移到 now，分数按比例缩小，去掉太小的和超出数量的
+    'hot_rebase': """
+        local epoch = tonumber(redis.call('hget', KEYS[1], KEYS[2]))
+        if not epoch or redis.call('exists', KEYS[2]) == 0 then
+            redis.call('hdel', KEYS[1], KEYS[2])
+            return 0
+        end
+        local exp = (epoch - tonumber(ARGV[1])) / tonumber(ARGV[2])
+        local factor = math.pow(2, exp)
+        redis.call('zunionstore', KEYS[2], 1, KEYS[2], 'weights', factor)
+        redis.call('zremrangebyscore', KEYS[2], '-inf', '(' .. ARGV[4])
+        redis.call('zremrangebyrank', KEYS[2], 0, -tonumber(ARGV[3]) - 1)
+        redis.call('hset', KEYS[1], KEYS[2], ARGV[1])
+        return 1
+    """,
+}
+
+
+def run_script(name, keys=None, args=None, client=None):
+    """执行 ``LUA_SCRIPTS`` 里的脚本，在 ``execute_pipeline`` 里会进入管道
+
+    :param client: 指定 redis 客户端或者管道
+    """
+    scripts = current_app.extensions.setdefault('zerqu_scripts', {})
+    script = scripts.get(name)
+    if script is None:
+        conn = current_app.extensions['zerqu_redis']
+        script = scripts[name] = conn.register_script(LUA_SCRIPTS[name])
+    # 管道定义了 __len__，空的管道也是假值，不能用 ``client or ...``
+    if client is None:
+        client = use_redis()
+    return script(keys=keys, args=args, client=client)
+
+
+def zset_page(key, cursor=None, count=20):
+    """按分数从高到低读取有序集合的一页，返回 ``([(成员, 分数)], 下一页 cursor)``
+
+    cursor 是 ``<分数>_<偏移>``，偏移是上一页末尾和最后一个分数相同的成员
+    数量，分数相同的成员翻页时不会重复或者遗漏。没有下一页时 cursor 为 0。
+    格式不对时抛出 ``ValueError``。分隔符不能用 ``:``，OAuth 校验请求时
+    会拒绝没有编码的 ``:``。
+    """
+    score, offset = '+inf', 0
+    if cursor:
+        score, offset = cursor.split('_')
+        score, offset = float(score), int(offset)
+    rv = redis.zrevrangebyscore(
+        key, score, '-inf', start=offset, num=count, withscores=True,
+    )
+    if len(rv) < count:
+        return rv, 0
+
+    last = rv[-1][1]
+    n = len([s for _, s in rv if s == last])
+    if last == score:
+        n += offset
+    return rv, '%r_%d' % (last, n)
+
+
+class LocalCache(object):
+    """进程内的 LRU 缓存，每个条目都有过期时间
+
+    :param size: 最多保存的条目数量
+    :param timeout: 条目的过期时间，单位秒
+    """
+
+    def __init__(self, size=1000, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __bool__(self):
+        # 定义了 __len__，空的缓存也要是真值
+        return True
+
+    __nonzero__ = __bool__
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.time():
+                return None
+            # 重新插入到末尾，表示最近使用过
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + timeout)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# name -> LocalCache，每个 worker 进程一份
+local_caches = {}
+_listener = {'pid': None}
+
+
+def use_local_cache(name, size):
+    """获取名为 ``name`` 的进程内缓存，未开启时返回 None"""
+    config = current_app.config
+    if not config.get('ZERQU_LOCAL_CACHE'):
+        return None
+
+    _start_invalidation_listener(current_app.extensions['zerqu_redis'])
+
+    rv = local_caches.get(name)
+    if rv is None:
+        timeout = config.get('ZERQU_LOCAL_CACHE_TIMEOUT', 60)
+        rv = local_caches.setdefault(name, LocalCache(size, timeout))
+    return rv
+
+
+def broadcast_invalidate(name, *keys):
+    """通知所有 worker 删除进程内缓存"""
+    if not keys or not current_app.config.get('ZERQU_LOCAL_CACHE'):
+        return
+    local = local_caches.get(name)
+    for key in keys:
+        if local is not None:
+            local.delete(key)
+        redis.publish(INVALIDATE_CHANNEL, '%s %s' % (name, key))
+
+
+def _start_invalidation_listener(client):
+    # gunicorn fork 之后线程不会被继承，所以按进程号判断
+    pid = os.getpid()
+    if _listener['pid'] == pid:
+        return
+    _listener['pid'] = pid
+    t = threading.Thread(target=_listen_invalidation, args=(client,))
+    t.daemon = True
+    t.start()
+
+
+def _listen_invalidation(client):
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                data = message['data']
+                if isinstance(data, bytes):
+                    data = data.decode('utf-8')
+                name, key = data.split(' ', 1)
+                local = local_caches.get(name)
+                if local is not None:
+                    local.delete(key)
+        except Exception as e:
+            logger.warning('Cache invalidation listener: %r' % e)
+            # 断线期间可能漏掉了消息，只能全部丢弃
+            for local in list(local_caches.values()):
+                local.clear()
+            time.sleep(1)
+
+
+def single_flight(key, creator, stale=EMPTY, reload=None, wait=0.5):
+    """同一时间只有一个调用者执行 ``creator``
+
+    没抢到锁的调用者：有旧值 ``stale`` 就直接返回旧值；否则每隔 50ms
+    调用一次 ``reload()``，等待抢到锁的调用者写入缓存，``reload()``
+    返回 EMPTY 表示还没有写入。等待超过 ``wait`` 秒就自己执行 ``creator``。
+
+    :param key: 缓存key，锁的名称是 ``lock:<key>``
+    :param creator: 计算并写入缓存，返回计算结果
+    """
+    client = current_app.extensions['zerqu_redis']
+    lock = 'lock:%s' % key
+    if client.set(lock, 1, nx=True, ex=LOCK_TIMEOUT):
+        try:
+            return creator()
+        finally:
+            client.delete(lock)
+
+    if stale is not EMPTY:
+        return stale
 
-def cached(key_pattern, expire=ONE_HOUR):
+    if reload is not None:
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            time.sleep(0.05)
+            rv = reload()
+            if rv is not EMPTY:
+                return rv
+    return creator()
+
+
+def _is_entry(rv):
+    return isinstance(rv, tuple) and len(rv) == 3 and rv[0] == ENTRY_MARK
+
+
+def fetch(key, creator, expire=ONE_HOUR, stale=None, metric=None):
+    """读取缓存，没有则调用 ``creator`` 计算并缓存
+
+    缓存在 ``expire`` 秒后软过期，再过 ``stale`` 秒（默认和 ``expire``
+    一样）才真正删除。软过期之后由一个调用者重新计算，其他调用者继续
+    使用旧值。
+
+    :param metric: ``(name, op)``，记录到缓存统计里
+    """
+    if metric is None:
+        return _fetch(key, creator, expire, stale, None)
+    with timing(*metric):
+        return _fetch(key, creator, expire, stale, metric)
+
+
+def _fetch(key, creator, expire, stale, metric):
+    if stale is None:
+        stale = expire
+
+    def create():
+        if metric:
+            record_cache(metric[0], metric[1], 'miss', key=key)
+        rv = creator()
+        entry = (ENTRY_MARK, time.time() + expire, rv)
+        cache.set(key, entry, expire + stale)
+        return rv
+
+    def reload():
+        entry = cache.get(key)
+        if _is_entry(entry):
+            return entry[2]
+        return EMPTY
+
+    entry = cache.get(key)
+    if not _is_entry(entry):
+        return single_flight(key, create, reload=reload)
+
+    _, expires_at, value = entry
+    if expires_at > time.time():
+        if metric:
+            record_cache(metric[0], metric[1], 'hit')
+        return value
+    if metric:
+        record_cache(metric[0], metric[1], 'stale')
+    return single_flight(key, create, stale=value)
+
+
+def cached(key_pattern, expire=ONE_HOUR, stale=None):
     def wrapper(f):
         @wraps(f)
         def decorated(*args, **kwargs):
@@ -62,11 +429,109 @@ def cached(key_pattern, expire=ONE_HOUR):
                 key = key_pattern % kwargs
             else:
                 key = key_pattern
-            rv = cache.get(key)
-            if rv:
-                return rv
-            rv = f(*args, **kwargs)
-            cache.set(key, rv, timeout=expire)
-            return rv
+
+            def creator():
+                return f(*args, **kwargs)
+
+            metric = ('cached', f.__name__)
+            return fetch(key, creator, expire, stale, metric)
         return decorated
     return wrapper
+
+
+def use_metrics():
+    """当前 app 的缓存统计缓冲，没有开启统计时返回 None"""
+    config = current_app.config
+    if not config.get('ZERQU_CACHE_METRICS'):
+        return None
+    rv = current_app.extensions.get('zerqu_cache_metrics')
+    if rv is None:
+        client = current_app.extensions['zerqu_redis']
+        interval = config.get('ZERQU_CACHE_METRICS_INTERVAL', 10)
+        rv = PeriodicBuffer(partial(_flush_metrics, client), interval)
+        current_app.extensions['zerqu_cache_metrics'] = rv
+    return rv
+
+
+def record_cache(name, op, result, count=1, key=None):
+    """记录一次缓存操作，先在进程内累加，定时写入 redis
+
+    :param name: 数据表名称，或者 ``cached``、``response``
+    :param op: 操作，例如 ``get``、``ff``
+    :param result: ``hit``、``local``、``stale``、``nil``、``miss``
+                   （查询了数据库），或者 ``bytes`` 这样的累计值
+    :param key: 记录没命中的 key，用来找出热点
+    """
+    metrics = use_metrics()
+    if metrics is None:
+        return
+    metrics.add((name, '%s:%s' % (op, result)), count)
+    if key is not None:
+        metrics.add((None, key), count)
+
+
+@contextmanager
+def timing(name, op):
+    """记录调用次数和耗时（微秒）"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = int((time.time() - start) * 1000000)
+        record_cache(name, op, 'calls')
+        record_cache(name, op, 'us', elapsed)
+
+
+def flush_metrics():
+    metrics = use_metrics()
+    if metrics is not None:
+        metrics.flush()
+
+
+def _flush_metrics(client, data):
+    names = set()
+    with client.pipeline(transaction=False) as pipe:
+        for (name, field), value in data.items():
+            if name is None:
+                pipe.zincrby(METRICS_HOT, field, value)
+            else:
+                names.add(name)
+                pipe.hincrby(METRICS_PREFIX.format(name), field, value)
+        if names:
+            pipe.sadd(METRICS_NAMES, *names)
+        pipe.zremrangebyrank(METRICS_HOT, 0, -HOT_KEYS_SIZE - 1)
+        pipe.execute()
+
+
+def read_metrics(hot=20):
+    """读取所有缓存统计，并计算命中率和平均耗时"""
+    client = current_app.extensions['zerqu_redis']
+    names = sorted(to_str(n) for n in client.smembers(METRICS_NAMES))
+    with client.pipeline() as pipe:
+        for name in names:
+            pipe.hgetall(METRICS_PREFIX.format(name))
+        pipe.zrevrange(METRICS_HOT, 0, hot - 1, withscores=True)
+        rv = pipe.execute()
+
+    stats = {}
+    for name, fields in zip(names, rv[:-1]):
+        ops = defaultdict(dict)
+        for field, value in fields.items():
+            op, result = to_str(field).rsplit(':', 1)
+            ops[op][result] = int(value)
+        for op in ops.values():
+            calls = op.get('calls')
+            if calls:
+                op['hit_rate'] = round(1 - op.get('miss', 0) / float(calls), 4)
+                op['avg_us'] = op.get('us', 0) // calls
+        stats[name] = dict(ops)
+
+    hot_keys = [(to_str(k), int(score)) for k, score in rv[-1]]
+    return dict(stats=stats, hot_keys=hot_keys)
+
+
+def reset_metrics():
+    client = current_app.extensions['zerqu_redis']
+    names = [to_str(n) for n in client.smembers(METRICS_NAMES)]
+    keys = [METRICS_PREFIX.format(name) for name in names]
+    client.delete(METRICS_NAMES, METRICS_HOT, *keys)
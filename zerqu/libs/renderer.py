@@ -1,5 +1,7 @@
+# coding: utf-8
 
 import re
+import hashlib
 from mistune import Renderer, Markdown
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
@@ -9,6 +11,8 @@ from flask import current_app
 from markupsafe import escape
 from werkzeug.utils import import_string
 from jinja2.utils import urlize
+from .cache import redis, use_local_cache, broadcast_invalidate
+from .utils import to_str
 try:
     import html5lib
     import html5lib.sanitizer
@@ -113,9 +117,88 @@ renderers = {
 }
 
 
+# 渲染结果，按渲染器、渲染器版本和内容的 sha1 缓存
+HTML_KEY = 'html:{}:{}:{}'
+
+
+def use_renderer():
+    """返回 ``(名称, 版本, 渲染函数)``"""
+    config = current_app.config
+    name = config.get('ZERQU_TEXT_RENDERER')
+    func = renderers.get(name)
+    if func is None:
+        func = import_string(name)
+    return name, config.get('ZERQU_RENDERER_VERSION', 1), func
+
+
+def html_cache_key(s, name=None, version=None):
+    if name is None:
+        name, version, _ = use_renderer()
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return HTML_KEY.format(name, version, hashlib.sha1(s).hexdigest())
+
+
+def render(s):
+    """直接渲染，不使用缓存，比如预览"""
+    return use_renderer()[2](s)
+
+
 def markup(s):
-    name = current_app.config.get('ZERQU_TEXT_RENDERER')
-    if name in renderers:
-        return renderers[name](s)
-    func = import_string(name)
-    return func(s)
+    """渲染内容，结果缓存在 redis 和进程内缓存里"""
+    return markup_many([s])[0]
+
+
+def markup_many(texts):
+    """渲染多个内容，redis 里的缓存用一次 ``MGET`` 读取"""
+    name, version, func = use_renderer()
+    keys = [html_cache_key(s, name, version) for s in texts]
+    local = use_local_cache('html', _local_size())
+    if local is None:
+        rv = [None] * len(keys)
+    else:
+        rv = [local.get(key) for key in keys]
+    missing = [i for i, value in enumerate(rv) if value is None]
+    if not missing:
+        return rv
+
+    values = redis.mget([keys[i] for i in missing])
+    created = {}
+    for i, value in zip(missing, values):
+        key = keys[i]
+        if value is not None:
+            value = to_str(value)
+        elif key in created:
+            value = created[key]
+        else:
+            value = created[key] = func(texts[i])
+        rv[i] = value
+        if local is not None:
+            local.set(key, value)
+    if created:
+        _save_html(created)
+    return rv
+
+
+def cache_markup(s, old=None):
+    """写入内容时调用，预先渲染并缓存，``old`` 是修改之前的内容"""
+    if old and old != s:
+        key = html_cache_key(old)
+        redis.delete(key)
+        broadcast_invalidate('html', key)
+    if not s:
+        return
+    name, version, func = use_renderer()
+    _save_html({html_cache_key(s, name, version): func(s)})
+
+
+def _save_html(items):
+    expires = current_app.config.get('ZERQU_HTML_CACHE_EXPIRES', 7 * 86400)
+    with redis.pipeline(transaction=False) as pipe:
+        for key, value in items.items():
+            pipe.set(key, value, ex=expires)
+        pipe.execute()
+
+
+def _local_size():
+    return current_app.config.get('ZERQU_HTML_LOCAL_CACHE_SIZE', 2000)
@@ -1,5 +1,9 @@
 # coding: utf-8
 
+import time
+import atexit
+import hashlib
+import threading
 from flask import request, current_app, url_for
 from flask import copy_current_request_context
 try:
@@ -25,6 +29,68 @@ def run_task(func, *args, **kwargs):
         func(*args, **kwargs)
 
 
+class PeriodicBuffer(object):
+    """进程内累加，每隔 ``interval`` 秒或者累计 ``size`` 次之后调用一次
+    ``flush(data)``，``data`` 是 ``{key: 累加值}``
+
+    有数据时启动一个定时器，没有新的调用时也会在 ``interval`` 秒内写出。
+    ``flush`` 在定时器线程里执行，不能依赖 app context。
+    """
+
+    def __init__(self, flush, interval=10, size=10000):
+        self._flush = flush
+        self.interval = interval
+        self.size = size
+        self._data = {}
+        self._count = 0
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.close)
+
+    def add(self, key, value=1):
+        with self._lock:
+            self._data[key] = self._data.get(key, 0) + value
+            self._count += 1
+            due = self._count >= self.size or \
+                time.time() - self._flushed_at >= self.interval
+            if not due:
+                self._schedule()
+        if due:
+            self.flush()
+
+    def _schedule(self):
+        # fork 之后子进程里的定时器线程不再运行
+        if self._timer is not None and self._timer.is_alive():
+            return
+        self._timer = threading.Timer(self.interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            data = self._data
+            self._data = {}
+            self._count = 0
+            self._flushed_at = time.time()
+        if data:
+            self._flush(data)
+
+    def close(self):
+        """进程退出时写出剩下的数据"""
+        if self._timer is not None and self._timer.is_alive():
+            self._timer.cancel()
+            self._timer.join(1)
+        self.flush()
+
+
+def to_str(s, charset='utf-8'):
+    """redis 返回的 bytes 转为字符串"""
+    if isinstance(s, bytes):
+        return s.decode(charset)
+    return s
+
+
 def xmldatetime(date):
     return date.strftime('%Y-%m-%dT%H:%M:%SZ')
 
@@ -61,6 +127,16 @@ def is_robot():
     return request.user_agent.browser in ROBOT_BROWSERS
 
 
+def get_visitor_id(user_id=None):
+    """访客标识：登录用户用 ID，其他访客用 IP 和 User-Agent 的摘要"""
+    if user_id:
+        return 'u:%s' % user_id
+    text = '%s|%s' % (request.remote_addr, request.user_agent)
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()[:16]
+
+
 def is_mobile():
     """是否是手机端"""
     return request.user_agent.platform in MOBILE_PLATFORMS
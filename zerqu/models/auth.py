@@ -3,14 +3,12 @@
 import datetime
 from werkzeug.utils import cached_property
 from werkzeug.security import gen_salt
-from sqlalchemy import event
 from sqlalchemy import Column
 from sqlalchemy import String, Unicode, DateTime, Boolean, Text, Integer
 from flask_oauthlib.provider import OAuth2Provider
 from flask_oauthlib.contrib.oauth2 import bind_cache_grant
-from .base import db, Base, CACHE_TIMES
+from .base import db, Base
 from .user import User, UserSession
-from ..libs.cache import cache
 
 __all__ = ['oauth', 'bind_oauth', 'OAuthClient', 'OAuthToken']
 
@@ -19,6 +17,7 @@ oauth = OAuth2Provider()
 
 class OAuthClient(Base):
     __tablename__ = 'zq_oauth_client'
+    __cache_lookups__ = ('client_id',)
 
     id = Column(Integer, primary_key=True)
 
@@ -70,22 +69,9 @@ class OAuthClient(Base):
         return True
 
 
-@event.listens_for(OAuthClient, 'after_update')
-def receive_oauth_client_after_update(mapper, conn, target):
-    prefix = target.generate_cache_prefix('ff')
-    key = prefix + 'client_id$' + target.client_id
-    cache.set(key, target, CACHE_TIMES['ff'])
-
-
-@event.listens_for(OAuthClient, 'after_delete')
-def receive_oauth_client_after_delete(mapper, conn, target):
-    prefix = target.generate_cache_prefix('ff')
-    key = prefix + 'client_id$' + target.client_id
-    cache.delete(key)
-
-
 class OAuthToken(Base):
     __tablename__ = 'zq_oauth_token'
+    __cache_lookups__ = ('access_token', 'refresh_token')
 
     client_id = Column(Integer, primary_key=True, autoincrement=False)
     user_id = Column(Integer, default=0, primary_key=True, autoincrement=False)
@@ -131,26 +117,6 @@ class OAuthToken(Base):
         return self.created_at + datetime.timedelta(seconds=self.expires_in)
 
 
-@event.listens_for(OAuthToken, 'after_update')
-def receive_oauth_token_after_update(mapper, conn, target):
-    prefix = target.generate_cache_prefix('ff')
-    to_cache = {
-        prefix + 'access_token$' + target.access_token: target,
-        prefix + 'refresh_token$' + target.refresh_token: target,
-    }
-    cache.set_many(to_cache, CACHE_TIMES['ff'])
-
-
-@event.listens_for(OAuthToken, 'after_delete')
-def receive_oauth_token_after_delete(mapper, conn, target):
-    prefix = target.generate_cache_prefix('ff')
-    keys = [
-        prefix + 'access_token$' + target.access_token,
-        prefix + 'refresh_token$' + target.refresh_token,
-    ]
-    cache.delete_many(keys)
-
-
 def bind_oauth(app):
     # bind oauth getters and setters
     oauth.init_app(app)
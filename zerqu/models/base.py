@@ -1,36 +1,67 @@
 # coding: utf-8
 
+import time
+import json
+import struct
+import datetime
+from collections import defaultdict
 from contextlib import contextmanager
+from functools import partial
 
 from flask import current_app, abort
-from sqlalchemy import event, func
-from sqlalchemy.orm import Query, class_mapper
+from sqlalchemy import event, func, text
+from sqlalchemy import Column, String, DateTime
+from sqlalchemy.orm import Query, Session, class_mapper, configure_mappers
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from sqlalchemy.orm.exc import UnmappedClassError
 # 使用了 postgresql 的 JSON 和 ARRAY
 from sqlalchemy.dialects.postgresql import JSON, ARRAY
 from werkzeug.utils import cached_property
 from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
 
-from zerqu.libs.utils import is_json
-from zerqu.libs.cache import cache, redis, ONE_DAY, FIVE_MINUTES
+from zerqu.libs.utils import is_json, to_str, EMPTY, PeriodicBuffer
+from zerqu.libs.utils import run_task
+from zerqu.libs.cache import cache, redis, ONE_HOUR, ONE_DAY, FIVE_MINUTES
+from zerqu.libs.cache import use_local_cache, broadcast_invalidate
+from zerqu.libs.cache import fetch, single_flight, run_script
+from zerqu.libs.cache import execute_pipeline, record_cache, timing
+from zerqu.libs.cache import METRICS_PREFIX
 from zerqu.libs.errors import NotFound
+from .codec import dump_row, load_row
 
 __all__ = ['db', 'CACHE_TIMES', 'Base', 'JSON', 'ARRAY']
 
+# 声明了 ``__cache_counters__`` 的模型
+COUNTED_MODELS = []
+
 # 缓存超时时间映射
 CACHE_TIMES = {
     'get': ONE_DAY,
     'count': ONE_DAY,
     'ff': FIVE_MINUTES,
     'fc': FIVE_MINUTES,
+    # 模型 ``__cache_lookups__`` 声明的 filter_first 字段
+    'lookup': ONE_DAY,
+    # 模型 ``__cache_counters__`` 声明的计数器
+    'counter': ONE_DAY * 7,
+    # 不存在的数据
+    'nil': 60,
+    # 软过期之后还可以继续使用旧数据的时间
+    'stale': ONE_HOUR,
 }
 CACHE_MODEL_PREFIX = 'db'
 
+# 缓存中表示“数据库里没有这条数据”的标记
+TOMBSTONE = b'!nil'
+# 模型缓存前4个字节是软过期时间
+_EXPIRES = struct.Struct('>I')
+
 
 class SQLAlchemy(_SQLAlchemy):
     @contextmanager
     def auto_commit(self, throw=True):
-        """自动提交
+        """自动提交，模型的缓存在提交之后才会更新
         :param throw: bool, 是否抛出异常
         """
         try:
@@ -69,52 +100,71 @@ class CacheQuery(Query):
         # 生成cache key
         # mapper.class_ 即获取该 mapper 的模型
         # generate_cache_prefix 方法是在 BaseMixin 类里
-        key = mapper.class_.generate_cache_prefix('get') + suffix
-        # 从缓存中获取数据
-        rv = cache.get(key)
+        model = mapper.class_
+        key = model.generate_cache_prefix('get') + suffix
+
+        # 请求内已经读取过，或者已经登记在批量读取里
+        loader = _current_loader()
+        if loader is None:
+            return self._get_cached(model, key, ident)
+        if key in loader.pending:
+            loader.resolve()
+        if key not in loader.identity:
+            loader.identity[key] = self._get_cached(model, key, ident)
+        return loader.identity[key]
+
+    def _get_cached(self, model, key, ident):
+        with timing(model.__tablename__, 'get'):
+            return self._get_row(model, key, ident)
+
+    def _get_row(self, model, key, ident):
+        name = model.__tablename__
+        # 先查进程内缓存
+        local = _local_cache(model)
+        rv = _local_get(local, model, key)
         if rv:
+            record_cache(name, 'get', 'local')
             return rv
-        rv = super(CacheQuery, self).get(ident)
-        if rv is None:
+
+        # 再查 redis
+        rv, fresh = read_cache(model, key, local)
+        if rv is TOMBSTONE:
+            record_cache(name, 'get', 'nil')
             return None
-        # 设置缓存
-        cache.set(key, rv, CACHE_TIMES['get'])
-        return rv
+        if rv is not None and fresh:
+            record_cache(name, 'get', 'hit')
+            return rv
+
+        def create():
+            record_cache(name, 'get', 'miss', key=key)
+            item = super(CacheQuery, self).get(ident)
+            if item is None:
+                cache.set(key, TOMBSTONE, CACHE_TIMES['nil'])
+            else:
+                # 设置缓存
+                store_cache(model, {key: item})
+            return item
+
+        def reload():
+            item, _ = read_cache(model, key)
+            if item is None:
+                return EMPTY
+            return _strip_tombstone(item)
+
+        # 缓存过期了只让一个调用者查询数据库，其他调用者使用旧数据
+        if rv is not None:
+            record_cache(name, 'get', 'stale')
+            return single_flight(key, create, stale=rv)
+        return single_flight(key, create, reload=reload)
 
     def get_dict(self, idents):
         if not idents:
             return {}
 
         mapper = self._only_full_mapper_zero('get')
-        if len(mapper.primary_key) != 1:
-            raise NotImplemented
-
-        # 生成前缀
-        prefix = mapper.class_.generate_cache_prefix('get')
-        # 生成keys
-        keys = {prefix + str(i) for i in idents}
-        # 获取缓存数据
-        rv = cache.get_dict(*keys)
-        # 缓存数据是否命中
-        missed = {i for i in idents if rv[prefix + str(i)] is None}
-
-        rv = {k.lstrip(prefix): rv[k] for k in rv}
-        # 全都命中
-        if not missed:
-            return rv
-
-        # 获取第一个主键
-        pk = mapper.primary_key[0]
-        # 主键in_查询
-        missing = self.filter(pk.in_(missed)).all()
-        to_cache = {}
-        for item in missing:
-            ident = str(getattr(item, pk.name))
-            to_cache[prefix + ident] = item
-            rv[ident] = item
-
-        cache.set_many(to_cache, CACHE_TIMES['get'])
-        return rv
+        # 缓存用一次 MGET 读取，没命中的用一次 IN 查询，
+        # 请求内会和其他登记过的 key 合并
+        return get_loader().get_dict(mapper.class_, idents)
 
     def get_many(self, idents, clean=True):
         d = self.get_dict(idents)
@@ -124,54 +174,90 @@ class CacheQuery(Query):
 
     def filter_first(self, **kwargs):
         mapper = self._only_mapper_zero()
+        with timing(mapper.class_.__tablename__, 'ff'):
+            return self._filter_first(mapper, kwargs)
+
+    def _filter_first(self, mapper, kwargs):
+        model = mapper.class_
+        name = model.__tablename__
         # 生成缓存key的前缀， 这里使用 mapper 之后就不需要 mapper 了
-        prefix = mapper.class_.generate_cache_prefix('ff')
+        prefix = model.generate_cache_prefix('ff')
         # 生成缓存key，example: <prefix> + 'username$admin-rolename$admin'
         key = prefix + '-'.join(['%s$%s' % (k, kwargs[k]) for k in kwargs])
-        # 获取缓存
-        rv = cache.get(key)
-        # 缓存命中
-        if rv:
-            return rv
+        # 缓存里保存的是主键，数据通过 get 缓存读取
+        ident = cache.get(key)
+        if ident == TOMBSTONE:
+            record_cache(name, 'ff', 'nil')
+            return None
+        if isinstance(ident, tuple):
+            rv = self.get(ident[0] if len(ident) == 1 else ident)
+            # 缓存命中
+            if rv is not None:
+                record_cache(name, 'ff', 'hit')
+                return rv
+
         # 缓存没命中
+        record_cache(name, 'ff', 'miss', key=key)
         rv = self.filter_by(**kwargs).first()
         if rv is None:
+            # 记下来，有新数据插入时清除
+            store_tombstones(model, [key], track=True)
             return None
-        # 设置缓存
-        # it is hard to invalidate this cache, expires in 2 minutes
-        cache.set(key, rv, CACHE_TIMES['ff'])
+
+        ident = tuple(getattr(rv, k.name) for k in mapper.primary_key)
+        lookups = getattr(model, '__cache_lookups__', ())
+        if set(kwargs).issubset(lookups):
+            # 声明过的查询字段，记录反向索引，更新或删除时精确清除
+            index_lookup(rv, mapper.primary_key, key)
+            cache.set(key, ident, CACHE_TIMES['lookup'])
+        else:
+            # it is hard to invalidate this cache, expires in 5 minutes
+            cache.set(key, ident, CACHE_TIMES['ff'])
+        store_cache(model, {_unique_key(rv, mapper.primary_key): rv})
         return rv
 
     def filter_count(self, **kwargs):
         mapper = self._only_mapper_zero()
         model = mapper.class_  # 获取模型
+        q = self.select_from(model).with_entities(func.count(1))
         if not kwargs:
-            # 没有 filter 条件
+            # 没有 filter 条件，插入数据时会通过 ``cache.inc`` 更新
             key = model.generate_cache_prefix('count')
             rv = cache.get(key)
             if rv is not None:
+                record_cache(model.__tablename__, 'count', 'hit')
                 return rv
-            q = self.select_from(model).with_entities(func.count(1))
-            rv = q.scalar()
-            cache.set(key, rv, CACHE_TIMES['count'])
-            return rv
+
+            def create():
+                record_cache(model.__tablename__, 'count', 'miss', key=key)
+                count = q.scalar()
+                cache.set(key, count, CACHE_TIMES['count'])
+                return count
+
+            def reload():
+                count = cache.get(key)
+                if count is None:
+                    return EMPTY
+                return count
+
+            return single_flight(key, create, reload=reload)
+
+        if len(kwargs) == 1:
+            column, value = list(kwargs.items())[0]
+            if column in getattr(model, '__cache_counters__', ()):
+                # 声明过的计数器，由插入和删除事件维护
+                return read_counter(model, column, value, q)
 
         # 有 filter 条件
         # 生成前缀
         prefix = model.generate_cache_prefix('fc')
         # 生成缓存key
         key = prefix + '-'.join(['%s$%s' % (k, kwargs[k]) for k in kwargs])
-        # 从缓存中获取数据
-        rv = cache.get(key)
-        # 缓存命中
-        if rv:
-            return rv
-        # 缓存没命中，数据库查询
-        q = self.select_from(model).with_entities(func.count(1))
-        rv = q.filter_by(**kwargs).scalar()
-        # 设置缓存
-        cache.set(key, rv, CACHE_TIMES['fc'])
-        return rv
+        # 缓存没命中或者过期时，只有一个调用者查询数据库
+        return fetch(
+            key, q.filter_by(**kwargs).scalar, CACHE_TIMES['fc'],
+            metric=(model.__tablename__, 'fc'),
+        )
 
     def get_or_404(self, ident):
         data = self.get(ident)
@@ -233,17 +319,61 @@ class BaseMixin(object):
         # example: `db:get:zq_user:`
         return '%s:' % prefix
 
+    @classmethod
+    def increase_column(cls, ident, column, step=1):
+        """原子地增加整数字段：``UPDATE ... SET col = col + :step RETURNING``
+
+        提交之后删除这一行的缓存，下次读取时重新加载；减少时最小为 0。
+        返回新的值，数据不存在时返回 None。
+        """
+        mapper = class_mapper(cls)
+        pk = mapper.primary_key[0]
+        col = cls.__table__.c[column]
+        value = func.coalesce(col, 0) + step
+        if step < 0:
+            value = func.greatest(value, 0)
+        stmt = cls.__table__.update().where(pk == ident)
+        stmt = stmt.values({col: value}).returning(col)
+
+        session = db.session()
+        rv = session.execute(stmt).scalar()
+        if rv is None:
+            return None
+
+        # session 里已经加载的实例也一起更新
+        key = mapper.identity_key_from_primary_key([ident])
+        obj = session.identity_map.get(key)
+        if obj is not None:
+            set_committed_value(obj, column, rv)
+
+        key = cls.generate_cache_prefix('get') + str(ident)
+        # 不改写缓存里的字段：并发的两个事务可能后写入的是旧的值
+        session_writes(None, session).forget(cls, key)
+        forget_loaded(key)
+        return rv
+
     @classmethod
     def __declare_last__(cls):
         """给Mapper注册事件"""
+        counters = getattr(cls, '__cache_counters__', None)
+        if counters:
+            COUNTED_MODELS.append(cls)
+
         @event.listens_for(cls, 'after_insert')
         def receive_after_insert(mapper, conn, target):
             """注册Mapper事件，监听insert之后
 
             :param target: 模型
             """
+            writes = session_writes(target)
             # 更新统计
-            cache.inc(target.generate_cache_prefix('count'))
+            writes.inc(target.generate_cache_prefix('count'))
+            # 清除“不存在”的标记，让新数据马上可见
+            key = _unique_key(target, mapper.primary_key)
+            writes.clear_tombstones(target, key)
+            forget_loaded(key)
+            for column in counters or ():
+                writes.incr_counter(target, column, getattr(target, column), 1)
 
         @event.listens_for(cls, 'after_update')
         def receive_after_update(mapper, conn, target):
@@ -251,9 +381,18 @@ class BaseMixin(object):
 
             :param target: 模型
             """
+            writes = session_writes(target)
             key = _unique_key(target, mapper.primary_key)
-            # 设置缓存
-            cache.set(key, target, CACHE_TIMES['get'])
+            # 设置缓存，并通知其他 worker 丢弃进程内缓存
+            writes.store(target, key)
+            forget_loaded(key)
+            writes.clear_lookups(target, mapper.primary_key)
+            for column in counters or ():
+                state = get_history(target, column)
+                for value in state.deleted:
+                    writes.incr_counter(target, column, value, -1)
+                for value in state.added:
+                    writes.incr_counter(target, column, value, 1)
 
         @event.listens_for(cls, 'after_delete')
         def receive_after_delete(mapper, conn, target):
@@ -261,9 +400,15 @@ class BaseMixin(object):
 
             :param target: 模型
             """
+            writes = session_writes(target)
             key = _unique_key(target, mapper.primary_key)
             # 更新统计
-            cache.delete_many(key, target.generate_cache_prefix('count'))
+            writes.delete(target, key, target.generate_cache_prefix('count'))
+            forget_loaded(key)
+            writes.clear_lookups(target, mapper.primary_key)
+            for column in counters or ():
+                value = getattr(target, column)
+                writes.incr_counter(target, column, value, -1)
 
 
 class Base(db.Model, BaseMixin):
@@ -296,6 +441,397 @@ def _unique_key(target, primary_key):
     return target.generate_cache_prefix('get') + key
 
 
+def _local_cache(model):
+    """模型通过 ``__cache_local__`` 声明进程内缓存的大小"""
+    size = getattr(model, '__cache_local__', None)
+    if not size:
+        return None
+    return use_local_cache(model.__tablename__, size)
+
+
+def _local_get(local, model, key):
+    """进程内缓存保存的是编码后的数据，每次都解码出新的实例，
+    避免多个请求修改同一个对象
+    """
+    if not local:
+        return None
+    data = local.get(key)
+    if data is None:
+        return None
+    return load_row(model, data)
+
+
+def _local_set(local, key, data):
+    """``data`` 是 redis 里的缓存数据，去掉过期时间之后保存"""
+    if local:
+        local.set(key, data[_EXPIRES.size:])
+
+
+def read_cache(model, key, local=None):
+    """从 redis 读取模型缓存，返回 ``(实例, 是否还没有软过期)``
+
+    没有软过期的数据同时写入进程内缓存 ``local``。
+    """
+    data = cache.get(key)
+    if data == TOMBSTONE:
+        return TOMBSTONE, True
+    if data:
+        record_cache(model.__tablename__, 'get', 'bytes', len(data))
+    rv, expires_at = _unpack_row(model, data)
+    fresh = expires_at > time.time()
+    if rv is not None and fresh:
+        _local_set(local, key, data)
+    return rv, fresh
+
+
+def load_cache(model, key, local=True):
+    """读取模型缓存，先查进程内缓存，再查 redis"""
+    local = local and _local_cache(model)
+    rv = _local_get(local, model, key)
+    if rv is not None:
+        return rv
+    rv, _ = read_cache(model, key, local)
+    return rv
+
+
+def load_cache_dict(model, keys, local=True):
+    """批量读取模型缓存，返回值和 ``cache.get_dict`` 一样"""
+    return load_cache_multi({key: model for key in keys}, local)
+
+
+def load_cache_multi(models, local=True):
+    """批量读取多个模型的缓存，只用一次 MGET
+
+    :param models: ``{key: model}``
+    """
+    rv = {}
+    missed = []
+    for key in models:
+        l1 = local and _local_cache(models[key])
+        rv[key] = _local_get(l1, models[key], key)
+        if rv[key] is None:
+            missed.append(key)
+    if not missed:
+        return rv
+
+    for key, value in cache.get_dict(*missed).items():
+        if value == TOMBSTONE:
+            rv[key] = TOMBSTONE
+            continue
+        model = models[key]
+        if value:
+            record_cache(model.__tablename__, 'get_dict', 'bytes', len(value))
+        rv[key], _ = _unpack_row(model, value)
+        if rv[key] is not None:
+            _local_set(local and _local_cache(model), key, value)
+    return rv
+
+
+def store_cache(model, mapping, timeout=None, local=True):
+    """写入模型缓存，进程内缓存保存的是同样的编码后的数据
+
+    缓存在 ``timeout`` 秒后软过期，之后 ``CACHE_TIMES['stale']``
+    秒内还可以作为旧数据使用。
+    """
+    if not mapping:
+        return
+    if timeout is None:
+        timeout = CACHE_TIMES['get']
+    expires_at = _EXPIRES.pack(int(time.time() + timeout))
+    data = {key: expires_at + dump_row(mapping[key]) for key in mapping}
+    cache.set_many(data, timeout + CACHE_TIMES['stale'])
+    size = sum(len(v) for v in data.values())
+    record_cache(model.__tablename__, 'set', 'bytes', size)
+    local = local and _local_cache(model)
+    for key in data:
+        _local_set(local, key, data[key])
+
+
+def _unpack_row(model, data):
+    if not isinstance(data, bytes) or len(data) <= _EXPIRES.size:
+        return None, 0
+    expires_at, = _EXPIRES.unpack(data[:_EXPIRES.size])
+    return load_row(model, data[_EXPIRES.size:]), expires_at
+
+
+def store_tombstones(model, keys, track=False):
+    """标记这些 key 对应的数据不存在
+
+    :param track: 是否记录到集合里，``filter_first`` 的 key 无法由新插入的
+                  数据推算出来，需要记录下来以便插入时清除
+    """
+    if not keys:
+        return
+    timeout = CACHE_TIMES['nil']
+    cache.set_many({key: TOMBSTONE for key in keys}, timeout)
+    if track:
+        name = model.generate_cache_prefix('nil')
+        with redis.pipeline() as pipe:
+            pipe.sadd(name, *keys)
+            pipe.expire(name, timeout)
+            pipe.execute()
+
+
+def index_lookup(target, primary_key, key):
+    """记录 ``filter_first`` 的 key 指向了哪一条数据"""
+    name = _lookup_index_key(target, primary_key)
+    with redis.pipeline() as pipe:
+        pipe.sadd(name, key)
+        pipe.expire(name, CACHE_TIMES['lookup'])
+        pipe.execute()
+
+
+def _lookup_index_key(target, primary_key):
+    suffix = _unique_suffix(target, primary_key)
+    return target.generate_cache_prefix('ffidx') + suffix
+
+
+def _counter_key(model, column, value):
+    return '%s%s$%s' % (model.generate_cache_prefix('counter'), column, value)
+
+
+def read_counter(model, column, value, query):
+    """读取计数器，没有初始化时用 ``query`` 统计一次"""
+    key = _counter_key(model, column, value)
+    rv = redis.get(key)
+    if rv is not None:
+        record_cache(model.__tablename__, 'counter', 'hit')
+        return int(rv)
+
+    def create():
+        record_cache(model.__tablename__, 'counter', 'miss', key=key)
+        count = query.filter_by(**{column: value}).scalar()
+        # 统计期间的增减会丢失，由 reconcile_counters 修正
+        redis.set(key, count, ex=CACHE_TIMES['counter'], nx=True)
+        return count
+
+    def reload():
+        count = redis.get(key)
+        if count is None:
+            return EMPTY
+        return int(count)
+
+    return single_flight(key, create, reload=reload)
+
+
+def reconcile_counters(models=None, batch_size=1000):
+    """用 ``GROUP BY`` 重新统计计数器，修正偏差
+
+    只修正 redis 里已经存在的计数器，返回 ``(模型, 字段, 检查数量, 偏差数量)``
+    的生成器。
+    """
+    if models is None:
+        # COUNTED_MODELS 在 __declare_last__ 里填充
+        configure_mappers()
+        models = COUNTED_MODELS
+
+    for model in models:
+        for column in model.__cache_counters__:
+            field = getattr(model, column)
+            q = db.session.query(field, func.count(1)).group_by(field)
+            q = q.execution_options(stream_results=True)
+            counted = {str(v): c for v, c in q.yield_per(batch_size)}
+
+            checked = drifted = 0
+            prefix = _counter_key(model, column, '')
+            for keys in _scan_keys(prefix + '*', batch_size):
+                values = [to_str(k)[len(prefix):] for k in keys]
+                current = redis.mget(keys)
+                with redis.pipeline() as pipe:
+                    for key, value, rv in zip(keys, values, current):
+                        count = counted.get(value, 0)
+                        checked += 1
+                        if rv is not None and int(rv) != count:
+                            drifted += 1
+                            pipe.set(key, count, ex=CACHE_TIMES['counter'])
+                    pipe.execute()
+            yield model, column, checked, drifted
+
+
+def _scan_keys(match, count):
+    cursor = 0
+    while True:
+        cursor, keys = redis.scan(cursor, match=match, count=count)
+        if keys:
+            yield keys
+        if not int(cursor):
+            break
+
+
+class CacheWrites(object):
+    """一个事务里的缓存写操作，提交之后用尽量少的 pipeline 执行，回滚时丢弃
+
+    flush 时写缓存会在事务提交之前就生效，回滚之后缓存里留下的是脏数据。
+    """
+
+    def __init__(self):
+        # get key -> (model, target)，target 为 None 表示删除
+        self.rows = {}
+        self.deletes = set()
+        self.incs = defaultdict(int)
+        self.counters = defaultdict(int)
+        # 提交时需要读取并删除的集合：不存在标记、filter_first 反向索引
+        self.sets = set()
+        self.invalidates = defaultdict(set)
+        # 提交之后执行的任务 (func, args)
+        self.tasks = []
+
+    def store(self, target, key):
+        self.rows[key] = (type(target), target)
+        self.invalidates[target.__tablename__].add(key)
+
+    def delete(self, target, key, *keys):
+        self.rows[key] = (type(target), None)
+        self.deletes.update(keys)
+        self.invalidates[target.__tablename__].add(key)
+
+    def inc(self, key, step=1):
+        self.incs[key] += step
+
+    def forget(self, model, key):
+        """只删除缓存的行，不影响计数"""
+        self.deletes.add(key)
+        self.invalidates[model.__tablename__].add(key)
+
+    def after_commit(self, func, *args):
+        """提交之后用 ``run_task`` 执行，回滚时丢弃"""
+        self.tasks.append((func, args))
+
+    def clear_tombstones(self, target, key):
+        """插入数据之后，清除主键和所有 ``filter_first`` 的不存在标记"""
+        self.deletes.add(key)
+        self.sets.add(target.generate_cache_prefix('nil'))
+
+    def clear_lookups(self, target, primary_key):
+        """数据更新或删除之后，清除指向它的 ``filter_first`` 缓存
+
+        新的字段值之前可能被标记为不存在，也一起清除。
+        """
+        lookups = getattr(target, '__cache_lookups__', None)
+        if not lookups:
+            return
+
+        self.sets.add(_lookup_index_key(target, primary_key))
+        prefix = target.generate_cache_prefix('ff')
+        for column in lookups:
+            value = getattr(target, column)
+            if value is not None:
+                self.deletes.add('%s%s$%s' % (prefix, column, value))
+
+    def incr_counter(self, target, column, value, step):
+        if value is not None:
+            self.counters[_counter_key(type(target), column, value)] += step
+
+    def flush(self):
+        deletes = set(self.deletes)
+        if self.sets:
+            names = list(self.sets)
+            with redis.pipeline() as pipe:
+                for name in names:
+                    pipe.smembers(name)
+                pipe.delete(*names)
+                rv = pipe.execute()
+            for keys in rv[:-1]:
+                deletes.update(to_str(k) for k in keys)
+
+        rows = defaultdict(dict)
+        for key in self.rows:
+            model, target = self.rows[key]
+            if target is None:
+                deletes.add(key)
+            else:
+                rows[model][key] = target
+                deletes.discard(key)
+
+        # SimpleCache 的 delete_many 遇到不存在的键就会停止，逐个删除
+        for key in deletes:
+            cache.delete(key)
+        for model in rows:
+            store_cache(model, rows[model], local=False)
+        for key in self.incs:
+            # 同一个事务里删除过的统计不再增加
+            if key not in deletes:
+                cache.inc(key, self.incs[key])
+
+        with execute_pipeline():
+            for key in self.counters:
+                step = self.counters[key]
+                if step:
+                    run_script('incr_if_exists', keys=[key], args=[step])
+            for name in self.invalidates:
+                broadcast_invalidate(name, *self.invalidates[name])
+
+
+WRITES_KEY = 'zerqu_cache_writes'
+TASKS_KEY = 'zerqu_commit_tasks'
+
+
+def session_writes(target, session=None):
+    """``target`` 所在事务的缓存写操作"""
+    if session is None:
+        session = object_session(target)
+    writes = session.info.get(WRITES_KEY)
+    if writes is None:
+        writes = session.info[WRITES_KEY] = CacheWrites()
+    return writes
+
+
+@event.listens_for(Session, 'after_commit')
+def _flush_cache_writes(session):
+    writes = session.info.pop(WRITES_KEY, None)
+    if writes is None:
+        return
+    if writes.tasks:
+        session.info.setdefault(TASKS_KEY, []).extend(writes.tasks)
+    try:
+        writes.flush()
+    except Exception as e:
+        # 数据库已经提交了，缓存写失败只能等过期
+        current_app.logger.exception('%r' % e)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _run_commit_tasks(session, transaction):
+    # after_commit 里不能再执行 SQL，等最外层的事务结束之后再执行
+    if session.transaction is not None:
+        return
+    for task, args in session.info.pop(TASKS_KEY, ()):
+        try:
+            run_task(task, *args)
+        except Exception as e:
+            current_app.logger.exception('%r' % e)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_cache_writes(session):
+    session.info.pop(WRITES_KEY, None)
+    session.info.pop(TASKS_KEY, None)
+
+
+def _current_loader():
+    # loader 依赖本模块，延迟导入
+    from .loader import current_loader
+    return current_loader()
+
+
+def get_loader():
+    """当前请求的批量读取器，不在请求内时返回一个临时的"""
+    from .loader import Loader
+    return _current_loader() or Loader()
+
+
+def forget_loaded(key):
+    loader = _current_loader()
+    if loader is not None:
+        loader.forget(key)
+
+
+def _strip_tombstone(value):
+    if value is TOMBSTONE:
+        return None
+    return value
+
+
 def _itervalues(data, idents):
     for k in idents:
         item = data[str(k)]
@@ -308,13 +844,30 @@ def _itervalues(data, idents):
 class RedisStat(object):
     """Redis状态类"""
     KEY_PREFIX = 'stat:{}'
+    # 由 ``snapshot_stats`` 保存到数据库，redis 数据丢失后读取时自动恢复
+    SNAPSHOT = False
+    # 恢复时不累加，只在字段不存在时设置
+    SNAPSHOT_REPLACE = ()
 
     def __init__(self, ident):
         self.ident = ident
         self._key = self.KEY_PREFIX.format(ident)
 
-    def increase(self, field, step=1):
-        redis.hincrby(self._key, field, step)
+    def increase(self, field, step=1, buffered=False):
+        """增加计数
+
+        :param buffered: 先在进程内累加，最多延迟
+                         ``ZERQU_STAT_BUFFER_INTERVAL`` 毫秒写入 redis
+        """
+        buf = buffered and use_stat_buffer()
+        if buf:
+            buf.add(('hincrby', self._key, field), step)
+        else:
+            redis.hincrby(self._key, field, step)
+
+    def decrease(self, field, step=1):
+        """原子地减少计数，不会小于 0"""
+        return run_script('hdecr_floor', keys=[self._key], args=[field, step])
 
     def get(self, key, default=0):
         return self.value.get(key, default)
@@ -327,16 +880,163 @@ class RedisStat(object):
 
     @cached_property
     def value(self):
-        return redis.hgetall(self._key)
+        rv = [redis.hgetall(self._key)]
+        if self.SNAPSHOT:
+            restore_stats(self.__class__, [self.ident], rv)
+        return rv[0]
 
     @classmethod
     def get_many(cls, ids):
         with redis.pipeline() as pipe:
             for i in ids:
                 pipe.hgetall(cls.KEY_PREFIX.format(i))
-            return pipe.execute()
+            rv = pipe.execute()
+        if cls.SNAPSHOT:
+            restore_stats(cls, ids, rv)
+        return rv
+
+    @classmethod
+    def restored(cls, pipe, ident, data):
+        """从快照恢复了 ``data`` 之后调用，用来恢复其它相关的数据"""
 
     @classmethod
     def get_dict(cls, ids):
         rv = cls.get_many(ids)
         return dict(zip(ids, rv))
+
+
+class StatSnapshot(db.Model):
+    """``RedisStat`` 的快照，``key`` 是 redis 里的 key"""
+    __tablename__ = 'zq_stat_snapshot'
+
+    key = Column(String(80), primary_key=True)
+    data = Column(JSON, default={})
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+# redis 里有这个字段说明已经从快照恢复过了
+SNAPSHOT_MARK = b'snapshot'
+
+SNAPSHOT_UPSERT = (
+    'INSERT INTO zq_stat_snapshot (key, data, updated_at) VALUES %s '
+    'ON CONFLICT (key) DO UPDATE '
+    'SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at'
+)
+
+
+def restore_stats(stat_cls, idents, values):
+    """把没有恢复过的统计从快照里恢复
+
+    redis 重启之后新增的计数会和快照累加。``values`` 是 ``idents`` 对应的
+    hgetall 结果，恢复过的会替换成新的数据。
+    """
+    missing = [i for i, v in enumerate(values) if SNAPSHOT_MARK not in v]
+    if not missing:
+        return values
+
+    keys = [stat_cls.KEY_PREFIX.format(idents[i]) for i in missing]
+    q = db.session.query(StatSnapshot.key, StatSnapshot.data)
+    snapshots = dict(q.filter(StatSnapshot.key.in_(keys)))
+
+    client = current_app.extensions['zerqu_redis']
+    with client.pipeline() as pipe:
+        for key in keys:
+            data = snapshots.get(key) or {}
+            incrs = [k for k in data if k not in stat_cls.SNAPSHOT_REPLACE]
+            sets = [k for k in data if k in stat_cls.SNAPSHOT_REPLACE]
+            args = [SNAPSHOT_MARK, len(incrs)]
+            for k in incrs + sets:
+                args.extend((k, data[k]))
+            run_script('hrestore', keys=[key], args=args, client=pipe)
+            pipe.hgetall(key)
+        rv = pipe.execute()
+
+    with client.pipeline() as pipe:
+        for n, i in enumerate(missing):
+            values[i] = rv[n * 2 + 1]
+            data = snapshots.get(keys[n])
+            if rv[n * 2] and data:
+                stat_cls.restored(pipe, idents[i], data)
+        pipe.execute()
+    return values
+
+
+def snapshot_stats(stat_classes=None, batch_size=1000):
+    """用 SCAN 遍历 ``RedisStat`` 的 hash，每批一条多行 upsert 写入快照
+
+    返回 ``(统计类, 已保存数量)`` 的生成器。
+    """
+    if stat_classes is None:
+        stat_classes = [c for c in RedisStat.__subclasses__() if c.SNAPSHOT]
+
+    for stat_cls in stat_classes:
+        prefix = stat_cls.KEY_PREFIX.format('')
+        done = 0
+        for keys in _scan_keys(stat_cls.KEY_PREFIX.format('*'), batch_size):
+            keys = [to_str(k) for k in keys]
+            # 还没有恢复过的先恢复，避免用不完整的数据覆盖快照
+            values = stat_cls.get_many([k[len(prefix):] for k in keys])
+            _write_snapshots(keys, values)
+            done += len(keys)
+            yield stat_cls, done
+
+
+def _write_snapshots(keys, values):
+    rows = []
+    params = {'now': datetime.datetime.utcnow()}
+    for i, (key, value) in enumerate(zip(keys, values)):
+        data = {to_str(k): int(v) for k, v in value.items()
+                if k != SNAPSHOT_MARK}
+        params['k%d' % i] = key
+        params['d%d' % i] = json.dumps(data)
+        rows.append('(:k%d, CAST(:d%d AS json), :now)' % (i, i))
+    with db.auto_commit():
+        db.session.execute(text(SNAPSHOT_UPSERT % ', '.join(rows)), params)
+
+
+def use_stat_buffer():
+    """``RedisStat`` 的计数缓冲，``ZERQU_STAT_BUFFER_INTERVAL`` 为 0 时不缓冲"""
+    config = current_app.config
+    interval = config.get('ZERQU_STAT_BUFFER_INTERVAL')
+    if not interval:
+        return None
+    rv = current_app.extensions.get('zerqu_stat_buffer')
+    if rv is None:
+        client = current_app.extensions['zerqu_redis']
+        size = config.get('ZERQU_STAT_BUFFER_SIZE', 1000)
+        rv = PeriodicBuffer(
+            partial(_flush_stats, client), interval / 1000.0, size,
+        )
+        current_app.extensions['zerqu_stat_buffer'] = rv
+    return rv
+
+
+def _flush_stats(client, data):
+    """``data`` 的 key 是 ``(命令, redis key, 参数)``"""
+    members = defaultdict(list)
+    expires = {}
+    with client.pipeline(transaction=False) as pipe:
+        for (command, key, arg), value in data.items():
+            if command == 'hincrby' and value:
+                pipe.hincrby(key, arg, value)
+            elif command == 'pfadd':
+                members[key].append(arg)
+            elif command == 'expire':
+                expires[key] = arg
+        for key in members:
+            pipe.pfadd(key, *members[key])
+        for key in expires:
+            pipe.expire(key, expires[key])
+        pipe.execute()
+
+
+class CacheStat(RedisStat):
+    """模型缓存的统计，按数据表记录，字段是 ``<操作>:<结果>``
+
+    - ``get:miss``/``ff:miss``: 缓存没命中，查询了数据库
+    - ``get:nil``/``ff:nil``: 命中了不存在的标记，省掉了一次查询
+    - ``get:calls``/``get:us``: 调用次数和总耗时（微秒）
+
+    由 ``record_cache`` 在进程内累加后定时写入。
+    """
+    KEY_PREFIX = METRICS_PREFIX
@@ -2,20 +2,38 @@
 import re
 import time
 from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
 from zerqu.libs.utils import run_task
 from zerqu.libs.cache import execute_pipeline
+from zerqu.libs.renderer import cache_markup
+from zerqu.rec.timeline import fanout_cafe_topic, reset_timeline
+from zerqu.rec.timeline import update_cafe_topics
+from zerqu.rec.timeline import get_cafe_set_names, update_cafe_sets
+from zerqu.rec.popularity import record_hot, link_cafe_topic
+from zerqu.rec.tags import update_topic_tags
+from zerqu.rec.related import mark_related_changed, remove_related_topics
+from .base import session_writes
+from .cafe import Cafe, CafeMember, CafeTopic
 from .topic import Topic, TopicStat, TopicLike, TopicRead
 from .topic import Comment, CommentLike
 from .notification import Notification
 from .user import User
 
+# 每次 create_app 都会调用 bind_events，事件只注册一次
+_bound = False
+
 
 def bind_events():
+    global _bound
+    if _bound:
+        return
+    _bound = True
 
     @event.listens_for(Comment, 'after_insert')
     def record_add_comment(mapper, conn, target):
         """Comment模型插入数据后调用"""
         run_task(_record_add_comment, target)
+        run_task(cache_markup, target.content)
 
     @event.listens_for(TopicLike, 'after_insert')
     def record_like_topic(mapper, conn, target):
@@ -27,12 +45,150 @@ def bind_events():
         """TopicRead模型插入数据事件"""
         run_task(_record_read_topic, target)
 
+    @event.listens_for(Comment, 'after_delete')
+    def record_delete_comment(mapper, conn, target):
+        """Comment模型删除数据事件"""
+        run_task(_record_delete_stat, target.topic_id, 'comments')
+
+    @event.listens_for(TopicLike, 'after_delete')
+    def record_unlike_topic(mapper, conn, target):
+        """TopicLike模型删除数据事件"""
+        run_task(_record_delete_stat, target.topic_id, 'likes')
+        run_task(mark_related_changed, target.topic_id)
+
+    @event.listens_for(TopicRead, 'after_delete')
+    def record_unread_topic(mapper, conn, target):
+        """TopicRead模型删除数据事件"""
+        run_task(_record_delete_stat, target.topic_id, 'reads')
+
+    @event.listens_for(Topic, 'after_insert')
+    def record_add_topic(mapper, conn, target):
+        """Topic新建之后更新标签，缓存渲染的内容"""
+        tags = _public_tags(target.tags, target.status)
+        if tags:
+            run_task(update_topic_tags, target.id, tags)
+        run_task(cache_markup, target.content)
+
+    @event.listens_for(Topic, 'after_update')
+    def record_update_topic(mapper, conn, target):
+        """Topic的内容、标签或者状态变化"""
+        history = get_history(target, 'content')
+        if history.has_changes():
+            # 旧的内容没有加载时，旧的缓存等它自己过期
+            old = history.deleted[0] if history.deleted else None
+            run_task(cache_markup, target.content, old)
+
+        tags = get_history(target, 'tags')
+        status = get_history(target, 'status')
+        if not tags.has_changes() and not status.has_changes():
+            return
+        old_tags = target.tags
+        if tags.has_changes():
+            old_tags = tags.deleted[0] if tags.deleted else None
+        old_status = status.deleted[0] if status.deleted else target.status
+        old = _public_tags(old_tags, old_status)
+        new = _public_tags(target.tags, target.status)
+        if old != new:
+            run_task(update_topic_tags, target.id, new - old, old - new)
+
+    @event.listens_for(Topic, 'after_delete')
+    def record_delete_topic(mapper, conn, target):
+        tags = _public_tags(target.tags, target.status)
+        if tags:
+            run_task(update_topic_tags, target.id, removed=tags)
+        session_writes(target).after_commit(remove_related_topics, target.id)
+
+    @event.listens_for(Cafe, 'after_insert')
+    def record_add_cafe(mapper, conn, target):
+        """Cafe新建之后更新 cafe ID 集合"""
+        names = get_cafe_set_names(target)
+        run_task(update_cafe_sets, target.id, names)
+
+    @event.listens_for(Cafe, 'after_update')
+    def record_update_cafe(mapper, conn, target):
+        """Cafe的状态或者权限变化"""
+        for key in ('status', 'permission'):
+            if get_history(target, key).has_changes():
+                names = get_cafe_set_names(target)
+                run_task(update_cafe_sets, target.id, names)
+                return
+
+    @event.listens_for(Cafe, 'after_delete')
+    def record_delete_cafe(mapper, conn, target):
+        run_task(update_cafe_sets, target.id, set())
+
+    @event.listens_for(CafeTopic, 'after_insert')
+    def record_add_cafe_topic(mapper, conn, target):
+        """CafeTopic发布之后更新 cafe 的主题列表、时间线和热度"""
+        if target.status == CafeTopic.STATUS_PUBLIC:
+            session_writes(target).after_commit(
+                _record_cafe_topic, target.cafe_id, target.topic_id
+            )
+
+    @event.listens_for(CafeTopic, 'after_update')
+    def record_update_cafe_topic(mapper, conn, target):
+        """CafeTopic审核通过或者撤回"""
+        if not get_history(target, 'status').has_changes():
+            return
+        remove = target.status != CafeTopic.STATUS_PUBLIC
+        session_writes(target).after_commit(
+            _record_cafe_topic, target.cafe_id, target.topic_id, remove
+        )
+
+    @event.listens_for(CafeTopic, 'after_delete')
+    def record_delete_cafe_topic(mapper, conn, target):
+        """CafeTopic删除"""
+        session_writes(target).after_commit(
+            _record_cafe_topic, target.cafe_id, target.topic_id, True
+        )
+
+    @event.listens_for(CafeMember, 'after_insert')
+    def record_add_cafe_member(mapper, conn, target):
+        """关注 cafe 之后更新关注集合并重建时间线"""
+        if target.role >= CafeMember.ROLE_SUBSCRIBER:
+            run_task(_record_cafe_member, target.user_id, target.cafe_id, True)
+
+    @event.listens_for(CafeMember, 'after_update')
+    def record_update_cafe_member(mapper, conn, target):
+        """join_cafe、leave_cafe 修改的是 role"""
+        if get_history(target, 'role').has_changes():
+            following = target.role >= CafeMember.ROLE_SUBSCRIBER
+            run_task(
+                _record_cafe_member, target.user_id, target.cafe_id, following
+            )
+
+    @event.listens_for(CafeMember, 'after_delete')
+    def record_delete_cafe_member(mapper, conn, target):
+        run_task(_record_cafe_member, target.user_id, target.cafe_id, False)
+
     @event.listens_for(CommentLike, 'after_insert')
     def record_like_comment(mapper, conn, target):
         """CommentLike模型插入数据事件"""
         run_task(_record_like_comment, target)
 
 
+def _public_tags(tags, status):
+    """草稿的标签不计入标签的主题和数量"""
+    if status == Topic.STATUS_DRAFT:
+        return set()
+    return set(tags or [])
+
+
+def _record_cafe_topic(cafe_id, topic_id, remove=False):
+    """事务提交之后执行，回滚时不会写入 redis"""
+    update_cafe_topics(cafe_id, topic_id, remove)
+    # 移除时 fanout_cafe_topic 需要更新之后的 TOPIC_CAFES
+    link_cafe_topic(cafe_id, topic_id, remove)
+    fanout_cafe_topic(cafe_id, topic_id, remove)
+    if remove:
+        mark_related_changed(topic_id)
+
+
+def _record_cafe_member(user_id, cafe_id, following):
+    CafeMember.update_user_following(user_id, cafe_id, following)
+    reset_timeline(user_id)
+
+
 def _record_add_comment(comment):
     topic = Topic.cache.get(comment.topic_id)
     if not topic:
@@ -43,6 +199,7 @@ def _record_add_comment(comment):
         stat = TopicStat(topic.id)
         stat.increase('comments')
         stat['timestamp'] = time.time()
+        record_hot(topic.id, 'comments')
 
         if topic.user_id != comment.user_id:
             # 如果主题user_id不是评论者，则发送评论通知
@@ -73,6 +230,7 @@ def _record_like_topic(like):
     if not topic:
         return
     TopicStat(topic.id).increase('likes')
+    record_hot(topic.id, 'likes')
 
     if topic.user_id != like.user_id:
         Notification(topic.user_id).add(
@@ -84,6 +242,12 @@ def _record_like_topic(like):
 
 def _record_read_topic(read):
     TopicStat(read.topic_id).increase('reads')
+    record_hot(read.topic_id, 'reads')
+
+
+def _record_delete_stat(topic_id, field):
+    # 完整的重新统计由 reconcile_topic_stats 定时执行
+    TopicStat(topic_id).decrease(field)
 
 
 def _record_like_comment(like):
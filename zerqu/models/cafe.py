@@ -7,6 +7,7 @@ from sqlalchemy import Column
 from sqlalchemy import String, Unicode, DateTime
 from sqlalchemy import SmallInteger, Integer
 from zerqu.libs.utils import EMPTY
+from zerqu.libs.cache import redis, run_script
 from .base import db, Base, JSON
 
 __all__ = ['Cafe', 'CafeMember', 'CafeTopic']
@@ -14,6 +15,8 @@ __all__ = ['Cafe', 'CafeMember', 'CafeTopic']
 
 class Cafe(Base):
     __tablename__ = 'zq_cafe'
+    __cache_local__ = 500
+    __cache_lookups__ = ('slug',)
 
     # ### Cafe状态 ###
     STATUSES = {
@@ -159,6 +162,7 @@ class Cafe(Base):
 class CafeMember(Base):
     """Cafe成员关联表"""
     __tablename__ = 'zq_cafe_member'
+    __cache_counters__ = ('cafe_id',)
 
     # ### 成员角色 ###
     # not joined, but has topics or comments in this cafe
@@ -177,6 +181,9 @@ class CafeMember(Base):
         ROLE_ADMIN: 'admin',
     }
 
+    # 用户关注的 cafe ID 集合，由 CafeMember 的事件维护，0 是占位成员
+    FOLLOWING_KEY = 'cafe_member:following:{}'
+
     cafe_id = Column(Integer, primary_key=True, autoincrement=False)
     user_id = Column(Integer, primary_key=True, autoincrement=False)
     role = Column('role', SmallInteger, default=ROLE_VISITOR)
@@ -214,10 +221,41 @@ class CafeMember(Base):
 
     @classmethod
     def get_user_following_cafe_ids(cls, user_id):
-        # TODO: cache
+        rv = redis.smembers(cls.FOLLOWING_KEY.format(user_id))
+        if not rv:
+            return cls.rebuild_user_following(user_id)
+        rv = {int(i) for i in rv}
+        rv.discard(0)
+        return rv
+
+    @classmethod
+    def ensure_user_following(cls, user_id):
+        """集合不存在时从数据库重建，返回集合的 key"""
+        key = cls.FOLLOWING_KEY.format(user_id)
+        if not redis.exists(key):
+            cls.rebuild_user_following(user_id)
+        return key
+
+    @classmethod
+    def rebuild_user_following(cls, user_id):
         q = db.session.query(cls.cafe_id).filter_by(user_id=user_id)
         q = q.filter(cls.role >= cls.ROLE_SUBSCRIBER)
-        return {cafe_id for cafe_id, in q}
+        rv = {cafe_id for cafe_id, in q}
+        key = cls.FOLLOWING_KEY.format(user_id)
+        with redis.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.sadd(key, 0, *rv)
+            pipe.execute()
+        return rv
+
+    @classmethod
+    def update_user_following(cls, user_id, cafe_id, following):
+        """关注或者取消关注，集合不存在时等读取时重建"""
+        key = cls.FOLLOWING_KEY.format(user_id)
+        if following:
+            run_script('sadd_if_exists', keys=[key], args=[cafe_id])
+        else:
+            redis.srem(key, cafe_id)
 
     @classmethod
     def get_cafe_admin_ids(cls, cafe_id):
@@ -229,6 +267,7 @@ class CafeMember(Base):
 class CafeTopic(Base):
     """Cafe主题关联表"""
     __tablename__ = 'zq_cafe_topic'
+    __cache_counters__ = ('cafe_id',)
 
     # ### 主题状态 ###
     STATUS_DRAFT = 0
@@ -0,0 +1,140 @@
+# coding: utf-8
+"""
+    zerqu.models.codec
+    ~~~~~~~~~~~~~~~~~~
+
+    模型缓存的序列化。只保存按列排列的值，并带上表结构指纹，
+    读取时重建一个 detached 实例；指纹不一致就当作没有命中。
+"""
+
+import zlib
+import struct
+import pickle
+import datetime
+from flask import current_app
+from sqlalchemy.orm import class_mapper, make_transient_to_detached
+from werkzeug.utils import import_string
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['dump_row', 'load_row', 'codecs']
+
+# 编码格式有变化时修改这个值，旧缓存会全部失效
+CODEC_VERSION = 1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EXT_DATETIME = 1
+
+
+class ModelSchema(object):
+    """模型的列信息和指纹"""
+
+    def __init__(self, model):
+        mapper = class_mapper(model)
+        self.mapper = mapper
+        self.keys = tuple(prop.key for prop in mapper.column_attrs)
+
+        columns = ['%s:%s' % (prop.key, prop.columns[0].type)
+                   for prop in mapper.column_attrs]
+        text = '%d|%s|%s' % (
+            CODEC_VERSION, model.__tablename__, ','.join(columns)
+        )
+        self.fingerprint = zlib.crc32(text.encode('utf-8')) & 0xffffffff
+
+    def values(self, obj):
+        d = obj.__dict__
+        return [d.get(key) for key in self.keys]
+
+    def build(self, values):
+        obj = self.mapper.class_manager.new_instance()
+        obj.__dict__.update(zip(self.keys, values))
+        make_transient_to_detached(obj)
+        return obj
+
+
+_schemas = {}
+
+
+def get_schema(model):
+    rv = _schemas.get(model)
+    if rv is None:
+        rv = _schemas[model] = ModelSchema(model)
+    return rv
+
+
+class PickleCodec(object):
+    """不依赖 msgpack 的实现，只 pickle 列的值，不包括实例状态"""
+
+    @staticmethod
+    def encode(fingerprint, values):
+        return pickle.dumps((fingerprint, values), pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(data):
+        return pickle.loads(data)
+
+
+def _pack_ext(o):
+    if isinstance(o, datetime.datetime):
+        delta = o - EPOCH
+        n = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return msgpack.ExtType(EXT_DATETIME, struct.pack('>q', n))
+    raise TypeError('Can not pack %r' % o)
+
+
+def _unpack_ext(code, data):
+    if code == EXT_DATETIME:
+        n = struct.unpack('>q', data)[0]
+        return EPOCH + datetime.timedelta(microseconds=n)
+    return msgpack.ExtType(code, data)
+
+
+class MsgpackCodec(object):
+    """msgpack 数组：``[fingerprint, value1, value2, ...]``"""
+
+    @staticmethod
+    def encode(fingerprint, values):
+        values.insert(0, fingerprint)
+        return msgpack.packb(values, default=_pack_ext, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        values = msgpack.unpackb(data, ext_hook=_unpack_ext, raw=False)
+        return values[0], values[1:]
+
+
+codecs = {
+    'pickle': PickleCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def use_codec():
+    name = current_app.config.get('ZERQU_MODEL_CODEC', 'msgpack')
+    if name == 'msgpack' and msgpack is None:
+        name = 'pickle'
+    if name in codecs:
+        return codecs[name]
+    return import_string(name)
+
+
+def dump_row(obj):
+    """把模型实例编码成 bytes"""
+    schema = get_schema(type(obj))
+    return use_codec().encode(schema.fingerprint, schema.values(obj))
+
+
+def load_row(model, data):
+    """从 bytes 重建模型实例，格式或表结构不一致时返回 None"""
+    if not data:
+        return None
+    schema = get_schema(model)
+    try:
+        fingerprint, values = use_codec().decode(data)
+    except Exception:
+        return None
+    if fingerprint != schema.fingerprint:
+        return None
+    return schema.build(values)
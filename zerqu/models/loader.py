@@ -0,0 +1,173 @@
+# coding: utf-8
+"""
+    zerqu.models.loader
+    ~~~~~~~~~~~~~~~~~~~
+
+    请求内的批量读取。先用 ``want`` 登记需要的数据，第一次读取时把登记过的
+    所有 key 合并成一次 MGET，没命中的每个模型一次 ``IN`` 查询；
+    ``RedisStat`` 的数据合并到一个 pipeline 里。
+
+    读过的数据保存在 identity map 里，同一个请求里重复读取不再访问 redis。
+"""
+
+from collections import OrderedDict, defaultdict
+from flask import request, has_request_context
+from sqlalchemy import tuple_
+from sqlalchemy.orm import class_mapper
+from zerqu.libs.cache import redis, record_cache, timing
+from .base import db, TOMBSTONE
+from .base import load_cache_multi, store_cache, store_tombstones
+from .base import restore_stats
+
+__all__ = ['Loader', 'current_loader']
+
+
+def _suffix(ident):
+    if isinstance(ident, (list, tuple)):
+        return '-'.join(map(str, ident))
+    return str(ident)
+
+
+class Loader(object):
+    def __init__(self):
+        # cache key -> 模型实例，不存在的是 None
+        self.identity = {}
+        # cache key -> (model, ident)
+        self.pending = OrderedDict()
+        # (redis 命令, key) -> 结果，例如 RedisStat 的 hgetall
+        self.values = {}
+        self.pending_values = set()
+
+    def want(self, model, idents):
+        """登记需要读取的数据，等到下一次读取时一起处理"""
+        prefix = model.generate_cache_prefix('get')
+        for ident in idents:
+            key = prefix + _suffix(ident)
+            if key not in self.identity:
+                self.pending[key] = (model, ident)
+        return self
+
+    def want_redis(self, command, keys):
+        """登记只读的 redis 命令，例如 ``hgetall``、``pfcount``"""
+        for key in keys:
+            if (command, key) not in self.values:
+                self.pending_values.add((command, key))
+        return self
+
+    def want_stats(self, stat_cls, idents):
+        keys = [stat_cls.KEY_PREFIX.format(i) for i in idents]
+        return self.want_redis('hgetall', keys)
+
+    def forget(self, key):
+        self.identity.pop(key, None)
+
+    def get(self, model, ident):
+        key = model.generate_cache_prefix('get') + _suffix(ident)
+        if key not in self.identity:
+            self.want(model, [ident])
+            self.resolve()
+        return self.identity.get(key)
+
+    def get_dict(self, model, idents):
+        """和 ``CacheQuery.get_dict`` 一样，没有的数据值为 None"""
+        self.want(model, idents)
+        self.resolve()
+        prefix = model.generate_cache_prefix('get')
+        rv = {}
+        for ident in idents:
+            suffix = _suffix(ident)
+            rv[suffix] = self.identity.get(prefix + suffix)
+        return rv
+
+    def redis_dict(self, command, keys):
+        self.want_redis(command, keys)
+        self.resolve()
+        return {key: self.values[(command, key)] for key in keys}
+
+    def stat_dict(self, stat_cls, idents):
+        """和 ``RedisStat.get_dict`` 一样"""
+        keys = [stat_cls.KEY_PREFIX.format(i) for i in idents]
+        rv = self.redis_dict('hgetall', keys)
+        values = [rv[key] for key in keys]
+        if stat_cls.SNAPSHOT:
+            restore_stats(stat_cls, idents, values)
+            for key, value in zip(keys, values):
+                self.values[('hgetall', key)] = value
+        return dict(zip(idents, values))
+
+    def resolve(self):
+        """处理所有登记过的数据"""
+        if self.pending_values:
+            pending = list(self.pending_values)
+            self.pending_values = set()
+            with redis.pipeline() as pipe:
+                for command, key in pending:
+                    getattr(pipe, command)(key)
+                self.values.update(zip(pending, pipe.execute()))
+
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = OrderedDict()
+        with timing('loader', 'resolve'):
+            self._resolve(pending)
+
+    def _resolve(self, pending):
+        rv = load_cache_multi({k: pending[k][0] for k in pending})
+        counts = defaultdict(lambda: defaultdict(int))
+        missed = defaultdict(dict)
+        for key in pending:
+            model, ident = pending[key]
+            value = rv.get(key)
+            if value is None:
+                missed[model][key] = ident
+                result = 'miss'
+            elif value is TOMBSTONE:
+                self.identity[key] = None
+                result = 'nil'
+            else:
+                self.identity[key] = value
+                result = 'hit'
+            counts[model.__tablename__][result] += 1
+            counts[model.__tablename__]['calls'] += 1
+
+        for name in counts:
+            for result in counts[name]:
+                record_cache(name, 'get_dict', result, counts[name][result])
+
+        for model in missed:
+            self._query(model, missed[model])
+
+    def _query(self, model, missed):
+
+        primary_key = class_mapper(model).primary_key
+        if len(primary_key) == 1:
+            clause = primary_key[0].in_(list(missed.values()))
+        else:
+            clause = tuple_(*primary_key).in_(
+                [tuple(i) for i in missed.values()]
+            )
+
+        prefix = model.generate_cache_prefix('get')
+        to_cache = {}
+        for item in db.session.query(model).filter(clause):
+            ident = [getattr(item, k.name) for k in primary_key]
+            to_cache[prefix + _suffix(ident)] = item
+
+        store_cache(model, to_cache)
+        self.identity.update(to_cache)
+
+        nils = [key for key in missed if key not in to_cache]
+        store_tombstones(model, nils)
+        for key in nils:
+            self.identity[key] = None
+
+
+def current_loader():
+    """当前请求的批量读取器，不在请求内时返回 None"""
+    if not has_request_context():
+        return None
+    loader = getattr(request, '_zerqu_loader', None)
+    if loader is None:
+        loader = request._zerqu_loader = Loader()
+    return loader
@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+    zerqu.models.serializer
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    API 响应的序列化。每个模型按 ``keys()`` 编译一个函数直接读取属性，
+    时间列直接格式化成 ``%Y-%m-%dT%H:%M:%SZ``，不用再经过 ``dict(o)``
+    和 ``JSONEncoder.default``。``jsonify`` 用 ``ZERQU_JSON_BACKEND``
+    输出 bytes，默认是 simplejson，没有安装时用标准库。
+"""
+
+import re
+import json
+import datetime
+from flask import current_app, request
+from sqlalchemy import DateTime
+from sqlalchemy.orm import class_mapper
+from werkzeug.utils import import_string
+from .base import Base
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+__all__ = ['dump_model', 'dumps', 'jsonify', 'serializers']
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# 模型 -> 编译好的函数
+serializers = {}
+
+
+def format_datetime(d):
+    """和 ``d.strftime('%Y-%m-%dT%H:%M:%SZ')`` 一样，但是快很多"""
+    if d is None:
+        return None
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        d.year, d.month, d.day, d.hour, d.minute, d.second
+    )
+
+
+def compile_serializer(model, keys):
+    """生成 ``lambda o: {'id': o.id, 'created_at': _dt(o.created_at)}``
+
+    ``keys()`` 对同一个模型必须是固定的。
+    """
+    mapper = class_mapper(model)
+    dates = {
+        prop.key for prop in mapper.column_attrs
+        if isinstance(prop.columns[0].type, DateTime)
+    }
+    items = []
+    for key in keys:
+        if IDENTIFIER.match(key):
+            value = 'o.%s' % key
+        else:
+            value = 'getattr(o, %r)' % key
+        if key in dates:
+            value = '_dt(%s)' % value
+        items.append('%r: %s' % (key, value))
+    source = 'lambda o: {%s}' % ', '.join(items)
+    code = compile(source, '<serializer %s>' % model.__name__, 'eval')
+    return eval(code, {'_dt': format_datetime})
+
+
+def dump_model(o):
+    """模型转换成可以直接 JSON 序列化的 dict"""
+    cls = type(o)
+    func = serializers.get(cls)
+    if func is None:
+        func = serializers[cls] = compile_serializer(cls, tuple(o.keys()))
+    return func(o)
+
+
+def default(o):
+    """给 JSON 后端的 ``default``，只有不认识的类型才会调用"""
+    if isinstance(o, Base):
+        return dump_model(o)
+    if hasattr(o, 'keys') and hasattr(o, '__getitem__'):
+        return dict(o)
+    if isinstance(o, datetime.datetime):
+        return format_datetime(o)
+    raise TypeError('%r is not JSON serializable' % o)
+
+
+backends = {
+    'json': json,
+    'simplejson': simplejson,
+}
+
+
+def use_backend():
+    name = current_app.config.get('ZERQU_JSON_BACKEND', 'simplejson')
+    if name in backends:
+        return backends[name] or json
+    return import_string(name)
+
+
+def dumps(data, indent=None):
+    """序列化成 bytes，后端需要支持 ``default`` 参数"""
+    config = current_app.config
+    if indent:
+        separators = (',', ': ')
+    else:
+        separators = (',', ':')
+    rv = use_backend().dumps(
+        data, default=default, indent=indent, separators=separators,
+        sort_keys=config.get('JSON_SORT_KEYS', False),
+        ensure_ascii=config.get('JSON_AS_ASCII', True),
+    )
+    if not isinstance(rv, bytes):
+        rv = rv.encode('utf-8')
+    return rv
+
+
+def jsonify(*args, **kwargs):
+    """和 ``flask.jsonify`` 用法一样，``jsonify(model)`` 直接序列化模型"""
+    if len(args) == 1 and not kwargs:
+        data = args[0]
+    else:
+        data = dict(*args, **kwargs)
+    indent = None
+    pretty = current_app.config.get('JSONIFY_PRETTYPRINT_REGULAR')
+    if pretty and not request.is_xhr:
+        indent = 2
+    return current_app.response_class(
+        dumps(data, indent), mimetype='application/json',
+    )
@@ -1,22 +1,31 @@
 # coding: utf-8
 
+import time
 import datetime
 from collections import defaultdict
 from flask import current_app
 from sqlalchemy import func
-from sqlalchemy import Column
+from sqlalchemy import Column, Index
+from sqlalchemy.orm import column_property
 from sqlalchemy import String, Unicode, DateTime
 from sqlalchemy import SmallInteger, Integer, UnicodeText
-from zerqu.libs.cache import cache, redis
+from zerqu.libs.cache import redis
 from zerqu.libs.renderer import markup
 from .webpage import WebPage
 from .utils import current_user
-from .base import db, Base, JSON, ARRAY, CACHE_TIMES, RedisStat
+from .base import db, Base, JSON, ARRAY, RedisStat
+from .base import get_loader, use_stat_buffer
+from .loader import current_loader
+from .user import User
 
 
 class Topic(Base):
     """主题"""
     __tablename__ = 'zq_topic'
+    __table_args__ = (
+        Index('ix_zq_topic_tags', 'tags', postgresql_using='gin'),
+    )
+    __cache_local__ = 2000
 
     # ### 主题状态 ###
     STATUS_DRAFT = 0
@@ -38,7 +47,8 @@ class Topic(Base):
     content = Column(UnicodeText, default=u'')
 
     user_id = Column(Integer, nullable=False, index=True)
-    tags = Column(ARRAY(String))
+    # 修改时读取旧的值，事件里需要知道删除了哪些标签
+    tags = column_property(Column(ARRAY(String)), active_history=True)
 
     status = Column(SmallInteger, default=STATUS_PUBLIC)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -94,9 +104,17 @@ class Topic(Base):
         return markup(self.content)
 
     def get_statuses(self, user_id=None):
-        status = TopicStat(self.id) or {}
+        loader = get_loader()
+        key = (self.id, user_id)
+        if user_id:
+            # 和统计数据一起读取
+            loader.want(TopicLike, [key]).want(TopicRead, [key])
+        uv = TopicStat.UV_PREFIX.format(self.id)
+        loader.want_redis('pfcount', [uv])
+        status = loader.stat_dict(TopicStat, [self.id])[self.id]
         rv = {
             'view_count': int(status.get('views', 0)),
+            'unique_view_count': loader.redis_dict('pfcount', [uv])[uv],
             'like_count': int(status.get('likes', 0)),
             'comment_count': int(status.get('comments', 0)),
             'read_count': int(status.get('reads', 0)),
@@ -104,9 +122,8 @@ class Topic(Base):
         if not user_id:
             return rv
 
-        key = (self.id, user_id)
-        rv['liked_by_me'] = bool(TopicLike.cache.get(key))
-        read = TopicRead.cache.get(key)
+        rv['liked_by_me'] = bool(loader.get(TopicLike, key))
+        read = loader.get(TopicRead, key)
         if read:
             rv['read_by_me'] = read.percent
         else:
@@ -121,6 +138,45 @@ class TopicStat(RedisStat):
     """主题状态"""
     KEY_PREFIX = 'topic_stat:{}'
     TOPIC_FLAGS = 'topic_flags'
+    SNAPSHOT = True
+    SNAPSHOT_REPLACE = ('timestamp',)
+    # 独立访客的 HyperLogLog，每个约 12KB，另外按天保存一份
+    UV_PREFIX = 'topic_uv:{}'
+    UV_DAILY_EXPIRES = 31 * 86400
+
+    def add_viewer(self, visitor, buffered=False):
+        """记录一个访客，``visitor`` 是用户 ID 或者 IP 的摘要"""
+        total = self.UV_PREFIX.format(self.ident)
+        today = '%s:%s' % (total, time.strftime('%Y%m%d', time.gmtime()))
+        buf = buffered and use_stat_buffer()
+        if buf:
+            buf.add(('pfadd', total, visitor))
+            buf.add(('pfadd', today, visitor))
+            buf.add(('expire', today, self.UV_DAILY_EXPIRES))
+            return
+        with redis.pipeline() as pipe:
+            pipe.pfadd(total, visitor)
+            pipe.pfadd(today, visitor)
+            pipe.expire(today, self.UV_DAILY_EXPIRES)
+            pipe.execute()
+
+    def unique_views(self, days=None):
+        """独立访客数量，``days`` 为最近几天（包括今天），合并每天的数据"""
+        total = self.UV_PREFIX.format(self.ident)
+        if not days:
+            return redis.pfcount(total)
+        now = time.time()
+        keys = ['%s:%s' % (total, time.strftime(
+            '%Y%m%d', time.gmtime(now - i * 86400)
+        )) for i in range(days)]
+        # redis-py 2.10 的 pfcount 只接受一个键
+        return redis.execute_command('PFCOUNT', *keys)
+
+    @classmethod
+    def restored(cls, pipe, ident, data):
+        # topic_flags 由 hash 里的 flags 恢复
+        if data.get('flags'):
+            pipe.zincrby(cls.TOPIC_FLAGS, ident, data['flags'])
 
     def flag(self):
         with redis.pipeline() as pipe:
@@ -128,6 +184,13 @@ class TopicStat(RedisStat):
             pipe.zincrby(self.TOPIC_FLAGS, self.ident)
             pipe.execute()
 
+    def resolve_flags(self):
+        """处理完举报，移出 topic_flags 并清零 flags，返回是否在队列里"""
+        with redis.pipeline() as pipe:
+            pipe.zrem(self.TOPIC_FLAGS, self.ident)
+            pipe.hset(self._key, 'flags', 0)
+            return bool(pipe.execute()[0])
+
     def keys(self):
         return (
             'views', 'reads', 'flags', 'likes',
@@ -148,6 +211,7 @@ class TopicStat(RedisStat):
 class TopicLike(Base):
     """喜欢的主题关联表"""
     __tablename__ = 'zq_topic_like'
+    __cache_counters__ = ('topic_id',)
 
     topic_id = Column(Integer, primary_key=True, autoincrement=False)
     user_id = Column(Integer, primary_key=True, autoincrement=False)
@@ -196,6 +260,10 @@ class TopicRead(Base):
 class Comment(Base):
     """评论"""
     __tablename__ = 'zq_comment'
+    __cache_counters__ = ('topic_id',)
+
+    # 被举报的评论，分数是举报次数
+    FLAGS_KEY = 'comment_flags'
 
     id = Column(Integer, primary_key=True)
     content = Column(UnicodeText, nullable=False)
@@ -231,12 +299,25 @@ class Comment(Base):
             'created_at', 'updated_at', 'flag_count', 'like_count',
         )
 
-    def reset_like_count(self):
-        """重置like计数"""
-        q = CommentLike.query.filter_by(comment_id=self.id)
-        self.like_count = q.with_entities(func.count(1)).scalar()
-        db.session.add(self)
-        return self.like_count
+    @classmethod
+    def flag(cls, cid):
+        with db.auto_commit():
+            cls.increase_column(cid, 'flag_count')
+        redis.zincrby(cls.FLAGS_KEY, cid)
+
+    @classmethod
+    def resolve_flags(cls, cid):
+        """处理完举报，移出 comment_flags 并清零 flag_count，
+        返回是否在队列里"""
+        # ZREM 只有一个请求会成功
+        if not redis.zrem(cls.FLAGS_KEY, cid):
+            return False
+        comment = cls.query.get(cid)
+        if comment:
+            comment.flag_count = 0
+            with db.auto_commit():
+                db.session.add(comment)
+        return True
 
     @staticmethod
     def get_multi_statuses(comment_ids, user_id):
@@ -263,39 +344,40 @@ class CommentLike(Base):
 
     @classmethod
     def comments_liked_by_user(cls, user_id, comment_ids):
-        return fetch_current_user_items(
-            cls, user_id, comment_ids, key='comment_id'
-        )
+        return fetch_current_user_items(cls, user_id, comment_ids)
 
 ####################################################################
 
 
-def fetch_current_user_items(cls, user_id, ref_ids, key='topic_id'):
+def fetch_current_user_items(cls, user_id, ref_ids):
+    """读取当前用户和这些数据的关联，``cls`` 的主键是 ``(ref_id, user_id)``
+
+    大部分主题当前用户都没有喜欢过，不存在的标记同样会缓存，
+    返回值包含所有 ``ref_ids``，没有关联的是 ``None``。
+    """
     if not ref_ids:
         return {}
+    rv = get_loader().get_dict(cls, [(i, user_id) for i in ref_ids])
+    return {k.split('-')[0]: rv[k] for k in rv}
 
-    prefix = cls.generate_cache_prefix('get')
-
-    def gen_key(tid):
-        return prefix + '-'.join(map(str, [tid, user_id]))
 
-    def get_key(key):
-        return key.lstrip(prefix).split('-')[0]
+def prefetch_topics(topics, user_id=None):
+    """登记主题列表需要的用户、统计和当前用户状态，之后一起读取
 
-    rv = cache.get_dict(*[gen_key(tid) for tid in ref_ids])
-    missed = {i for i in ref_ids if rv[gen_key(i)] is None}
-    rv = {get_key(k): rv[k] for k in rv}
-    if not missed:
-        return rv
-
-    to_cache = {}
-    q = cls.cache.filter_by(user_id=user_id)
-    for item in q.filter(getattr(cls, key).in_(missed)):
-        rv[str(getattr(item, key))] = item
-        to_cache[gen_key(getattr(item, key))] = item
-
-    cache.set_many(to_cache, CACHE_TIMES['get'])
-    return rv
+    :param topics: A list of topic instances.
+    :param user_id: Current user ID.
+    """
+    loader = current_loader()
+    if loader is None or not topics:
+        return
+    tids = [t.id for t in topics]
+    loader.want(User, {t.user_id for t in topics})
+    loader.want_stats(TopicStat, tids)
+    loader.want_redis('pfcount', [TopicStat.UV_PREFIX.format(i) for i in tids])
+    if user_id:
+        idents = [(tid, user_id) for tid in tids]
+        loader.want(TopicLike, idents)
+        loader.want(TopicRead, idents)
 
 
 def iter_topics_with_statuses(topics, user_id):
@@ -305,7 +387,11 @@ def iter_topics_with_statuses(topics, user_id):
     :param user_id: Current user ID.
     """
     tids = [t['id'] for t in topics]
-    stats = TopicStat.get_dict(tids)
+    loader = get_loader()
+    uv_keys = {tid: TopicStat.UV_PREFIX.format(tid) for tid in tids}
+    loader.want_redis('pfcount', uv_keys.values())
+    stats = loader.stat_dict(TopicStat, tids)
+    uvs = loader.redis_dict('pfcount', uv_keys.values())
 
     if user_id:
         liked = TopicLike.topics_liked_by_user(user_id, tids)
@@ -318,6 +404,7 @@ def iter_topics_with_statuses(topics, user_id):
         tid = t['id']
         status = stats.get(tid, {})
         t['view_count'] = int(status.get('views', 0))
+        t['unique_view_count'] = uvs[uv_keys[tid]]
         t['like_count'] = int(status.get('likes', 0))
         t['comment_count'] = int(status.get('comments', 0))
         t['read_count'] = int(status.get('reads', 0))
@@ -330,3 +417,70 @@ def iter_topics_with_statuses(topics, user_id):
             if read:
                 t['read_by_me'] = read.percent
         yield t
+
+
+def reconcile_topic_stats(start=None, end=None, batch_size=1000):
+    """用 ``GROUP BY topic_id`` 重新统计 likes、reads、comments，
+    分批写回 ``TopicStat``
+
+    主题和三个统计查询都按 ``topic_id`` 排序，用服务端游标一起遍历。
+    每写完一批返回一次 ``(已处理数量, 有偏差的数量, 最后一个主题 ID)``。
+
+    :param start: 从这个主题 ID 开始（包括）
+    :param end: 到这个主题 ID 结束（不包括）
+    """
+    def stream(q, column):
+        if start is not None:
+            q = q.filter(column >= start)
+        if end is not None:
+            q = q.filter(column < end)
+        q = q.order_by(column).execution_options(stream_results=True)
+        return iter(q.yield_per(batch_size))
+
+    topics = stream(db.session.query(Topic.id), Topic.id)
+    counters = []
+    for field, model in (('likes', TopicLike), ('reads', TopicRead),
+                         ('comments', Comment)):
+        q = db.session.query(model.topic_id, func.count(1))
+        q = q.group_by(model.topic_id)
+        counters.append((field, stream(q, model.topic_id)))
+    heads = [next(rows, None) for _, rows in counters]
+
+    batch = []
+    done = drifted = 0
+    for tid, in topics:
+        values = {}
+        for i, (field, rows) in enumerate(counters):
+            while heads[i] is not None and heads[i][0] < tid:
+                heads[i] = next(rows, None)
+            head = heads[i]
+            values[field] = head[1] if head and head[0] == tid else 0
+        batch.append((tid, values))
+
+        if len(batch) >= batch_size:
+            drifted += _write_topic_stats(batch)
+            done += len(batch)
+            yield done, drifted, tid
+            batch = []
+
+    if batch:
+        drifted += _write_topic_stats(batch)
+        done += len(batch)
+        yield done, drifted, batch[-1][0]
+
+
+def _write_topic_stats(batch):
+    """写回一批统计，返回和原来不一致的数量"""
+    fields = ('likes', 'reads', 'comments')
+    # 先从快照恢复，否则之后恢复时会累加到重新统计的数据上
+    current = TopicStat.get_many([tid for tid, _ in batch])
+
+    drifted = 0
+    with redis.pipeline(transaction=False) as pipe:
+        for (tid, values), old in zip(batch, current):
+            old = [int(old.get(k, 0)) for k in fields]
+            if old != [values[k] for k in fields]:
+                drifted += 1
+                pipe.hmset(TopicStat.KEY_PREFIX.format(tid), values)
+        pipe.execute()
+    return drifted
@@ -6,19 +6,19 @@ import datetime
 from flask import request, session, current_app
 from werkzeug.utils import cached_property
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import event
 from sqlalchemy import Column
 from sqlalchemy import String, Unicode, DateTime
 from sqlalchemy import SmallInteger, Integer
-from sqlalchemy.orm.attributes import get_history
-from zerqu.libs.cache import cache, redis
-from .base import db, Base
+from zerqu.libs.cache import redis
+from .base import Base
 
 __all__ = ['User', 'UserSession']
 
 
 class User(Base):
     __tablename__ = 'zq_user'
+    __cache_local__ = 2000
+    __cache_lookups__ = ('username', 'email')
 
     # 角色标识
     ROLE_SUPER = 9      # 超级管理员
@@ -99,23 +99,6 @@ class User(Base):
         self._avatar_url = url
 
 
-@event.listens_for(User, 'after_update')  # 注册 User 更新之后事件
-def receive_user_after_update(mapper, conn, target):
-    if target not in db.session.dirty:
-        return
-
-    to_delete = []
-
-    prefix = target.generate_cache_prefix('ff')  # 生成 filter_first 缓存前缀
-    for key in ['username', 'email']:
-        state = get_history(target, key)
-        for value in state.deleted:
-            to_delete.append('%s%s$%s' % (prefix, key, value))
-
-    if to_delete:
-        cache.delete_many(*to_delete)
-
-
 class UserSession(object):
     KEY_PREFIX = 'user_session:{}'
 
@@ -4,6 +4,7 @@ from werkzeug.local import LocalProxy
 from zerqu.libs.utils import Empty
 from .auth import oauth
 from .user import User, UserSession
+from .serializer import dump_model
 
 
 class Anonymous(Empty):
@@ -44,10 +45,10 @@ def iter_items_with_users(items, users=None):
     if not users:
         users = User.cache.get_dict([o.user_id for o in items])
     for item in items:
-        data = dict(item)
+        data = dump_model(item)
         user = users.get(str(item.user_id))
         if user:
-            data['user'] = dict(user)
+            data['user'] = dump_model(user)
         yield data
 
 
@@ -0,0 +1,146 @@
+# coding: utf-8
+"""
+    zerqu.rec.popularity
+    ~~~~~~~~~~~~~~~~~~~~
+
+    主题热度，保存在 redis 有序集合里。
+
+    每次喜欢、评论、阅读、浏览都给主题增加 ``weight * 2 ^ (t / half_life)``，
+    ``t`` 是距离这个有序集合 epoch 的时间，这样旧的分数不需要修改就相当于
+    按半衰期衰减了。分数会随时间变大，由 ``decay_hot_scores`` 定时把 epoch
+    移到当前时间并且按比例缩小。
+"""
+
+import time
+from functools import partial
+from flask import current_app
+from zerqu.models import Topic
+from zerqu.libs.cache import redis, run_script, zset_page, LUA_SCRIPTS
+from zerqu.libs.utils import PeriodicBuffer, to_str
+
+# 所有主题的热度
+HOT_KEY = 'hot:topics'
+# 每个 cafe 的热度
+HOT_CAFE_KEY = 'hot:cafe:{}'
+# 每个有序集合的 epoch
+HOT_EPOCHS = 'hot:epochs'
+# 主题所在的公开 cafe，热度增加时同时增加这些 cafe 的有序集合，
+# 为空时不增加热度
+TOPIC_CAFES = 'hot:topic_cafes:{}'
+
+WEIGHTS = {
+    'views': 0.1,
+    'reads': 0.5,
+    'comments': 2,
+    'likes': 3,
+    # 主题发布到 cafe 时的初始热度
+    'created': 5,
+}
+
+
+def _hot_keys(topic_id):
+    return [HOT_EPOCHS, TOPIC_CAFES.format(topic_id), HOT_KEY]
+
+
+def _hot_args(topic_id, weight, half_life):
+    prefix = HOT_CAFE_KEY.format('')
+    return [topic_id, weight, time.time(), half_life, prefix]
+
+
+def record_hot(topic_id, field, step=1, buffered=False):
+    """按 ``WEIGHTS`` 增加主题的热度
+
+    :param buffered: 先在进程内累加，和 ``RedisStat`` 的缓冲一样
+    """
+    weight = WEIGHTS[field] * step
+    buf = buffered and use_hot_buffer()
+    if buf:
+        buf.add(topic_id, weight)
+        return
+    half_life = current_app.config.get('ZERQU_HOT_HALF_LIFE', 86400)
+    args = _hot_args(topic_id, weight, half_life)
+    run_script('hot_incr', keys=_hot_keys(topic_id), args=args)
+
+
+def use_hot_buffer():
+    config = current_app.config
+    interval = config.get('ZERQU_STAT_BUFFER_INTERVAL')
+    if not interval:
+        return None
+    rv = current_app.extensions.get('zerqu_hot_buffer')
+    if rv is None:
+        client = current_app.extensions['zerqu_redis']
+        # 在定时器线程里执行，不能用 run_script
+        script = client.register_script(LUA_SCRIPTS['hot_incr'])
+        half_life = config.get('ZERQU_HOT_HALF_LIFE', 86400)
+        size = config.get('ZERQU_STAT_BUFFER_SIZE', 1000)
+        flush = partial(_flush_hot, client, script, half_life)
+        rv = PeriodicBuffer(flush, interval / 1000.0, size)
+        current_app.extensions['zerqu_hot_buffer'] = rv
+    return rv
+
+
+def _flush_hot(client, script, half_life, data):
+    with client.pipeline(transaction=False) as pipe:
+        for topic_id, weight in data.items():
+            args = _hot_args(topic_id, weight, half_life)
+            script(keys=_hot_keys(topic_id), args=args, client=pipe)
+        pipe.execute()
+
+
+def link_cafe_topic(cafe_id, topic_id, remove=False):
+    """主题发布到 cafe 或者从 cafe 移除
+
+    不在任何公开的 cafe 里之后也从全站的热度里移除。
+    """
+    key = TOPIC_CAFES.format(topic_id)
+    if remove:
+        with redis.pipeline() as pipe:
+            pipe.srem(key, cafe_id)
+            pipe.zrem(HOT_CAFE_KEY.format(cafe_id), topic_id)
+            pipe.scard(key)
+            left = pipe.execute()[-1]
+        if not left:
+            redis.zrem(HOT_KEY, topic_id)
+        return
+    redis.sadd(key, cafe_id)
+    record_hot(topic_id, 'created')
+
+
+def get_hot_topics(cursor=None, count=20, cafe_id=None):
+    """按热度从高到低读取主题，cursor 的格式见 ``zset_page``
+
+    格式不对时抛出 ``ValueError``。
+    """
+    if cafe_id:
+        key = HOT_CAFE_KEY.format(cafe_id)
+    else:
+        key = HOT_KEY
+    rv, cursor = zset_page(key, cursor, count)
+    topics = Topic.cache.get_many([int(i) for i, _ in rv])
+    return topics, cursor
+
+
+def decay_hot_scores(batch_size=1000):
+    """把所有热度有序集合的 epoch 移到当前时间，返回处理的数量"""
+    config = current_app.config
+    half_life = config.get('ZERQU_HOT_HALF_LIFE', 86400)
+    size = config.get('ZERQU_HOT_SIZE', 10000)
+    minimum = config.get('ZERQU_HOT_MIN_SCORE', 0.01)
+    keys = {HOT_KEY}
+    cursor = 0
+    while True:
+        cursor, rv = redis.hscan(HOT_EPOCHS, cursor, count=batch_size)
+        keys.update(to_str(k) for k in rv)
+        if not int(cursor):
+            break
+
+    now = time.time()
+    with redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            run_script(
+                'hot_rebase', keys=[HOT_EPOCHS, key],
+                args=[now, half_life, size, minimum], client=pipe,
+            )
+        pipe.execute()
+    return len(keys)
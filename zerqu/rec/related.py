@@ -0,0 +1,229 @@
+# coding: utf-8
+"""
+    zerqu.rec.related
+    ~~~~~~~~~~~~~~~~~
+
+    离线计算的相关主题。
+
+    每个主题的特征是它的标签、所在的 cafe 和喜欢它的用户，两个主题的
+    相关度是共同特征的权重之和，权重是 ``WEIGHTS[类型] / log(1 + 主题数)``，
+    越常见的特征权重越小，超过 ``MAX_FEATURE_TOPICS`` 个主题的特征直接
+    忽略。结果保存在 redis 有序集合里，由 ``build_related_topics`` 定时
+    计算，只重新计算上次运行之后有变化的主题，和它们相关的主题的列表不会
+    跟着更新，需要定期完整计算一次。每次运行都会导出全部特征并建立索引，
+    增量的只是相关度的计算和写入。
+
+    查询只能找到新增和修改的数据，删除了的主题、取消的喜欢和移出的 cafe
+    由事件记录在 ``RELATED_CHANGED`` 里。
+
+    安装了 numpy 和 scipy 时用稀疏矩阵乘法计算，否则用倒排表逐个计算。
+"""
+
+import math
+import time
+import datetime
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import func
+from zerqu.models import db, Topic, TopicLike, CafeTopic
+from zerqu.libs.cache import redis
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+# 每个主题的相关主题，score 是相关度
+RELATED_KEY = 'related:topic:{}'
+# 上次运行的时间
+RELATED_LAST_RUN = 'related:last_run'
+# 特征减少了的主题，下次运行时重新计算
+RELATED_CHANGED = 'related:changed'
+
+WEIGHTS = {
+    'tag': 3,
+    'cafe': 1,
+    'like': 2,
+}
+# 太常见的特征（比如很大的 cafe）区分不出相关的主题
+MAX_FEATURE_TOPICS = 5000
+
+
+def get_related_topics(topic_id, count=10):
+    ids = redis.zrevrange(RELATED_KEY.format(topic_id), 0, count - 1)
+    return Topic.cache.get_many([int(i) for i in ids])
+
+
+def mark_related_changed(topic_id):
+    """主题删除了，或者取消了喜欢、移出了 cafe"""
+    redis.sadd(RELATED_CHANGED, topic_id)
+
+
+def remove_related_topics(topic_id):
+    """主题删除之后马上删除它的相关主题
+
+    正在运行的计算可能又写入了，所以也记录下来，下次运行时再删除一次。
+    """
+    with redis.pipeline() as pipe:
+        pipe.delete(RELATED_KEY.format(topic_id))
+        pipe.sadd(RELATED_CHANGED, topic_id)
+        pipe.execute()
+
+
+def build_related_topics(full=False, batch_size=1000):
+    """计算有变化的主题的相关主题，``full`` 时计算所有主题
+
+    返回计算的主题数量。
+    """
+    now = time.time()
+    marked = [int(i) for i in redis.smembers(RELATED_CHANGED)]
+    since = None if full else redis.get(RELATED_LAST_RUN)
+    if since:
+        since = datetime.datetime.utcfromtimestamp(float(since))
+        changed = get_changed_topic_ids(since) | set(marked)
+    else:
+        changed = None
+
+    size = current_app.config.get('ZERQU_RELATED_SIZE', 10)
+    index = FeatureIndex(iter_topic_features())
+    if changed is None:
+        changed = list(index.topics)
+    else:
+        # 没有任何特征的主题（比如删除了）也就没有相关主题
+        save_related((tid, []) for tid in changed if tid not in index.topics)
+        changed = [tid for tid in changed if tid in index.topics]
+
+    for start in range(0, len(changed), batch_size):
+        topic_ids = changed[start:start + batch_size]
+        save_related(index.related(topic_ids, size))
+    with redis.pipeline() as pipe:
+        pipe.set(RELATED_LAST_RUN, now)
+        if marked:
+            pipe.srem(RELATED_CHANGED, *marked)
+        pipe.execute()
+    return len(changed)
+
+
+def get_changed_topic_ids(since):
+    """``since`` 之后修改了、发布到 cafe 或者被喜欢的主题"""
+    rv = set()
+    q = db.session.query(Topic.id).filter(Topic.updated_at >= since)
+    rv.update(tid for tid, in q)
+    q = db.session.query(CafeTopic.topic_id)
+    q = q.filter(CafeTopic.updated_at >= since)
+    rv.update(tid for tid, in q)
+    q = db.session.query(TopicLike.topic_id)
+    q = q.filter(TopicLike.created_at >= since)
+    rv.update(tid for tid, in q)
+    return rv
+
+
+def iter_topic_features(chunk_size=10000):
+    """导出 ``(主题 ID, (类型, 值))``"""
+    tag = func.unnest(Topic.tags)
+    q = db.session.query(Topic.id, tag).yield_per(chunk_size)
+    for tid, name in q:
+        yield tid, ('tag', name)
+
+    q = db.session.query(CafeTopic.topic_id, CafeTopic.cafe_id)
+    q = q.filter_by(status=CafeTopic.STATUS_PUBLIC).yield_per(chunk_size)
+    for tid, cafe_id in q:
+        yield tid, ('cafe', cafe_id)
+
+    q = db.session.query(TopicLike.topic_id, TopicLike.user_id)
+    for tid, user_id in q.yield_per(chunk_size):
+        yield tid, ('like', user_id)
+
+
+def save_related(related):
+    with redis.pipeline(transaction=False) as pipe:
+        for tid, items in related:
+            key = RELATED_KEY.format(tid)
+            pipe.delete(key)
+            args = []
+            for other, score in items:
+                args.extend((score, other))
+            if args:
+                pipe.zadd(key, *args)
+        pipe.execute()
+
+
+class FeatureIndex(object):
+    """主题和特征的关联，``related`` 计算相关度最高的主题"""
+
+    def __init__(self, pairs):
+        self.topics = {}
+        features = {}
+        kinds = []
+        rows = []
+        cols = []
+        for tid, feature in set(pairs):
+            rows.append(self.topics.setdefault(tid, len(self.topics)))
+            col = features.get(feature)
+            if col is None:
+                col = features[feature] = len(features)
+                kinds.append(feature[0])
+            cols.append(col)
+        self.topic_ids = [None] * len(self.topics)
+        for tid, row in self.topics.items():
+            self.topic_ids[row] = tid
+
+        counts = [0] * len(features)
+        for col in cols:
+            counts[col] += 1
+        weights = [
+            0 if n > MAX_FEATURE_TOPICS else WEIGHTS[kind] / math.log(1 + n)
+            for kind, n in zip(kinds, counts)
+        ]
+
+        if sparse is not None:
+            shape = (len(self.topics), len(features))
+            data = np.ones(len(rows), dtype=np.float32)
+            m = sparse.csr_matrix((data, (rows, cols)), shape=shape)
+            # 主题 x 特征，乘以特征的权重
+            diag = sparse.diags([np.array(weights, dtype=np.float32)], [0])
+            self.weighted = m.dot(diag).tocsr()
+            self.weighted.eliminate_zeros()
+            # 特征 x 主题
+            self.transposed = m.T.tocsr()
+            return
+
+        self.topic_features = defaultdict(list)
+        self.feature_topics = defaultdict(list)
+        for row, col in zip(rows, cols):
+            if weights[col]:
+                self.topic_features[row].append((col, weights[col]))
+                self.feature_topics[col].append(row)
+
+    def related(self, topic_ids, size=10):
+        """返回 ``[(主题 ID, [(相关主题 ID, 相关度)])]``"""
+        rows = [self.topics[tid] for tid in topic_ids]
+        if sparse is not None:
+            # 一次矩阵乘法得到这一批主题和所有主题的相关度
+            scores = self.weighted[rows].dot(self.transposed).tocsr()
+            for i, row in enumerate(rows):
+                start, end = scores.indptr[i], scores.indptr[i + 1]
+                cols = scores.indices[start:end]
+                data = scores.data[start:end]
+                data[cols == row] = 0
+                if len(data) > size:
+                    top = np.argpartition(-data, size)[:size]
+                    cols, data = cols[top], data[top]
+                yield self.topic_ids[row], self._top(zip(cols, data), size)
+            return
+
+        for row in rows:
+            items = defaultdict(float)
+            for col, weight in self.topic_features[row]:
+                for other in self.feature_topics[col]:
+                    items[other] += weight
+            items.pop(row, None)
+            yield self.topic_ids[row], self._top(items.items(), size)
+
+    def _top(self, items, size):
+        items = sorted(items, key=lambda o: o[1], reverse=True)
+        return [
+            (self.topic_ids[col], round(float(score), 4))
+            for col, score in items[:size] if score > 0
+        ]
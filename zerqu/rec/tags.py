@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+    zerqu.rec.tags
+    ~~~~~~~~~~~~~~
+
+    主题标签。``Topic.tags`` 有 GIN 索引，每个标签最新的主题 ID 保存在
+    有序集合里，超出保存的数量之后才用索引查询；标签的主题数量保存在
+    ``TAG_COUNTS``，作为标签的热度。
+"""
+
+from flask import current_app
+from sqlalchemy import func, cast, String
+from zerqu.models import db, Topic
+from zerqu.models.base import ARRAY
+from zerqu.libs.cache import redis, run_script, zset_page
+from zerqu.libs.utils import to_str
+
+# 标签最新的主题，成员和 score 都是主题 ID，也有占位成员
+TAG_TOPICS_KEY = 'tag_topics:{}'
+TAG_TOPICS_PLACEHOLDER = 0
+# 每个标签的主题数量
+TAG_COUNTS = 'tags:counts'
+
+
+def get_tag_topics(tag, cursor=None, count=20):
+    """标签下的主题，从新到旧，cursor 是上一页最后一个主题的 ID"""
+    ids = read_tag_topic_ids(tag, cursor, count)
+    topics = Topic.cache.get_many(ids)
+    if len(ids) < count:
+        return topics, 0
+    return topics, ids[-1]
+
+
+def read_tag_topic_ids(tag, cursor=None, count=20):
+    config = current_app.config
+    size = config.get('ZERQU_TAG_TOPICS_SIZE', 500)
+    expires = config.get('ZERQU_TAG_TOPICS_EXPIRES', 86400)
+    key = TAG_TOPICS_KEY.format(tag)
+    start = '(%d' % cursor if cursor else '+inf'
+    end = '(%d' % TAG_TOPICS_PLACEHOLDER
+    with redis.pipeline() as pipe:
+        # 没有人读取的标签过期之后删除
+        pipe.expire(key, expires)
+        pipe.zrevrangebyscore(key, start, end, start=0, num=count)
+        pipe.zcard(key)
+        alive, ids, total = pipe.execute()
+
+    if not alive:
+        rebuilt = rebuild_tag_topics(tag, size, expires)
+        ids = [i for i in rebuilt if not cursor or i < cursor][:count]
+        total = len(rebuilt) + 1
+    ids = [int(i) for i in ids]
+    if len(ids) < count and total >= size:
+        ids = query_tag_topic_ids(tag, cursor, count)
+    return ids
+
+
+def rebuild_tag_topics(tag, size, expires):
+    ids = query_tag_topic_ids(tag, count=size)
+    args = [TAG_TOPICS_PLACEHOLDER, TAG_TOPICS_PLACEHOLDER]
+    for tid in ids:
+        args.extend((tid, tid))
+    key = TAG_TOPICS_KEY.format(tag)
+    with redis.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.zadd(key, *args)
+        pipe.expire(key, expires)
+        pipe.execute()
+    return ids
+
+
+def query_tag_topic_ids(tag, cursor=None, count=20):
+    """``tags @> ARRAY[tag]`` 可以使用 GIN 索引，不包括草稿"""
+    # 参数要转换成 varchar[]，否则没有 varchar[] @> text[] 运算符
+    tags = cast([tag], ARRAY(String))
+    q = db.session.query(Topic.id).filter(Topic.tags.contains(tags))
+    q = q.filter(Topic.status != Topic.STATUS_DRAFT)
+    if cursor:
+        q = q.filter(Topic.id < cursor)
+    q = q.order_by(Topic.id.desc()).limit(count)
+    return [i for i, in q]
+
+
+def update_topic_tags(topic_id, added=(), removed=()):
+    """主题的标签变化之后更新标签的主题和数量
+
+    标签的有序集合不存在时等读取时重建。
+    """
+    size = current_app.config.get('ZERQU_TAG_TOPICS_SIZE', 500)
+    with redis.pipeline(transaction=False) as pipe:
+        for tag in added:
+            run_script(
+                'zadd_capped', keys=[TAG_TOPICS_KEY.format(tag)],
+                args=[topic_id, topic_id, size], client=pipe,
+            )
+            pipe.zincrby(TAG_COUNTS, tag, 1)
+        for tag in removed:
+            pipe.zrem(TAG_TOPICS_KEY.format(tag), topic_id)
+            pipe.zincrby(TAG_COUNTS, tag, -1)
+        if removed:
+            pipe.zremrangebyscore(TAG_COUNTS, '-inf', 0)
+        pipe.execute()
+
+
+def get_popular_tags(cursor=None, count=20):
+    """主题数量最多的标签，返回 ``([(标签, 数量)], cursor)``
+
+    cursor 的格式见 ``zset_page``，格式不对时抛出 ``ValueError``。
+    """
+    rv, cursor = zset_page(TAG_COUNTS, cursor, count)
+    return [(to_str(tag), int(n)) for tag, n in rv], cursor
+
+
+def rebuild_tag_counts():
+    """用一次 ``unnest`` 聚合重新统计标签的主题数量，返回标签数量"""
+    tag = func.unnest(Topic.tags).label('tag')
+    sub = db.session.query(tag)
+    sub = sub.filter(Topic.status != Topic.STATUS_DRAFT).subquery()
+    q = db.session.query(sub.c.tag, func.count(1)).group_by(sub.c.tag)
+    args = []
+    for name, n in q:
+        args.extend((n, name))
+    with redis.pipeline() as pipe:
+        pipe.delete(TAG_COUNTS)
+        if args:
+            pipe.zadd(TAG_COUNTS, *args)
+        pipe.execute()
+    return len(args) // 2
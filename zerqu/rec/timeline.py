@@ -1,9 +1,26 @@
 # coding: utf-8
 
+import heapq
 import random
+from flask import current_app
+from sqlalchemy import func
 from zerqu.models import db, Topic, Cafe, CafeMember, CafeTopic
-from zerqu.libs.cache import cached
-# TODO: use redis to calculate popularity
+from zerqu.libs.cache import cached, redis, run_script
+from zerqu.rec.popularity import TOPIC_CAFES
+
+# 推模式的用户时间线，成员和 score 都是主题 ID
+TIMELINE_KEY = 'timeline:user:{}'
+# 空时间线的占位成员，保证 key 存在，读取时过滤掉
+TIMELINE_PLACEHOLDER = 0
+# 每个 cafe 最新的公开主题，成员和 score 都是主题 ID，也有占位成员
+CAFE_TOPICS_KEY = 'cafe_topics:{}'
+# 按状态和权限分类的 cafe ID 集合，由 Cafe 的事件维护，也有占位成员
+CAFE_SETS = {
+    'public': 'cafes:public',
+    'promoted': 'cafes:promoted',
+    'official': 'cafes:official',
+}
+PROMOTED_STATUSES = (Cafe.STATUS_OFFICIAL, Cafe.STATUS_VERIFIED)
 
 
 def get_timeline_topics(cursor=None, user_id=None, count=20):
@@ -20,9 +37,137 @@ def get_timeline_topics(cursor=None, user_id=None, count=20):
 
     if len(cafe_ids) < 10:
         cafe_ids = get_random_cafe_ids() | cafe_ids
+    if user_id and current_app.config.get('ZERQU_TIMELINE_FANOUT'):
+        return get_materialized_topics(user_id, cafe_ids, cursor, count)
     return get_cafe_topics(cafe_ids, cursor, count)
 
 
+def get_materialized_topics(user_id, cafe_ids, cursor=None, count=20):
+    """从推模式的时间线读取，不推送的 cafe 另外查询后合并
+
+    时间线不存在（新用户或者过期了）时用一次查询重建。翻页超出了保存的
+    数量之后全部用查询。
+    """
+    config = current_app.config
+    size = config.get('ZERQU_TIMELINE_SIZE', 800)
+    expires = config.get('ZERQU_TIMELINE_EXPIRES', 7 * 86400)
+    pushed = get_following_cafe_ids(user_id) - get_pull_cafe_ids()
+    pulled = cafe_ids - pushed
+
+    key = TIMELINE_KEY.format(user_id)
+    start = '(%d' % cursor if cursor else '+inf'
+    end = '(%d' % TIMELINE_PLACEHOLDER
+    for i in range(2):
+        with redis.pipeline() as pipe:
+            # 读取的同时延长过期时间，key 存在说明用户是活跃的
+            pipe.expire(key, expires)
+            pipe.zrevrangebyscore(key, start, end, start=0, num=count)
+            pipe.zcard(key)
+            alive, ids, total = pipe.execute()
+        if alive:
+            break
+        rebuild_timeline(user_id, pushed, size, expires)
+
+    ids = [int(i) for i in ids]
+    if len(ids) < count and total >= size:
+        ids = []
+        pulled = cafe_ids
+    if pulled:
+        ids = set(ids) | set(merge_cafe_topic_ids(pulled, cursor, count))
+        ids = sorted(ids, reverse=True)[:count]
+
+    topics = Topic.cache.get_many(ids)
+    if len(ids) < count:
+        return topics, 0
+    return topics, ids[-1]
+
+
+def rebuild_timeline(user_id, cafe_ids, size, expires):
+    ids = []
+    if cafe_ids:
+        ids = merge_cafe_topic_ids(cafe_ids, count=size)
+    args = [TIMELINE_PLACEHOLDER, TIMELINE_PLACEHOLDER]
+    for tid in ids:
+        args.extend((tid, tid))
+
+    key = TIMELINE_KEY.format(user_id)
+    with redis.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.zadd(key, *args)
+        pipe.expire(key, expires)
+        pipe.execute()
+
+
+def reset_timeline(user_id):
+    """关注的 cafe 变化之后删除时间线，下次读取时重建"""
+    redis.delete(TIMELINE_KEY.format(user_id))
+
+
+def fanout_cafe_topic(cafe_id, topic_id, remove=False):
+    """把 cafe 的主题推送到关注者的时间线，或者从时间线里移除
+
+    只推送到还存在的时间线，过期的等读取时重建。移除时主题还在用户关注的
+    其他 cafe 里公开的保留，``TOPIC_CAFES`` 需要先更新。
+    """
+    config = current_app.config
+    if not config.get('ZERQU_TIMELINE_FANOUT'):
+        return
+    if cafe_id in get_pull_cafe_ids():
+        return
+
+    limit = config.get('ZERQU_TIMELINE_FANOUT_LIMIT', 2000)
+    user_ids = get_cafe_follower_ids(cafe_id, limit + 1)
+    if len(user_ids) > limit:
+        # 关注者刚刚超过限制，get_pull_cafe_ids 还没有更新
+        return
+
+    size = config.get('ZERQU_TIMELINE_SIZE', 800)
+    with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            key = TIMELINE_KEY.format(user_id)
+            if remove:
+                keys = [
+                    key, CafeMember.FOLLOWING_KEY.format(user_id),
+                    TOPIC_CAFES.format(topic_id),
+                ]
+                run_script(
+                    'timeline_zrem', keys=keys, args=[topic_id], client=pipe,
+                )
+            else:
+                run_script(
+                    'zadd_capped', keys=[key],
+                    args=[topic_id, topic_id, size], client=pipe,
+                )
+        pipe.execute()
+
+
+def get_cafe_follower_ids(cafe_id, limit=None):
+    """关注 cafe 的用户，和 ``get_following_cafe_ids`` 对应"""
+    q = db.session.query(CafeMember.user_id).filter_by(cafe_id=cafe_id)
+    q = q.filter(CafeMember.role >= CafeMember.ROLE_SUBSCRIBER)
+    if limit:
+        q = q.limit(limit)
+    rv = {user_id for user_id, in q}
+    cafe = Cafe.cache.get(cafe_id)
+    if cafe:
+        rv.add(cafe.user_id)
+    return rv
+
+
+def get_pull_cafe_ids():
+    """官方 cafe 和关注者太多的 cafe 不推送，读取时查询"""
+    return get_cafe_ids('official') | get_crowded_cafe_ids()
+
+
+@cached('timeline:crowded_cafe_ids')
+def get_crowded_cafe_ids():
+    limit = current_app.config.get('ZERQU_TIMELINE_FANOUT_LIMIT', 2000)
+    q = db.session.query(CafeMember.cafe_id)
+    q = q.filter(CafeMember.role >= CafeMember.ROLE_SUBSCRIBER)
+    q = q.group_by(CafeMember.cafe_id).having(func.count(1) > limit)
+    return {cafe_id for cafe_id, in q}
+
+
 def get_all_topics(cursor=None, count=20):
     """获取所有主题
     :param cursor:
@@ -41,50 +186,184 @@ def get_all_topics(cursor=None, count=20):
     return topics, topic_ids[-1]
 
 
-@cached('timeline:following_cafe_ids:%s')
 def get_following_cafe_ids(user_id):
     """获取关注的cafe ids"""
-    q = db.session.query(Cafe.id).filter_by(status=Cafe.STATUS_OFFICIAL)
-    official = {cafe_id for cafe_id, in q}
-    following = CafeMember.get_user_following_cafe_ids(user_id)
+    keys = ensure_cafe_sets('official')
+    keys.append(CafeMember.ensure_user_following(user_id))
+    return union_cafe_ids(keys) | get_owned_cafe_ids(user_id)
+
+
+@cached('timeline:owned_cafe_ids:%s')
+def get_owned_cafe_ids(user_id):
     q = db.session.query(Cafe.id).filter_by(user_id=user_id)
-    mine = {cafe_id for cafe_id, in q}
-    return official | following | mine
+    return {cafe_id for cafe_id, in q}
 
 
-@cached('timeline:promoted_cafe_ids')
 def get_promoted_cafe_ids():
-    statuses = [Cafe.STATUS_OFFICIAL, Cafe.STATUS_VERIFIED]
-    q = db.session.query(Cafe.id).filter(Cafe.status.in_(statuses))
-    return {cafe_id for cafe_id, in q}
+    return get_cafe_ids('promoted')
 
 
-@cached('timeline:random_cafe_ids')
 def get_random_cafe_ids():
     # random sample some public cafes
-    q = db.session.query(Cafe.id)
-    q = q.filter_by(permission=Cafe.PERMISSION_PUBLIC)
-    choices = {cafe_id for cafe_id, in q}
+    key = ensure_cafe_sets('public')[0]
+    choices = {int(i) for i in redis.srandmember(key, 10)}
+    choices.discard(TIMELINE_PLACEHOLDER)
     if len(choices) > 8:
         return set(random.sample(choices, 6))
     return choices
 
 
-@cached('timeline:all_cafe_ids')
-def get_all_cafe_ids():
+def get_cafe_ids(*names):
+    """``CAFE_SETS`` 里几个集合的并集"""
+    return union_cafe_ids(ensure_cafe_sets(*names))
+
+
+def union_cafe_ids(keys):
+    rv = {int(i) for i in redis.sunion(keys)}
+    rv.discard(TIMELINE_PLACEHOLDER)
+    return rv
+
+
+def ensure_cafe_sets(*names):
+    """不存在的集合从数据库重建，返回集合的 key"""
+    keys = [CAFE_SETS[name] for name in names]
+    with redis.pipeline() as pipe:
+        for key in keys:
+            pipe.exists(key)
+        rv = pipe.execute()
+    for name, exists in zip(names, rv):
+        if not exists:
+            rebuild_cafe_set(name)
+    return keys
+
+
+def rebuild_cafe_set(name):
     q = db.session.query(Cafe.id)
-    return {cafe_id for cafe_id, in q}
+    if name == 'public':
+        q = q.filter_by(permission=Cafe.PERMISSION_PUBLIC)
+    elif name == 'promoted':
+        q = q.filter(Cafe.status.in_(PROMOTED_STATUSES))
+    else:
+        q = q.filter_by(status=Cafe.STATUS_OFFICIAL)
+    key = CAFE_SETS[name]
+    with redis.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.sadd(key, TIMELINE_PLACEHOLDER, *[cafe_id for cafe_id, in q])
+        pipe.execute()
+
+
+def get_cafe_set_names(cafe):
+    """cafe 属于 ``CAFE_SETS`` 里的哪些集合，和 ``rebuild_cafe_set`` 对应"""
+    rv = set()
+    if cafe.permission == Cafe.PERMISSION_PUBLIC:
+        rv.add('public')
+    if cafe.status in PROMOTED_STATUSES:
+        rv.add('promoted')
+    if cafe.status == Cafe.STATUS_OFFICIAL:
+        rv.add('official')
+    return rv
+
+
+def update_cafe_sets(cafe_id, names):
+    """cafe 新建、修改或者删除之后更新集合，不存在的集合等读取时重建"""
+    with redis.pipeline() as pipe:
+        for name, key in CAFE_SETS.items():
+            if name in names:
+                run_script(
+                    'sadd_if_exists', keys=[key], args=[cafe_id],
+                    client=pipe,
+                )
+            else:
+                pipe.srem(key, cafe_id)
+        pipe.execute()
 
 
 def get_cafe_topics(cafe_ids, cursor=None, count=20):
+    topic_ids = merge_cafe_topic_ids(cafe_ids, cursor, count)
+    topics = Topic.cache.get_many(topic_ids)
+    if len(topic_ids) < count:
+        return topics, 0
+    return topics, topic_ids[-1]
+
+
+def merge_cafe_topic_ids(cafe_ids, cursor=None, count=20):
+    """``cafe_ids`` 里最新的公开主题 ID，从大到小
+
+    每个 cafe 读取 ``count`` 个比 cursor 小的 ID，用堆合并，
+    同一个主题可能在多个 cafe 里，只保留一个。
+    """
+    lists = read_cafe_topic_ids(cafe_ids, cursor, count)
+    # python 2 的 heapq.merge 不支持 reverse
+    iters = [(-i for i in ids) for ids in lists]
+    rv = []
+    for i in heapq.merge(*iters):
+        if rv and rv[-1] == -i:
+            continue
+        rv.append(-i)
+        if len(rv) == count:
+            break
+    return rv
+
+
+def read_cafe_topic_ids(cafe_ids, cursor=None, count=20):
+    """每个 cafe 比 cursor 小的最多 ``count`` 个主题 ID
+
+    优先读取 ``CAFE_TOPICS_KEY``，不存在时重建；超出了保存的数量时
+    用 ``(cafe_id, topic_id)`` 主键做一次索引查询。
+    """
+    cafe_ids = list(cafe_ids)
+    size = current_app.config.get('ZERQU_CAFE_TOPICS_SIZE', 500)
+    start = '(%d' % cursor if cursor else '+inf'
+    end = '(%d' % TIMELINE_PLACEHOLDER
+    with redis.pipeline() as pipe:
+        for cafe_id in cafe_ids:
+            key = CAFE_TOPICS_KEY.format(cafe_id)
+            pipe.zrevrangebyscore(key, start, end, start=0, num=count)
+            pipe.zcard(key)
+        rv = pipe.execute()
+
+    lists = []
+    for n, cafe_id in enumerate(cafe_ids):
+        ids, total = rv[n * 2], rv[n * 2 + 1]
+        if not total:
+            rebuilt = rebuild_cafe_topics(cafe_id, size)
+            ids = [i for i in rebuilt if not cursor or i < cursor][:count]
+            total = len(rebuilt) + 1
+        ids = [int(i) for i in ids]
+        if len(ids) < count and total >= size:
+            ids = query_cafe_topic_ids(cafe_id, cursor, count)
+        lists.append(ids)
+    return lists
+
+
+def rebuild_cafe_topics(cafe_id, size):
+    ids = query_cafe_topic_ids(cafe_id, count=size)
+    args = [TIMELINE_PLACEHOLDER, TIMELINE_PLACEHOLDER]
+    for tid in ids:
+        args.extend((tid, tid))
+    key = CAFE_TOPICS_KEY.format(cafe_id)
+    with redis.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.zadd(key, *args)
+        pipe.execute()
+    return ids
+
+
+def update_cafe_topics(cafe_id, topic_id, remove=False):
+    """cafe 的主题发布或者移除，``CAFE_TOPICS_KEY`` 不存在时等读取时重建"""
+    key = CAFE_TOPICS_KEY.format(cafe_id)
+    if remove:
+        redis.zrem(key, topic_id)
+        return
+    size = current_app.config.get('ZERQU_CAFE_TOPICS_SIZE', 500)
+    run_script('zadd_capped', keys=[key], args=[topic_id, topic_id, size])
+
+
+def query_cafe_topic_ids(cafe_id, cursor=None, count=20):
+    """一个 cafe 里最新的公开主题 ID，从大到小"""
     q = db.session.query(CafeTopic.topic_id)
-    q = q.filter(CafeTopic.cafe_id.in_(cafe_ids))
+    q = q.filter_by(cafe_id=cafe_id, status=CafeTopic.STATUS_PUBLIC)
     if cursor:
         q = q.filter(CafeTopic.topic_id < cursor)
-
     q = q.order_by(CafeTopic.topic_id.desc()).limit(count)
-    topic_ids = {i for i, in q}
-    topics = Topic.cache.get_many(topic_ids)
-    if not topics:
-        return [], 0
-    return topics, topics[-1].id
+    return [i for i, in q]
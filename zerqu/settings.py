@@ -16,6 +16,68 @@ ZERQU_CACHE_TYPE = 'redis'
 ZERQU_CACHE_REDIS_DB = 2
 ZERQU_REDIS_URI = 'redis://localhost:6379/0'
 
+# per-worker in-process cache in front of redis for model rows,
+# invalidated through redis pub/sub
+ZERQU_LOCAL_CACHE = False
+ZERQU_LOCAL_CACHE_TIMEOUT = 60
+
+# serializer for cached model rows: msgpack (falls back to pickle when
+# msgpack is not installed), pickle, or a module string for importing
+ZERQU_MODEL_CODEC = 'msgpack'
+
+# JSON library for API responses: simplejson (falls back to json when
+# it is not installed), json, or a module string for importing. Sorted
+# keys and indentation disable the C encoders, so both are off.
+ZERQU_JSON_BACKEND = 'simplejson'
+JSON_SORT_KEYS = False
+JSONIFY_PRETTYPRINT_REGULAR = False
+
+# per-model cache hit/miss/latency counters, aggregated in each worker
+# and written to redis every ZERQU_CACHE_METRICS_INTERVAL seconds
+ZERQU_CACHE_METRICS = True
+ZERQU_CACHE_METRICS_INTERVAL = 10
+
+# buffer RedisStat increments such as topic views in each worker and
+# write them in one pipeline every ZERQU_STAT_BUFFER_INTERVAL
+# milliseconds (or after ZERQU_STAT_BUFFER_SIZE increments); reads may
+# lag by up to the interval. 0 disables buffering.
+ZERQU_STAT_BUFFER_INTERVAL = 1000
+ZERQU_STAT_BUFFER_SIZE = 1000
+
+# push new cafe topics into a capped redis zset per follower
+# (fan-out-on-write) instead of querying zq_cafe_topic for every page.
+# Only timelines read within ZERQU_TIMELINE_EXPIRES seconds are kept;
+# official cafes and cafes with more than ZERQU_TIMELINE_FANOUT_LIMIT
+# followers are still queried when reading.
+ZERQU_TIMELINE_FANOUT = False
+ZERQU_TIMELINE_SIZE = 800
+ZERQU_TIMELINE_FANOUT_LIMIT = 2000
+ZERQU_TIMELINE_EXPIRES = 7 * 86400
+
+# newest public topic ids kept in redis for each cafe; timelines merge
+# these lists and only query older pages from the database
+ZERQU_CAFE_TOPICS_SIZE = 500
+
+# newest topic ids kept in redis for each tag (/api/tags/<tag>/topics);
+# lists not read for ZERQU_TAG_TOPICS_EXPIRES seconds are dropped. Run
+# `python manage.py rebuild_tag_counts` once to count existing tags.
+ZERQU_TAG_TOPICS_SIZE = 500
+ZERQU_TAG_TOPICS_EXPIRES = 86400
+
+# hot ranking of topics (?sort=hot): every like/comment/read/view adds
+# a weight that halves every ZERQU_HOT_HALF_LIFE seconds. Run
+# `python manage.py decay_hot_scores` periodically to rescale scores
+# and keep at most ZERQU_HOT_SIZE topics above ZERQU_HOT_MIN_SCORE.
+ZERQU_HOT_HALF_LIFE = 86400
+ZERQU_HOT_SIZE = 10000
+ZERQU_HOT_MIN_SCORE = 0.01
+
+# related topics (/api/topics/<id>/related) computed offline from shared
+# tags, cafes and likes. Run `python manage.py build_related_topics`
+# periodically, and with --full now and then; it uses numpy and scipy
+# when they are installed.
+ZERQU_RELATED_SIZE = 10
+
 BABEL_DEFAULT_LOCALE = 'en'
 BABEL_LOCALES = ['en', 'zh']
 
@@ -34,4 +96,12 @@ ZERQU_VALID_MODIFY_TIME = 3600
 # it can also be a module string for importing
 ZERQU_TEXT_RENDERER = 'markdown'
 
+# rendered html is cached in redis by renderer name, ZERQU_RENDERER_VERSION
+# and the sha1 of the content; bump the version after changing the renderer.
+# With ZERQU_LOCAL_CACHE on, ZERQU_HTML_LOCAL_CACHE_SIZE entries are also
+# kept in each worker
+ZERQU_RENDERER_VERSION = 1
+ZERQU_HTML_CACHE_EXPIRES = 7 * 86400
+ZERQU_HTML_LOCAL_CACHE_SIZE = 2000
+
 ZERQU_CAFE_CREATOR_ROLES = [4, 7, 8, 9]